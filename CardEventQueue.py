@@ -0,0 +1,80 @@
+import threading
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from typing import Deque, Dict, List, Optional
+
+
+class CardEventKind(Enum):
+    DETECTED = "detected"
+    LOST = "lost"
+    SAMPLE = "sample"  # We know what sample the card holds, so there is a new pattern to draw
+
+
+@dataclass(frozen=True)
+class CardEvent:
+    kind: CardEventKind
+    received_at: float  # time.monotonic() at which the reader reported it
+    card_id: Optional[str] = None
+    sample: Optional[Dict] = None
+    trace: Optional[int] = None  # Latency trace that follows this event to the screen, if any
+
+
+# Which pending events are made obsolete by a new event of a given kind. Only the latest state matters for the
+# renderer; a card that was lost has no use for the pattern that was still waiting to be drawn, a card that shows up
+# again cancels the fade out of it being lost, and only the newest pattern is drawn. Apart from the pattern, events only
+# supersede those of the same card, so another card that is swiped in the meantime doesn't swallow them. A pending
+# event without a card (eg; a sample read from the tag itself) belongs to whatever card was there.
+ANY_CARD = "any card"
+SAME_CARD = "same card"
+SUPERSEDES: Dict[CardEventKind, Dict[CardEventKind, str]] = {
+    CardEventKind.DETECTED: {CardEventKind.LOST: SAME_CARD},
+    CardEventKind.LOST: {CardEventKind.DETECTED: SAME_CARD, CardEventKind.LOST: SAME_CARD,
+                         CardEventKind.SAMPLE: SAME_CARD},
+    CardEventKind.SAMPLE: {CardEventKind.SAMPLE: ANY_CARD},
+}
+
+
+def supersedes(event: CardEvent, pending: CardEvent) -> bool:
+    scope = SUPERSEDES[event.kind].get(pending.kind)
+    if scope is None:
+        return False
+    return scope == ANY_CARD or pending.card_id is None or pending.card_id == event.card_id
+
+
+class CardEventQueue:
+    """
+    Hands card events from the RFID reactor thread (the single producer) to the render loop (the single consumer).
+
+    Events are coalesced while they wait; bursts (a card flapping between detected and lost, or a couple of cards
+    being swiped in a row) collapse into the few events that describe the latest state, so the render loop never
+    builds a pattern that is already outdated.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: Deque[CardEvent] = deque()
+
+    def put(self, event: CardEvent) -> List[CardEvent]:
+        """
+        Add an event, dropping the pending events it supersedes.
+        :return: The events that were dropped (so their latency traces can be discarded)
+        """
+        with self._lock:
+            dropped = [pending for pending in self._pending if supersedes(event, pending)]
+            if dropped:
+                self._pending = deque(pending for pending in self._pending if not supersedes(event, pending))
+            self._pending.append(event)
+        return dropped
+
+    def drain(self) -> List[CardEvent]:
+        """
+        Take all pending events, oldest first.
+        """
+        with self._lock:
+            events = list(self._pending)
+            self._pending.clear()
+        return events
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
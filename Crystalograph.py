@@ -1,3 +1,4 @@
+import logging
 from typing import Tuple, Optional, List
 
 import numpy as np
@@ -5,7 +6,7 @@ import cv2
 import math
 
 from ColorController import ColorController
-from DisplayLine import DisplayLine, Spike
+from DisplayLine import DisplayLine, Spike, NUM_SEGMENTS_PER_LENGTH
 
 from functools import cache
 
@@ -18,32 +19,68 @@ Image = np.ndarray
 Point = Tuple[int, int]
 Color = Tuple[int, int, int]
 
-NUM_SEGMENTS_PER_LENGTH = 0.4
 NUM_BACKGROUND_IMAGES = 48
 
+# Level of detail. The quality preset sets how many line segments are used per pixel at the reference resolution,
+# which is then scaled with the actual resolution (within the limits).
+QUALITY_PRESETS = {"low": 0.25, "medium": 0.4, "high": NUM_SEGMENTS_PER_LENGTH}
+REFERENCE_RESOLUTION = (1280, 720)
+MIN_RESOLUTION_FACTOR = 0.25
+MAX_RESOLUTION_FACTOR = 2.0
+
+# Internal render resolution. The image is rendered at render_scale * output size and upscaled once when presented.
+# With a dynamic render scale, the scale is lowered (or raised again) in steps based on the measured frame time.
+MIN_RENDER_SCALE = 0.4
+MAX_RENDER_SCALE = 1.0
+RENDER_SCALE_STEP = 0.1
+RENDER_SCALE_COOLDOWN_FRAMES = 60  # Frames to wait after a change before the frame time is judged again
+FRAME_TIME_SMOOTHING = 0.1
+INTERPOLATIONS = {"nearest": cv2.INTER_NEAREST, "linear": cv2.INTER_LINEAR, "cubic": cv2.INTER_CUBIC,
+                  "area": cv2.INTER_AREA, "lanczos": cv2.INTER_LANCZOS4}
+
 
 class Crystalograph:
-    def __init__(self) -> None:
+    def __init__(self, quality: str = "high", render_scale: float = 1.0, interpolation: str = "linear") -> None:
         self._image: Optional[np.ndarray] = None
         self._center = (0, 0)
+        # Size of the internal image that is rendered
         self._width = 0
         self._height = 0
+        # Size of the presented image. Lines are defined in this coordinate space.
+        self._output_width = 0
+        self._output_height = 0
         self._lines_to_draw = []
+        # The arguments for all the lines that were added, so they can be re-created when the render scale changes
+        self._line_definitions: List[dict] = []
         self._color_controller = ColorController()
 
         # Speed option. Keep the base layer in memory so a re-draw isn't needed.
         self._base_layer_image: Optional[np.ndarray] = None
         self._counter = 0  # Used to trick the drawBackground cache into giving different images
 
+        self._checkQuality(quality)
+        self._quality = quality
+        self._segments_per_length = QUALITY_PRESETS[quality]
+
+        self._render_scale = min(max(render_scale, MIN_RENDER_SCALE), MAX_RENDER_SCALE)
+        self._interpolation = INTERPOLATIONS[interpolation]
+        self._target_frame_time: Optional[float] = None  # In ms. None means that the render scale is fixed.
+        self._average_frame_time: Optional[float] = None
+        self._render_scale_cooldown = 0
+
     def addLineToDraw(self, line_type: str, base_color: str, radius: int, thickness: int, center: Point,
                       begin_angle: int, end_angle: int, spikes: Optional[List[Spike]] = None,
                       mask: Optional[List] = None):
         data = locals()
         del data["self"]
-        if line_type == "line":
-            self._lines_to_draw.append(DisplayLine(**data))
-        if line_type == "double_line":
-            self._lines_to_draw.append(DoubleDisplayLine(**data))
+        self._line_definitions.append(data)
+        self._lines_to_draw.append(self._createLine(data))
+
+    def _createLine(self, data: dict) -> DisplayLine:
+        data = dict(data, segments_per_length=self._segments_per_length, render_scale=self._render_scale)
+        if data["line_type"] == "double_line":
+            return DoubleDisplayLine(**data)
+        return DisplayLine(**data)
 
     def createEmptyImage(self, size: Tuple[int, int]) -> None:
         self._image = np.zeros((*size[::-1], 3), dtype=np.uint8)
@@ -51,11 +88,114 @@ class Crystalograph:
         self._center = (int(self._width / 2), int(self._height / 2))
         self._base_layer_image = None
 
+    def setOutputSize(self, size: Tuple[int, int]) -> None:
+        """
+        Set the size of the presented image. The internal image is created at this size times the render scale.
+        """
+        self._output_width, self._output_height = size
+        self._updateLevelOfDetail()
+        self.createEmptyImage(self._getRenderSize())
+
+    def getCenter(self) -> Point:
+        """
+        Center of the presented image
+        """
+        return int(self._output_width / 2), int(self._output_height / 2)
+
+    def _getRenderSize(self) -> Tuple[int, int]:
+        return max(int(self._output_width * self._render_scale), 1), max(int(self._output_height * self._render_scale), 1)
+
+    def getRenderScale(self) -> float:
+        return self._render_scale
+
+    def setRenderScale(self, render_scale: float) -> None:
+        render_scale = round(min(max(render_scale, MIN_RENDER_SCALE), MAX_RENDER_SCALE), 2)
+        if render_scale == self._render_scale:
+            return
+        self._render_scale = render_scale
+        self.createEmptyImage(self._getRenderSize())
+        # All the geometry is in internal image coordinates, so it has to be re-created
+        self._lines_to_draw = [self._createLine(data) for data in self._line_definitions]
+        self.setup()
+
+    def setTargetFrameTime(self, target_frame_time: Optional[float]) -> None:
+        """
+        Enable the dynamic render scale by setting a target frame time (in ms). Set to None to keep the scale fixed.
+        """
+        self._target_frame_time = target_frame_time
+        self._average_frame_time = None
+
+    def adaptRenderScale(self, frame_time: float) -> None:
+        """
+        Report how long the last frame took (in ms). If a target frame time is set, the render scale is lowered when
+        the frames are too slow and raised again when there is plenty of headroom.
+        """
+        if self._target_frame_time is None:
+            return
+        if self._average_frame_time is None:
+            self._average_frame_time = frame_time
+        self._average_frame_time += FRAME_TIME_SMOOTHING * (frame_time - self._average_frame_time)
+
+        if self._render_scale_cooldown > 0:
+            self._render_scale_cooldown -= 1
+            return
+        if self._average_frame_time > self._target_frame_time * 1.1:
+            new_render_scale = self._render_scale - RENDER_SCALE_STEP
+        elif self._average_frame_time < self._target_frame_time * 0.7:
+            new_render_scale = self._render_scale + RENDER_SCALE_STEP
+        else:
+            return
+        previous_render_scale = self._render_scale
+        self.setRenderScale(new_render_scale)
+        if self._render_scale != previous_render_scale:
+            logging.info(f"Render scale changed to {self._render_scale} (frame time {self._average_frame_time:.1f} ms)")
+            self._render_scale_cooldown = RENDER_SCALE_COOLDOWN_FRAMES
+            self._average_frame_time = None
+
+    def upscale(self, image: np.ndarray) -> np.ndarray:
+        """
+        Scale a rendered image up to the output size (if it isn't already)
+        """
+        if image.shape[1] == self._output_width and image.shape[0] == self._output_height:
+            return image
+        return cv2.resize(image, (self._output_width, self._output_height), interpolation=self._interpolation)
+
+    def _scaleKernelSize(self, kernel_size: int) -> int:
+        # Blur kernels are in pixels, so they have to scale along with the image. Gaussian kernels must be odd.
+        if kernel_size <= 0:
+            return kernel_size
+        return max(int(kernel_size * self._render_scale) | 1, 1)
+
+    def setQuality(self, quality: str) -> None:
+        """
+        Set the quality preset (one of QUALITY_PRESETS). Only affects lines that are added after this call.
+        """
+        self._checkQuality(quality)
+        self._quality = quality
+        self._updateLevelOfDetail()
+
+    @staticmethod
+    def _checkQuality(quality: str) -> None:
+        if quality not in QUALITY_PRESETS:
+            raise ValueError(f"Unknown quality {quality}, must be one of {list(QUALITY_PRESETS)}")
+
+    def getSegmentsPerLength(self) -> float:
+        return self._segments_per_length
+
+    def _updateLevelOfDetail(self) -> None:
+        # Smaller outputs get proportionally fewer segments (and thus smaller spike, mask & noise arrays). The render
+        # scale is not taken into account here, as the lines are already shorter on a smaller internal image.
+        resolution_factor = min(self._output_width / REFERENCE_RESOLUTION[0],
+                                self._output_height / REFERENCE_RESOLUTION[1])
+        resolution_factor = min(max(resolution_factor, MIN_RESOLUTION_FACTOR), MAX_RESOLUTION_FACTOR)
+        self._segments_per_length = QUALITY_PRESETS[self._quality] * resolution_factor
+
     def _createBaseImage(self, size: Tuple[int, int]) -> None:
         self._base_layer_image = np.zeros((*size[::-1], 3), dtype=np.uint8)
 
     def clearLinesToDraw(self):
         self._lines_to_draw = []
+        self._line_definitions = []
 
     def drawTargetLines(self) -> None:
         """
@@ -72,6 +212,8 @@ class Crystalograph:
 
     def applyBlooming(self, target_image, gaussian_ksize: int = 9, blur_ksize: int = 5) -> None:
         # Provide some blurring to image, to create some bloom.
+        gaussian_ksize = self._scaleKernelSize(gaussian_ksize)
+        blur_ksize = self._scaleKernelSize(blur_ksize)
         if gaussian_ksize > 0:
             cv2.GaussianBlur(target_image, (gaussian_ksize, gaussian_ksize), 0, dst=target_image)
         if blur_ksize > 0:
@@ -101,7 +243,8 @@ class Crystalograph:
             line.draw(self._image)
 
         # Draw a white line over it for the highlight
-        kernel = np.ones((5, 5), np.uint8)
+        kernel_size = self._scaleKernelSize(5)
+        kernel = np.ones((kernel_size, kernel_size), np.uint8)
 
         # Convert to black & white image
         highlights = cv2.cvtColor(self._image, cv2.COLOR_BGR2GRAY)
@@ -136,8 +279,7 @@ class Crystalograph:
                                circle_radius, circle_shift, action_type: str = "random", target_type: str = "random",
                                line_type="double_line"):
         angle_difference = int(math.degrees(math.asin(circle_shift / circle_radius)))
-        center_x = int(self._width / 2)
-        center_y = int(self._height / 2)
+        center_x, center_y = self.getCenter()
 
         spike_func = SpikeGenerator.getSpikeFunctionByTarget(target_type)
         mask_func = MaskGenerator.getMaskFunctionByAction(action_type)
@@ -180,8 +322,7 @@ class Crystalograph:
                              circle_radius, circle_shift, action_type: str = "random", target_type: str = "random",
                              line_type="double_line"):
         angle_difference = int(math.degrees(math.acos(circle_shift / circle_radius)))
-        center_x = int(self._width / 2)
-        center_y = int(self._height / 2)
+        center_x, center_y = self.getCenter()
 
         spike_func = SpikeGenerator.getSpikeFunctionByTarget(target_type)
         mask_func = MaskGenerator.getMaskFunctionByAction(action_type)
@@ -215,19 +356,19 @@ class Crystalograph:
 
 if __name__ == '__main__':
     crystalograph = Crystalograph()
-    crystalograph.createEmptyImage((1024, 768))
+    crystalograph.setOutputSize((1024, 768))
 
     crystalograph.addLineToDraw(line_type="line", thickness=1, radius=150, begin_angle=185, end_angle=209,
-                                base_color="blue", center=crystalograph._center)
+                                base_color="blue", center=crystalograph.getCenter())
     crystalograph.addLineToDraw(line_type="line", thickness=1, radius=200, begin_angle=185, end_angle=209,
-                                base_color="blue", center=crystalograph._center)
+                                base_color="blue", center=crystalograph.getCenter())
     crystalograph.addLineToDraw(line_type="line", thickness=1, radius=300, begin_angle=185, end_angle=209,
-                                base_color="blue", center=crystalograph._center)
+                                base_color="blue", center=crystalograph.getCenter())
 
     crystalograph.addLineToDraw(line_type="double_line", thickness=1, radius=300, begin_angle=185, end_angle=209,
-                                base_color="blue", center=crystalograph._center)
+                                base_color="blue", center=crystalograph.getCenter())
 
     crystalograph.setup()
-    img = crystalograph.draw()
+    img = crystalograph.upscale(crystalograph.draw())
     cv2.imshow('Test', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
     cv2.waitKey()
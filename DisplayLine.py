@@ -23,7 +23,8 @@ Mask = NamedTuple("Mask", [("angle", float), ("width", float)])
 
 class DisplayLine:
     def __init__(self, base_color: str, radius: int, thickness: int, center: Point, begin_angle: int, end_angle: int,
-                 line_type: str, spikes: Optional[List[Spike]] = None, mask: Optional[List] = None) -> None:
+                 line_type: str, spikes: Optional[List[Spike]] = None, mask: Optional[List] = None,
+                 segments_per_length: float = NUM_SEGMENTS_PER_LENGTH, render_scale: float = 1.0) -> None:
         """
         :param base_color: The main color of the line to be drawn
         :param radius: All the lines that we drawn are circles, so this indicates the radius from the center.
@@ -35,15 +36,18 @@ class DisplayLine:
         :param spikes: Should there be spikes on the circle. You can define the angle (of the center), width (in deg)
                         and intensity (1 being; double the signal)
         :param mask: What parts of the circle should be filtered out.
+        :param segments_per_length: How many segments are used per pixel of line length (the level of detail).
+        :param render_scale: Scale of the image the line is drawn on, relative to the size that radius, thickness and
+                            center are given in.
         """
         self._color_name = base_color
-        self._radius: radius = radius
-        self._thickness: int = thickness
-        self._center: Point = center
+        self._radius: radius = int(round(radius * render_scale))
+        self._thickness: float = max(thickness * render_scale, 1)
+        self._center: Point = (int(center[0] * render_scale), int(center[1] * render_scale))
         self._begin_angle: int = begin_angle
         self._end_angle: int = end_angle
 
-        self._noise = 0.08 * (100 / radius)  # normalize the noise
+        self._noise = 0.08 * (100 / radius)  # normalize the noise (on the unscaled radius, so it scales with the line)
 
         self._angle_noise = 2
 
@@ -51,14 +55,17 @@ class DisplayLine:
         self._color_controller = None
         if spikes is None:
             spikes = []
-        self._spikes = spikes
+        # Stored as a tuple so that it can be used as a key for the radius profile cache
+        self._spikes: Tuple[Spike, ...] = tuple(Spike(*map(float, spike)) for spike in spikes)
 
         self._max_variation = 25
         self._variation_number = random.randint(0, self._max_variation)
-        self._num_segments = self._calculateNumSegments(self._radius, begin_angle, end_angle)
+        self._num_segments = self._calculateNumSegments(self._radius, begin_angle, end_angle, segments_per_length)
+        # Scale the smoothing with the level of detail, so that it covers the same part of the line. Must be odd.
+        self._smoothing_window = max(int(11 * segments_per_length / NUM_SEGMENTS_PER_LENGTH) | 1, 3)
         if mask is None:
             mask = []
-        self._mask = mask
+        self._mask: np.ndarray = np.asarray(mask, dtype=float).reshape(-1, 2)
         self._mask_array = self._generateMask()
 
     def setup(self) -> None:
@@ -83,7 +90,7 @@ class DisplayLine:
 
         pts = self.generateCirclePolyLines(self._center, self._radius, self._begin_angle, self._end_angle,
                                            noise=noise_modifier * self._noise)
-        if self._mask and not disable_mask:
+        if len(self._mask) and not disable_mask:
             masked_array = self._maskArray(pts, self._mask_array)
             segments = np.ma.clump_unmasked(masked_array)
             # We need to flatten the array, because clump_unmask doesn't work on anything but 1d arrays.
@@ -114,76 +121,108 @@ class DisplayLine:
         return image
 
     @staticmethod
-    def _angleClamp(angle):
-        while angle < 0:
-            angle += 360
-        while angle > 360:
-            angle -= 360
-        return angle
+    def _angleClamp(angles):
+        """
+        Wrap the angle(s) into the [0, 360] range. Positive multiples of 360 end up at 360, not 0.
+        """
+        angles = np.asarray(angles, dtype=float)
+        clamped = np.mod(angles, 360)
+        return np.where((clamped == 0) & (angles > 0), 360, clamped)
 
     def _generateMask(self) -> np.ndarray:
         """
-        Converts angle & widths into array of indexes to be masked
-        :param masks:
+        Converts angle & widths into array of indexes to be masked. Each call jitters the width of every mask entry
+        a bit (see _angle_noise), which is what makes the gaps in the line "breathe".
         :return: The indexes to be masked
         """
-        pts = np.arange(self._num_segments)
-        mask = np.empty(self._num_segments, dtype = bool)
-        mask.fill(False)
+        num_segments = self._num_segments
+        if not len(self._mask):
+            return np.empty(0, dtype=int)
+
         # Calculate on what segment the masks needs to be!
         total_angle_range = abs(self._begin_angle - self._end_angle)
-        angle_per_segment = self._num_segments / total_angle_range
+        angle_per_segment = num_segments / total_angle_range
+        mask_angles, mask_widths = self._mask[:, 0], self._mask[:, 1]
         absolute_begin_angle = self._angleClamp(self._begin_angle)
-        for mask_angle, mask_width in self._mask:
-            angle_difference = self._angleClamp(mask_angle - absolute_begin_angle)
-            segments_difference = angle_difference * angle_per_segment
-
-            segments_width_begin = int((mask_width + self._angle_noise * (random.random() - 0.5)) * angle_per_segment)
-            segments_width_end = int((mask_width + self._angle_noise * (random.random() - 0.5)) * angle_per_segment)
-            start = int(segments_difference - segments_width_begin / 2)
-            end = int(segments_difference + segments_width_end / 2)
-
-            # We need to do it like this to ensure that wrapping (eg; setting angle of 0) will work.
-            if start < 0:
-                mask[:end] = True
-                mask[start:] = True
-            else:
-                mask[start: end] = True
-        return pts[mask]
+        segments_difference = self._angleClamp(mask_angles - absolute_begin_angle) * angle_per_segment
+
+        # Jitter for the begin and end of every mask entry at once.
+        jitter = self._angle_noise * (np.random.random((len(self._mask), 2)) - 0.5)
+        segments_width = ((mask_widths[:, np.newaxis] + jitter) * angle_per_segment).astype(int)
+        starts = (segments_difference - segments_width[:, 0] / 2).astype(int)
+        ends = (segments_difference + segments_width[:, 1] / 2).astype(int)
+
+        # A negative start means the mask wraps around (eg; setting angle of 0), so it covers [start:] and [:end].
+        # Everything is translated into half open intervals, which then get written with a difference array.
+        wrapped = starts < 0
+        interval_begins = np.concatenate((np.where(wrapped, 0, starts), starts[wrapped]))
+        interval_ends = np.concatenate((ends, np.full(np.count_nonzero(wrapped), num_segments)))
+        interval_begins = self._toSliceIndex(interval_begins, num_segments)
+        interval_ends = self._toSliceIndex(interval_ends, num_segments)
+        valid = interval_ends > interval_begins
+
+        difference = np.bincount(interval_begins[valid], minlength=num_segments + 1) - \
+                     np.bincount(interval_ends[valid], minlength=num_segments + 1)
+        mask = np.cumsum(difference[:num_segments]) > 0
+        return np.flatnonzero(mask)
+
+    @staticmethod
+    def _toSliceIndex(indices: np.ndarray, length: int) -> np.ndarray:
+        """
+        Resolve indices the same way python slicing would (negative counts from the end, clipped to the length)
+        """
+        return np.clip(np.where(indices < 0, indices + length, indices), 0, length)
 
     @cache
     def generateModifiedRadius(self, radius: int) -> np.ndarray:
-        pts = np.empty(self._num_segments)
-        pts.fill(radius)
+        return self.calculateRadiusProfile(self._spikes, radius, self._num_segments, self._begin_angle,
+                                           self._end_angle, self._smoothing_window)
 
-        # Calculate on what segment the spike needs to be!
-        total_angle_range = abs(self._begin_angle - self._end_angle)
-        angle_per_segment = self._num_segments / total_angle_range
+    @staticmethod
+    @cache
+    def calculateRadiusProfile(spikes: Tuple[Spike, ...], radius: int, num_segments: int, begin_angle: int,
+                               end_angle: int, kern_size: int = 11) -> np.ndarray:
+        """
+        Calculate the (smoothed) radius of every segment of the line, with all the spikes applied.
+        Every spike is a triangular window that multiplies the radius. The windows of all spikes are evaluated at once
+        as a (num_spikes, num_segments) table and combined with a product, so no python looping is needed.
 
-        for spike_angle, spike_width, intensity in self._spikes:
+        The result is shared between all lines with the same settings, so it's returned as a read-only array.
+        """
+        pts = np.full(num_segments, radius, dtype=float)
+
+        if spikes:
+            # Calculate on what segment the spike needs to be!
+            total_angle_range = abs(begin_angle - end_angle)
+            angle_per_segment = num_segments / total_angle_range
+
+            spike_angles, spike_widths, intensities = np.array(spikes, dtype=float).T
             # TODO: Not sure if this is correct. If you see issues here, check fix for mask
-            angle_difference = abs(self._begin_angle - spike_angle)
-            segments_difference = angle_difference * angle_per_segment
-            segments_width = int(spike_width * angle_per_segment)
-
-            segments = np.arange(segments_width)
-            segments = numpy.append(segments, numpy.flipud(segments))
-            segments = (segments / (segments_width - 1)) * intensity + 1
-            window = pts[int(segments_difference - segments_width):int(segments_difference + segments_width)]
-            window = numpy.multiply(window, segments)
-            pts[int(segments_difference - segments_width):int(segments_difference + segments_width)] = window
-
-        kern_size = 11
+            segments_difference = np.abs(begin_angle - spike_angles) * angle_per_segment
+            segments_width = (spike_widths * angle_per_segment).astype(int)[:, np.newaxis]
+            window_start = (segments_difference - segments_width[:, 0]).astype(int)[:, np.newaxis]
+
+            # Position of each segment inside the window of each spike. The window is 2 * width long and ramps up
+            # linearly (0 .. width - 1) and then back down again.
+            offsets = np.arange(num_segments)[np.newaxis, :] - window_start
+            in_window = (offsets >= 0) & (offsets < 2 * segments_width)
+            ramp = np.where(offsets < segments_width, offsets, 2 * segments_width - 1 - offsets)
+            windows = ramp / np.maximum(segments_width - 1, 1) * intensities[:, np.newaxis] + 1
+            pts *= np.prod(np.where(in_window, windows, 1), axis=0)
+
         cutoff_size = int((kern_size - 1) / 2)
 
-        pts = self.smooth(pts, kern_size)
-        pts = self.smooth(pts[cutoff_size:-cutoff_size], kern_size)
-        return pts[cutoff_size:-cutoff_size]
+        pts = DisplayLine.smooth(pts, kern_size)
+        pts = DisplayLine.smooth(pts[cutoff_size:-cutoff_size], kern_size)
+        pts = pts[cutoff_size:-cutoff_size]
+        pts.flags.writeable = False
+        return pts
 
     @staticmethod
-    def _calculateNumSegments(radius: int, end_angle: int, begin_angle: int) -> int:
+    def _calculateNumSegments(radius: int, end_angle: int, begin_angle: int,
+                              segments_per_length: float = NUM_SEGMENTS_PER_LENGTH) -> int:
         circle_length = (2 * np.pi * radius) * ((end_angle - begin_angle) / 360)
-        return abs(int(circle_length * NUM_SEGMENTS_PER_LENGTH))
+        return abs(int(circle_length * segments_per_length))
 
     @staticmethod
     def smooth(x, window_len=11, window='blackman'):
@@ -231,13 +270,22 @@ class DisplayLine:
             raise ValueError
 
         s = numpy.r_[x[window_len - 1:0:-1], x, x[-2:-window_len - 1:-1]]
+        y = numpy.convolve(DisplayLine._getSmoothingKernel(window_len, window), s, mode='valid')
+        return y
+
+    @staticmethod
+    @cache
+    def _getSmoothingKernel(window_len: int, window: str) -> np.ndarray:
+        """
+        Get the normalized kernel used by smooth. This only depends on the settings, so it's only created once.
+        """
         if window == 'flat':  # moving average
             w = numpy.ones(window_len, 'd')
         else:
-            w = eval('numpy.' + window + '(window_len)')
-
-        y = numpy.convolve(w / w.sum(), s, mode='valid')
-        return y
+            w = getattr(numpy, window)(window_len)
+        kernel = w / w.sum()
+        kernel.flags.writeable = False
+        return kernel
 
     def generateCirclePolyLines(self, center: Point, radius: int, begin_angle: int = 0, end_angle: int = 90, *,
                                 noise: float = 0.1):
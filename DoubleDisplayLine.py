@@ -27,7 +27,7 @@ class DoubleDisplayLine(DisplayLine):
             # Re-create the mask if you want noise on the angle, otherwise just keep the default
             self._mask_array = self._generateMask()
 
-        if self._mask and not disable_mask:
+        if len(self._mask) and not disable_mask:
             masked_bottom_array = self._maskArray(pts_bottom, self._mask_array)
             masked_top_array = self._maskArray(pts_top, self._mask_array)
 
@@ -16,6 +16,9 @@ class Fader:
     def isFading(self):
         return self._fading is not None
 
+    def isFadingIn(self):
+        return self._fading == "in"
+
     def fadeOut(self):
         self._fading = "out"
 
@@ -0,0 +1,143 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Upper bounds (in ms) of the histogram buckets. Anything slower ends up in the last (overflow) bucket.
+DEFAULT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+NUM_RECENT_SAMPLES = 1000  # Samples kept per histogram to calculate the percentiles with
+
+
+class LatencyHistogram:
+    def __init__(self, buckets_ms: Tuple[float, ...] = DEFAULT_BUCKETS_MS) -> None:
+        self._buckets_ms = buckets_ms
+        self._counts = [0] * (len(buckets_ms) + 1)
+        self._recent: Deque[float] = deque(maxlen=NUM_RECENT_SAMPLES)
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def add(self, duration_ms: float) -> None:
+        self._counts[bisect_left(self._buckets_ms, duration_ms)] += 1
+        self._recent.append(duration_ms)
+        self._count += 1
+        self._total += duration_ms
+        self._max = max(self._max, duration_ms)
+
+    def getPercentile(self, percentile: float) -> Optional[float]:
+        if not self._recent:
+            return None
+        ordered = sorted(self._recent)
+        return ordered[min(int(len(ordered) * percentile / 100), len(ordered) - 1)]
+
+    def toDict(self) -> Dict:
+        labels = [f"<={bound}" for bound in self._buckets_ms] + [f">{self._buckets_ms[-1]}"]
+        return {"count": self._count,
+                "mean_ms": self._total / self._count if self._count else None,
+                "max_ms": self._max if self._count else None,
+                "p50_ms": self.getPercentile(50),
+                "p90_ms": self.getPercentile(90),
+                "p99_ms": self.getPercentile(99),
+                "buckets_ms": dict(zip(labels, self._counts))}
+
+
+class LatencyTracer:
+    """
+    Traces how long it takes for an event (eg; a tag being read) to travel through a number of stages. Every stage
+    gets a histogram of the time since the previous stage of the same trace, and "total" has the time from the start
+    to the end of the trace. All timestamps are from time.monotonic().
+
+    Traces can be started, marked and finished from different threads.
+    """
+    def __init__(self, log_summary_every: int = 10) -> None:
+        self._lock = threading.Lock()
+        self._traces: Dict[int, Tuple[float, float]] = {}  # trace id -> (start time, time of the last mark)
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._stage_order: List[str] = []
+        self._next_trace_id = 0
+        self._num_finished = 0
+        self._num_discarded = 0
+        self._log_summary_every = log_summary_every
+
+    def startTrace(self, timestamp: Optional[float] = None) -> int:
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self._lock:
+            trace_id = self._next_trace_id
+            self._next_trace_id += 1
+            self._traces[trace_id] = (timestamp, timestamp)
+        return trace_id
+
+    def mark(self, trace_id: Optional[int], stage: str) -> None:
+        """
+        Record that the trace reached the given stage. Unknown (eg; already finished) traces are ignored.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if trace_id not in self._traces:
+                return
+            start, previous = self._traces[trace_id]
+            self._getHistogram(stage).add((now - previous) * 1000)
+            self._traces[trace_id] = (start, now)
+
+    def finishTrace(self, trace_id: Optional[int], stage: str) -> None:
+        self.mark(trace_id, stage)
+        with self._lock:
+            if trace_id not in self._traces:
+                return
+            start, end = self._traces.pop(trace_id)
+            total_ms = (end - start) * 1000
+            self._getHistogram("total").add(total_ms)
+            self._num_finished += 1
+            should_log_summary = self._log_summary_every and self._num_finished % self._log_summary_every == 0
+        logging.debug(f"Trace {trace_id} took {total_ms:.1f} ms")
+        if should_log_summary:
+            self.logSummary()
+
+    def addSample(self, stage: str, duration_ms: float) -> None:
+        """
+        Add a duration to the histogram of a stage directly, for things that are not part of a trace
+        """
+        with self._lock:
+            self._getHistogram(stage).add(duration_ms)
+
+    def discardTrace(self, trace_id: Optional[int]) -> None:
+        """
+        Stop tracking a trace that will never finish (eg; because a newer event replaced it)
+        """
+        with self._lock:
+            if self._traces.pop(trace_id, None) is not None:
+                self._num_discarded += 1
+
+    def _getHistogram(self, stage: str) -> LatencyHistogram:
+        if stage not in self._histograms:
+            self._histograms[stage] = LatencyHistogram()
+            if stage != "total":
+                self._stage_order.append(stage)
+        return self._histograms[stage]
+
+    def toDict(self) -> Dict:
+        with self._lock:
+            stages = {stage: self._histograms[stage].toDict() for stage in self._stage_order}
+            total = self._histograms["total"].toDict() if "total" in self._histograms else None
+            return {"finished": self._num_finished,
+                    "discarded": self._num_discarded,
+                    "in_progress": len(self._traces),
+                    "stages": stages,
+                    "total": total}
+
+    def logSummary(self) -> None:
+        summary = self.toDict()
+        logging.info(f"Latency over {summary['finished']} traces ({summary['discarded']} discarded):")
+        for stage, histogram in list(summary["stages"].items()) + [("total", summary["total"])]:
+            if histogram is None or not histogram["count"]:
+                continue
+            logging.info(f"  {stage:>12}: p50 {histogram['p50_ms']:.1f} ms, p90 {histogram['p90_ms']:.1f} ms, "
+                         f"p99 {histogram['p99_ms']:.1f} ms, max {histogram['max_ms']:.1f} ms")
+
+    def dumpJson(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.toDict(), f, indent=2)
@@ -1,7 +1,15 @@
 import random
+from functools import partial
+from typing import Callable
 
+import numpy as np
+
+from PatternTable import PatternTable
 from sql_app.schemas import Action
 
+# Lookup from (lowercase) action to the index of the mask in the pattern table
+ACTION_INDICES = {action.value.lower(): index for index, action in enumerate(Action)}
+
 
 class MaskGenerator:
 
@@ -12,147 +20,27 @@ class MaskGenerator:
         return MaskGenerator.getMaskFunctionByAction(action)
 
     @staticmethod
-    def generateAngles(spacing, angle_width, start_angle=0, end_angle=360, shift=0):
-        angle_to_add = start_angle + 0.5 * angle_width
-        result = []
-        while angle_to_add < end_angle + 0.5 * angle_width:
-            result.append((angle_to_add, angle_width))
-            angle_to_add += spacing
-        return result
-
-    @staticmethod
-    def generateMask1(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(30, 10, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(15, 5, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(60, 20, start_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask2(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(15, 5, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(16, 10, start_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask3(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(15, 5, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(16, 5, start_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask4(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(30, 5, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(30, 5, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(40, 5, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(50, 5, start_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask5(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(20, 10, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(30, 15, start_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask6(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(60, 10, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(70, 10, start_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask7(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(15, 2, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(20, 3, start_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask8(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(15, 2, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(20, 3, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(25, 3, start_angle, end_angle))
-        return result
+    def generateMask(action_index: int, start_angle, end_angle) -> np.ndarray:
+        """
+        Generate the mask for an action (by index in the Action enum). Every row of the definition produces evenly
+        spaced mask entries over its range; all rows are evaluated at once.
+        :return: Array of shape (N, 2) with the (angle, width) of each mask entry.
+        """
+        definition = PatternTable.getDefault().getMaskDefinition(action_index)
+        spacing, width = definition[:, 0], definition[:, 1]
+        angle_span = abs(end_angle - start_angle)
+        anchors = np.array([start_angle, end_angle], dtype=float)
+        range_start = anchors[definition[:, 2].astype(int)] + definition[:, 3] * angle_span + definition[:, 4]
+        range_end = anchors[definition[:, 5].astype(int)] + definition[:, 6] * angle_span + definition[:, 7]
 
-    @staticmethod
-    def generateMask9(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(30, 10, start_angle + 10, end_angle))
-        result.extend(MaskGenerator.generateAngles(60, 15, start_angle + 20, end_angle))
-        result.extend(MaskGenerator.generateAngles(15, 2, start_angle + 10, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask10(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(10, 5, start_angle, start_angle + 60 + 5))
-        result.extend(MaskGenerator.generateAngles(20, 10, start_angle + 60, end_angle - 60))
-        result.extend(MaskGenerator.generateAngles(10, 5, end_angle - 60, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask11(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(20, 10, start_angle, start_angle + 60 + 5))
-        result.extend(MaskGenerator.generateAngles(10, 5, start_angle + 60, end_angle - 60))
-        result.extend(MaskGenerator.generateAngles(20, 10, end_angle - 60, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask12(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(15, 10, start_angle, start_angle + 60 + 5))
-        result.extend(MaskGenerator.generateAngles(8, 5, start_angle + 60, end_angle - 60))
-        result.extend(MaskGenerator.generateAngles(15, 10, end_angle - 60, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask13(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(8, 5, start_angle, start_angle + 60 + 5))
-        result.extend(MaskGenerator.generateAngles(15, 10, start_angle + 60, end_angle - 60))
-        result.extend(MaskGenerator.generateAngles(8, 5, end_angle - 60, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask14(start_angle, end_angle):
-        result = []
-        half_angle = abs(end_angle - start_angle) / 2
-        result.extend(MaskGenerator.generateAngles(12, 6, start_angle, start_angle + half_angle))
-        result.extend(MaskGenerator.generateAngles(22, 11, start_angle + half_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask15(start_angle, end_angle):
-        result = []
-        half_angle = abs(end_angle - start_angle) / 2
-        result.extend(MaskGenerator.generateAngles(22, 11, start_angle, start_angle + half_angle))
-        result.extend(MaskGenerator.generateAngles(12, 6, start_angle + half_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask16(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(4, 2, start_angle, end_angle))
-        return result
-
-    @staticmethod
-    def generateMask17(start_angle, end_angle):
-        result = []
-        result.extend(MaskGenerator.generateAngles(8, 4, start_angle, end_angle))
-        result.extend(MaskGenerator.generateAngles(4, 2, start_angle, end_angle))
-        return result
+        counts = np.maximum(np.ceil((range_end - range_start) / spacing), 0).astype(int)
+        rows = np.repeat(np.arange(len(definition)), counts)
+        steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        angles = range_start[rows] + 0.5 * width[rows] + steps * spacing[rows]
+        return np.column_stack((angles, width[rows]))
 
     @staticmethod
-    def getMaskFunctionByAction(action):
+    def getMaskFunctionByAction(action) -> Callable[[float, float], np.ndarray]:
         if action == "random":
             return MaskGenerator.getRandomMaskFunction()
-        action_list = list(Action)
-        result = getattr(MaskGenerator, f"generateMask{action_list.index(action.title()) + 1}")
-        return result
\ No newline at end of file
+        return partial(MaskGenerator.generateMask, ACTION_INDICES[action.lower()])
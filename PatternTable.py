@@ -0,0 +1,135 @@
+import json
+import os
+from fractions import Fraction
+from functools import cache
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from sql_app.schemas import Action, Target
+
+DEFAULT_PATTERN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "patterns.json")
+
+# Column layout of the compiled tables. Positions (angles) are stored as anchor (0 = start angle, 1 = end angle),
+# fraction of the total angle span and a fixed offset in degrees.
+MASK_COLUMNS = ("spacing", "width", "from_anchor", "from_span", "from_offset", "to_anchor", "to_span", "to_offset")
+SPIKE_COLUMNS = ("angle_anchor", "angle_span", "angle_offset", "width_span", "width_offset", "intensity")
+
+ANCHORS = {"start": 0, "end": 1}
+
+
+class PatternTable:
+    """
+    The masks (one per action) and spikes (one per target) that make up a pattern. They are defined in a json file
+    and get compiled into numpy arrays, indexed by the ordinal of the Action / Target enum.
+
+    Angles in the definitions are relative to the arc the pattern is drawn on, eg; {"anchor": "end", "span": "-1/3"}
+    means one third of the arc before the end angle. Fractions can be written as strings ("1/3") or as numbers.
+    """
+    def __init__(self, masks: Tuple[np.ndarray, ...], spikes: Tuple[np.ndarray, ...]) -> None:
+        self._masks = masks
+        self._spikes = spikes
+
+    def getMaskDefinition(self, action_index: int) -> np.ndarray:
+        return self._masks[action_index]
+
+    def getSpikeDefinition(self, target_index: int) -> np.ndarray:
+        return self._spikes[target_index]
+
+    @staticmethod
+    @cache
+    def getDefault() -> "PatternTable":
+        """
+        The pattern table from the default pattern file. It's only loaded (and validated) once.
+        """
+        return PatternTable.load(DEFAULT_PATTERN_FILE)
+
+    @staticmethod
+    def load(path: str) -> "PatternTable":
+        with open(path) as f:
+            data = json.load(f)
+        return PatternTable.compile(data)
+
+    @staticmethod
+    def compile(data: Dict) -> "PatternTable":
+        """
+        Validate the pattern definitions and compile them into arrays
+        :raises ValueError: If the definitions are incomplete or invalid
+        """
+        unknown_keys = set(data) - {"masks", "spikes"}
+        if unknown_keys:
+            raise ValueError(f"Unknown pattern table keys: {sorted(unknown_keys)}")
+        masks = PatternTable._compileSection(data.get("masks", {}), Action, PatternTable._compileMaskEntry,
+                                             len(MASK_COLUMNS))
+        spikes = PatternTable._compileSection(data.get("spikes", {}), Target, PatternTable._compileSpikeEntry,
+                                              len(SPIKE_COLUMNS))
+        return PatternTable(masks, spikes)
+
+    @staticmethod
+    def _compileSection(section: Dict[str, List], enum_type, compile_entry,
+                        num_columns: int) -> Tuple[np.ndarray, ...]:
+        names = [member.value for member in enum_type]
+        missing = [name for name in names if name not in section]
+        if missing:
+            raise ValueError(f"No pattern defined for {enum_type.__name__} {missing}")
+        unknown = [name for name in section if name not in names]
+        if unknown:
+            raise ValueError(f"Patterns defined for unknown {enum_type.__name__} {unknown}")
+
+        result = []
+        for name in names:
+            try:
+                rows = [compile_entry(entry) for entry in section[name]]
+            except (KeyError, TypeError, ValueError, ZeroDivisionError) as e:
+                raise ValueError(f"Invalid pattern for {name}: {e}") from e
+            compiled = np.array(rows, dtype=float).reshape(-1, num_columns)
+            compiled.flags.writeable = False
+            result.append(compiled)
+        return tuple(result)
+
+    @staticmethod
+    def _compileMaskEntry(entry: Dict) -> List[float]:
+        PatternTable._checkKeys(entry, {"spacing", "width", "from", "to"})
+        spacing = PatternTable._toFloat(entry["spacing"])
+        width = PatternTable._toFloat(entry["width"])
+        if spacing <= 0:
+            raise ValueError(f"Spacing must be positive, got {spacing}")
+        if width < 0:
+            raise ValueError(f"Width can't be negative, got {width}")
+        return [spacing, width,
+                *PatternTable._compilePosition(entry.get("from", {"anchor": "start"})),
+                *PatternTable._compilePosition(entry.get("to", {"anchor": "end"}))]
+
+    @staticmethod
+    def _compileSpikeEntry(entry: Dict) -> List[float]:
+        PatternTable._checkKeys(entry, {"angle", "width", "intensity"})
+        width = entry["width"]
+        if isinstance(width, dict):
+            PatternTable._checkKeys(width, {"span", "offset"})
+            width_span = PatternTable._toFloat(width.get("span", 0))
+            width_offset = PatternTable._toFloat(width.get("offset", 0))
+        else:
+            width_span, width_offset = 0.0, PatternTable._toFloat(width)
+        return [*PatternTable._compilePosition(entry["angle"]), width_span, width_offset,
+                PatternTable._toFloat(entry["intensity"])]
+
+    @staticmethod
+    def _compilePosition(position: Dict) -> List[float]:
+        PatternTable._checkKeys(position, {"anchor", "span", "offset"})
+        anchor = position.get("anchor", "start")
+        if anchor not in ANCHORS:
+            raise ValueError(f"Anchor must be one of {list(ANCHORS)}, got {anchor}")
+        return [ANCHORS[anchor], PatternTable._toFloat(position.get("span", 0)),
+                PatternTable._toFloat(position.get("offset", 0))]
+
+    @staticmethod
+    def _checkKeys(entry: Dict, allowed: set) -> None:
+        unknown = set(entry) - allowed
+        if unknown:
+            raise ValueError(f"Unknown keys {sorted(unknown)}")
+
+    @staticmethod
+    def _toFloat(value: Union[str, int, float]) -> float:
+        if isinstance(value, bool):
+            raise ValueError(f"Expected a number, got {value}")
+        return float(Fraction(value))
@@ -1,79 +1,273 @@
-from typing import List, Callable
+from collections import deque
+from concurrent.futures import Future
+from typing import List, Callable, Deque, Optional
 
 import serial
 import logging
+import random
+import selectors
+import socket
 import threading
 import time
 
+from ReaderCommand import ReaderCommand
+from SerialPortDiscovery import SerialPortDiscovery
+from TraitsCache import TraitsCache
+
+# Reconnecting uses exponential backoff (with jitter), so a short hiccup recovers quickly without hammering the ports
+# when the reader is really gone.
+MIN_RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+
+# How many commands can be waiting for a response at the same time. The reader handles them in order.
+MAX_COMMANDS_IN_FLIGHT = 4
+
 
 class RFIDController:
     def __init__(self,
-                 on_card_detected_callback: Callable[[str], None],
-                 on_card_lost_callback: Callable[[str], None],
-                 traits_detected_callback: Callable[[List[str]], None],
-                 baud_rate = 115200):
-        # Handle listening to serial.
-        self._serial_send_thread = threading.Thread(target=self._handleSerialSend, daemon=True)
-        self._serial_listen_thread = threading.Thread(target=self._handleSerialListen, daemon=True)
-
+                 on_card_detected_callback: Callable[[str, float], None],
+                 on_card_lost_callback: Callable[[str, float], None],
+                 traits_detected_callback: Callable[[List[str], float], None],
+                 baud_rate = 115200,
+                 ports: Optional[List[str]] = None,
+                 traits_cache: Optional[TraitsCache] = None):
+        """
+        All callbacks are called from the reactor thread. Their last argument is the time (time.monotonic()) at which
+        the line that caused the event was received from the reader.
+        :param ports: Only try these serial ports, instead of looking for the reader on the usual USB serial devices
+                      (eg; to use the pty of a SimulatedRFIDReader)
+        :param traits_cache: Cache of the traits of known cards. When a known card is read with invalid traits, the
+                             cached ones are reported right away, while the reader is asked to read them again.
+        """
         self._baud_rate = baud_rate
-        self._serial = None
+        self._serial: Optional[serial.Serial] = None
         self._on_card_detected_callback = on_card_detected_callback
         self._on_card_lost_callback = on_card_lost_callback
         self._traits_detected_callback = traits_detected_callback
         self._detected_card = None
-        self._recreate_serial_timer = None
-        self._serial_recreate_time = 5
-        self._request_trait_info = False  # Should we re-request trait info?
+        if ports:
+            self._port_discovery = SerialPortDiscovery(baud_rate, extra_ports=ports, port_patterns=())
+        else:
+            self._port_discovery = SerialPortDiscovery(baud_rate)
+        self._reconnect_attempts = 0
+        self._traits_cache = traits_cache
+        self._cached_traits_reported: Optional[List[str]] = None  # Reported for the current card, not verified yet
+
+        # All serial I/O is done by a single reactor thread. It waits on the serial port and on a wakeup socket, which
+        # other threads poke when they queue a command, so nothing has to poll.
+        self._reactor_thread: Optional[threading.Thread] = None
+        self._running = False
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup_receiver, selectors.EVENT_READ)
+        self._registered_events = 0  # What we are currently waiting for on the serial port
+
+        self._command_queue: Deque[ReaderCommand] = deque()  # Commands waiting to be handed to the reactor
+        # Held while checking the connection and queueing a command, and while the connection is replaced. Otherwise a
+        # command could be queued just after the queue was cleared, and nobody would ever resolve it.
+        self._command_lock = threading.Lock()
+        self._in_flight: List[ReaderCommand] = []  # Commands that were sent and wait for a response, oldest first
+        self._write_buffer = b""
+        self._read_buffer = b""
+        self._reconnect_at = 0.0  # Monotonic time at which we should try to (re)connect
 
     def getDetectedCard(self):
         return self._detected_card
 
     def start(self) -> None:
-        # TODO: Should probably handle starting it multiple times?
-        self._createSerial()
+        if self._running:
+            return
+        self._running = True
+        self._reactor_thread = threading.Thread(target=self._runReactor, daemon=True, name="RFIDReactor")
+        self._reactor_thread.start()
 
     def stop(self):
-        self._serial = None
-        if self._recreate_serial_timer:
-            self._recreate_serial_timer.cancel()
+        self._running = False
+        self._wakeUp()
+        if self._reactor_thread is not None and self._reactor_thread is not threading.current_thread():
+            self._reactor_thread.join(timeout=1)
+        self._reactor_thread = None
+
+    def _wakeUp(self) -> None:
+        try:
+            self._wakeup_sender.send(b"\0")
+        except (BlockingIOError, OSError):
+            # The socket buffer is full, so the reactor has plenty of wakeups pending already.
+            pass
+
+    def sendCommand(self, command: str, response_prefix: Optional[str] = None, timeout: float = 0.5,
+                    retries: int = 2) -> Future:
+        """
+        Send a command to the reader. This can be called from any thread; the reactor writes it as soon as the port is
+        writable. Multiple commands can be sent without waiting for the responses, which are matched to the commands
+        in the order they were sent.
+        :param response_prefix: How the response line starts. If None, no response is expected.
+        :param timeout: Seconds to wait for a response before sending the command again
+        :param retries: How often to send the command again before giving up
+        :return: Future with the response (without the prefix). Note that its callbacks are run on the reactor thread.
+        """
+        reader_command = ReaderCommand(command, response_prefix, timeout, retries)
+        self._queueCommand(reader_command)
+        return reader_command.future
+
+    def _queueCommand(self, command: ReaderCommand) -> None:
+        # TODO: add command validity checking.
+        with self._command_lock:
+            queued = self._serial is not None
+            if queued:
+                self._command_queue.append(command)
+        if queued:
+            self._wakeUp()
+        else:
+            logging.error("Unable to write command %s without serial connection" % command.command)
+            command.future.set_exception(serial.SerialException("No serial connection"))
 
     def _recreateSerial(self):
         logging.warning("Previously working serial has stopped working, try to re-create!")
-        self._serial = None
-        # Try to re-create it after a few seconds
-        self._recreate_serial_timer = threading.Timer(self._serial_recreate_time, self._createSerial)
-        self._recreate_serial_timer.start()
+        self._closeSerial()
+        self._scheduleReconnect()
 
-    def _sendCommand(self, command=""):
-        # TODO: add command validity checking.
-        if self._serial:
-            self._serial.write(b"\n")
-            command += "\n"
-            self._serial.write(command.encode('utf-8'))
+    def _scheduleReconnect(self) -> None:
+        delay = min(MIN_RECONNECT_DELAY * 2 ** self._reconnect_attempts, MAX_RECONNECT_DELAY)
+        delay *= random.uniform(0.5, 1.0)
+        self._reconnect_attempts += 1
+        self._reconnect_at = time.monotonic() + delay
+
+    def _closeSerial(self) -> None:
+        if self._serial is None:
+            return
+        if self._registered_events:
+            self._selector.unregister(self._serial)
+            self._registered_events = 0
+        try:
+            self._serial.close()
+        except Exception:
+            pass
+        with self._command_lock:
+            self._serial = None
+            queued_commands = list(self._command_queue)
+            self._command_queue.clear()
+        self._read_buffer = b""
+        self._write_buffer = b""
+        # Whatever was sent is lost, and the reader might be another one once we reconnect. The futures are failed
+        # without holding the lock, as their callbacks may send commands again.
+        failed_commands = self._in_flight + queued_commands
+        self._in_flight = []
+        for command in failed_commands:
+            if not command.future.done():
+                command.future.set_exception(serial.SerialException("Serial connection was lost"))
+
+    def _runReactor(self) -> None:
+        logging.info("Starting RFID reactor thread")
+        while self._running:
+            if self._serial is None and time.monotonic() >= self._reconnect_at:
+                self._createSerial()
+
+            if self._serial is not None:
+                self._expireCommands()
+                self._updateRegistration()
+                timeout = self._getCommandTimeout()
+            else:
+                timeout = max(self._reconnect_at - time.monotonic(), 0)
+
+            for key, events in self._selector.select(timeout):
+                if key.fileobj is self._wakeup_receiver:
+                    self._drainWakeups()
+                    continue
+                try:
+                    if events & selectors.EVENT_READ:
+                        self._handleSerialReadable()
+                    if events & selectors.EVENT_WRITE and self._serial is not None:
+                        self._handleSerialWritable()
+                except (serial.SerialException, OSError):
+                    self._recreateSerial()
+        self._closeSerial()
+
+    def _drainWakeups(self) -> None:
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _updateRegistration(self) -> None:
+        while self._command_queue and len(self._in_flight) < MAX_COMMANDS_IN_FLIGHT:
+            command = self._command_queue.popleft()
+            if command.future.set_running_or_notify_cancel():
+                self._writeCommand(command)
+
+        # Only ask to be woken up for writing if there actually is something to write, else select spins.
+        events = selectors.EVENT_READ
+        if self._write_buffer:
+            events |= selectors.EVENT_WRITE
+        if events == self._registered_events:
+            return
+        if self._registered_events:
+            self._selector.modify(self._serial, events)
         else:
-            logging.error("Unable to write command %s without serial connection" % command)
-
-    def _handleSerialSend(self):
-        logging.info("Starting serial send thread")
-
-        while self._serial is not None:
-            try:
-                if self._request_trait_info:
-                    self._sendCommand("READ ALL")
-                    self._request_trait_info = False
-                # It no like spinlocking :(
-                time.sleep(0.1)
-            except serial.SerialException:
-                self._recreateSerial()
-            except Exception as e:
-                logging.error(f"Serial broke with exception of type {type(e)}: {e}")
-                time.sleep(0.1)  # Prevent error spam.
+            self._selector.register(self._serial, events)
+        self._registered_events = events
+
+    def _writeCommand(self, command: ReaderCommand) -> None:
+        self._write_buffer += command.encode()
+        if command.expectsResponse():
+            command.deadline = time.monotonic() + command.timeout
+            self._in_flight.append(command)
+        else:
+            command.future.set_result(None)
+
+    def _expireCommands(self) -> None:
+        now = time.monotonic()
+        for command in [command for command in self._in_flight if command.deadline <= now]:
+            self._in_flight.remove(command)
+            if command.retries_left > 0:
+                command.retries_left -= 1
+                logging.warning(f"No response to {command.command}, sending it again")
+                self._writeCommand(command)
+            else:
+                command.future.set_exception(TimeoutError(f"No response to {command.command}"))
+
+    def _getCommandTimeout(self) -> Optional[float]:
+        # Wait until the first command times out, or indefinitely if we're not waiting on anything.
+        if not self._in_flight:
+            return None
+        return max(min(command.deadline for command in self._in_flight) - time.monotonic(), 0)
+
+    def _matchResponse(self, line: str, received_at: float) -> bool:
+        """
+        Resolve the oldest command that is waiting for this line
+        :return: If the line was a response to a command
+        """
+        for command in self._in_flight:
+            if command.matches(line):
+                self._in_flight.remove(command)
+                command.responded_at = received_at
+                command.future.set_result(line[len(command.response_prefix):])
+                return True
+        return False
+
+    def _handleSerialReadable(self) -> None:
+        data = self._serial.read(self._serial.in_waiting or 1)
+        if data:
+            self._handleReceived(data, time.monotonic())
+
+    def _handleReceived(self, data: bytes, received_at: float) -> None:
+        self._read_buffer += data
+        *lines, self._read_buffer = self._read_buffer.split(b"\n")
+        for line in lines:
+            self._handleLine(line, received_at)
+
+    def _handleSerialWritable(self) -> None:
+        written = self._serial.write(self._write_buffer)
+        self._write_buffer = self._write_buffer[written or 0:]
 
     def _validateCardTraits(self, arguments: List[str]) -> bool:
         logging.info(f"Checking reader response {arguments}")
-        if arguments[0] != "RAW" and arguments[0] != "REFINED":
-            logging.warning(f"INVALID TYPE: {arguments[1]}")
+        # Only the id of the tag came through, the traits have to be read separately
+        if not arguments:
+            logging.warning("NO TRAITS")
             return False
 
         # If we get "EMPTY" it means that they just got a weird tag with no traits
@@ -82,6 +276,10 @@ class RFIDController:
             logging.warning(f"EMPTY TAG")
             return False
 
+        if arguments[0] != "RAW" and arguments[0] != "REFINED":
+            logging.warning(f"INVALID TYPE: {arguments[0]}")
+            return False
+
         # We send traits back in all caps, which serves as a rudimentary check
         # To see if the reading is correct
         if any(arg != arg.upper() for arg in arguments[1:]):
@@ -89,84 +287,89 @@ class RFIDController:
             return False
         return True
 
-    def _handleSerialListen(self):
-        logging.info("Starting serial listen thread")
-        while self._serial is not None:
-            try:
-                line = self._serial.readline()
-                line = line.rstrip()  # Strip newlines
-                line = line.decode("utf-8")
-                if line.startswith("Tag found:"):
-                    response = line.replace("Tag found: ", "")
-                    arguments = response.split(" ")
-                    card_id = arguments[0]
-                    self._detected_card = card_id
-                    self._on_card_detected_callback(card_id)
-                    if not self._validateCardTraits(arguments[1:]):
-                        # TODO: Send read all command!
-                        self._request_trait_info = True
-                    else:
-                        self._traits_detected_callback(arguments[1:])
-                elif line.startswith("Tag lost:"):
-                    card_id = line.replace("Tag lost: ", "")
-                    self._detected_card = None
-                    self._on_card_lost_callback(card_id)
-                elif line.startswith("Traits: "):
-                    response = line.replace("Traits: ", "")
-                    arguments = response.split(" ")
-                    if self._validateCardTraits(arguments):
-                        self._traits_detected_callback(arguments)
-                    else:
-                        logging.warning("READ ALL FAILED :(")
-
-            except serial.SerialException:
-                self._recreateSerial()
-            except Exception as e:
-                logging.error(f"Serial broke with exception of type {type(e)}: {e}")
-                time.sleep(0.1)  # Prevent error spam.
-
-    def _startSerialThread(self) -> None:
-        self._serial_listen_thread.start()
-        self._serial_send_thread.start()
-
-    def _createSerial(self) -> None:
-        logging.info("Attempting to create serial")
+    def _handleLine(self, line: bytes, received_at: float) -> None:
         try:
-            self._serial_listen_thread.join()  # Ensure that previous thread has closed
-            self._serial_listen_thread = threading.Thread(target=self._handleSerialListen, daemon=True)
-        except RuntimeError:
-            # If the thread hasn't started before it will cause a runtime. Ignore that.
-            pass
+            line = line.rstrip()  # Strip newlines
+            line = line.decode("utf-8")
+            if self._matchResponse(line, received_at):
+                return
+            if line.startswith("Tag found:"):
+                response = line.replace("Tag found: ", "")
+                arguments = response.split(" ")
+                card_id = arguments[0]
+                self._detected_card = card_id
+                self._cached_traits_reported = None
+                self._on_card_detected_callback(card_id, received_at)
+                if not self._validateCardTraits(arguments[1:]):
+                    # The traits that came with the tag are not usable, ask the reader to read them again.
+                    self._requestTraits(card_id)
+                    self._reportCachedTraits(card_id, received_at)
+                else:
+                    self._storeTraits(card_id, arguments[1:])
+                    self._traits_detected_callback(arguments[1:], received_at)
+            elif line.startswith("Tag lost:"):
+                card_id = line.replace("Tag lost: ", "")
+                self._detected_card = None
+                self._cached_traits_reported = None
+                self._on_card_lost_callback(card_id, received_at)
+            elif line.startswith("Traits: "):
+                # Traits we didn't ask for (eg; a response that arrived after we gave up on it)
+                self._handleTraits(line.replace("Traits: ", ""), received_at)
+        except Exception as e:
+            logging.error(f"Handling serial line failed with exception of type {type(e)}: {e}")
 
-        try:
-            self._serial_send_thread.join()
-            self._serial_send_thread = threading.Thread(target=self._handleSerialSend(), daemon=True)
-        except RuntimeError:
-            pass
+    def _requestTraits(self, card_id: str) -> None:
+        command = ReaderCommand("READ ALL", response_prefix="Traits: ")
 
-        for i in range(0, 10):
-            try:
-                port = f"/dev/ttyUSB{i}"
-                self._serial = serial.Serial(port, self._baud_rate, timeout=3)
-                logging.info(f"Connected with serial {port}")
-                break
-            except Exception:
-                pass
-            try:
-                port = f"/dev/ttyACM{i}"
-                self._serial = serial.Serial(port, self._baud_rate, timeout=3)
-                logging.info(f"Connected with serial {port}")
-                break
-            except Exception:
-                pass
+        def onTraitsRead(future: Future) -> None:
+            if future.cancelled() or card_id != self._detected_card:
+                # The card was swapped in the meantime, these traits are not relevant anymore.
+                return
+            if future.exception() is not None:
+                logging.warning(f"READ ALL for {card_id} failed: {future.exception()}")
+                return
+            self._handleTraits(future.result(), command.responded_at)
 
-        if self._serial is not None:
-            # Call later
-            threading.Timer(2, self._startSerialThread).start()
+        command.future.add_done_callback(onTraitsRead)
+        self._queueCommand(command)
+
+    def _handleTraits(self, response: str, received_at: float) -> None:
+        arguments = response.split(" ")
+        if self._validateCardTraits(arguments):
+            self._storeTraits(self._detected_card, arguments)
+            if arguments != self._cached_traits_reported:
+                # Only report them if they correct the cached traits we already reported (or if there were none)
+                self._traits_detected_callback(arguments, received_at)
+            self._cached_traits_reported = None
         else:
-            logging.warning("Unable to create serial. Attempting again in a few seconds.")
-            # Check again after a bit of time has passed
-            self._recreate_serial_timer = threading.Timer(self._serial_recreate_time, self._createSerial)
-            self._recreate_serial_timer.start()
+            logging.warning("READ ALL FAILED :(")
+
+    def _reportCachedTraits(self, card_id: str, received_at: float) -> None:
+        if self._traits_cache is None:
+            return
+        traits = self._traits_cache.get(card_id)
+        if traits is None:
+            return
+        logging.info(f"Using cached traits for {card_id} until the reader confirms them")
+        self._cached_traits_reported = traits
+        self._traits_detected_callback(traits, received_at)
+
+    def _storeTraits(self, card_id: Optional[str], traits: List[str]) -> None:
+        if self._traits_cache is None or card_id is None:
+            return
+        if self._traits_cache.put(card_id, traits):
+            logging.info(f"Updated cached traits of {card_id}")
 
+    def _createSerial(self) -> None:
+        logging.info("Attempting to create serial")
+        probed_port = self._port_discovery.findPort()
 
+        if probed_port is None:
+            logging.warning("Unable to create serial. Attempting again in a bit.")
+            self._scheduleReconnect()
+        else:
+            self._reconnect_attempts = 0
+            with self._command_lock:
+                self._serial = probed_port.connection
+            # Whatever was read while probing are real lines as well (eg; the card that is on it)
+            self._handleReceived(probed_port.received, time.monotonic())
@@ -0,0 +1,39 @@
+from concurrent.futures import Future
+from typing import Optional
+
+
+class ReaderCommand:
+    """
+    A command for the RFID reader, together with what its response looks like. The result of the future is the
+    response line without the prefix, or None for commands that don't get a response (as soon as it's handed to the
+    serial port). If the reader doesn't respond in time, the command is sent again; once it runs out of retries, the
+    future fails with a TimeoutError.
+    """
+    def __init__(self, command: str, response_prefix: Optional[str] = None, timeout: float = 0.5,
+                 retries: int = 2) -> None:
+        """
+        :param command: The command, without line endings
+        :param response_prefix: How the response line of the reader starts (eg; "Traits: ")
+        :param timeout: Seconds to wait for the response before sending the command again
+        :param retries: How often the command is sent again before giving up
+        """
+        self.command = command
+        self.response_prefix = response_prefix
+        self.timeout = timeout
+        self.retries_left = retries
+        self.future: Future = Future()
+        self.deadline: Optional[float] = None  # Monotonic time at which the response should have been received
+        self.responded_at: Optional[float] = None  # Monotonic time at which the response was received
+
+    def expectsResponse(self) -> bool:
+        return self.response_prefix is not None
+
+    def matches(self, line: str) -> bool:
+        return self.expectsResponse() and line.startswith(self.response_prefix)
+
+    def encode(self) -> bytes:
+        # The leading newline terminates any garbage the reader may have received before.
+        return b"\n" + (self.command + "\n").encode("utf-8")
+
+    def __repr__(self) -> str:
+        return f"ReaderCommand({self.command!r})"
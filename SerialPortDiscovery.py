@@ -0,0 +1,148 @@
+import glob
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import serial
+
+# Where the readers show up. The by-id links are stable over re-plugging, the tty names are not.
+DEFAULT_PORT_PATTERNS = ("/dev/serial/by-id/*", "/dev/ttyUSB*", "/dev/ttyACM*")
+
+# What the lines of the reader start with. A port that sends one of these is the reader for sure.
+READER_LINE_PREFIXES = (b"Tag found:", b"Tag lost:", b"Traits:")
+
+
+class ProbedPort(NamedTuple):
+    port: str
+    connection: serial.Serial
+    received: bytes  # What was read while probing, which should be handled like anything that is read later on
+    identified: bool  # If a line of the reader came in, rather than the port just opening
+
+
+class SerialPortDiscovery:
+    """
+    Finds the serial port of the RFID reader. All candidate ports are probed at the same time, and the port that
+    worked last time is preferred, so reconnecting after a USB hiccup is quick.
+
+    Ports are opened without raising DTR, as that resets the Arduino (which would then miss cards while it boots).
+    When there are several candidates, each is asked to READ ALL, and a port that answers with a line of the reader
+    (the response, or a tag that is found or lost) is picked over ports that only opened. A reader without a card on
+    it can't answer, so a port that opens but stays silent is still used if nothing better turns up.
+    """
+    def __init__(self, baud_rate: int, extra_ports: Optional[List[str]] = None,
+                 port_patterns: List[str] = DEFAULT_PORT_PATTERNS, identify_timeout: float = 0.3) -> None:
+        """
+        :param baud_rate: Baud rate to open the port with
+        :param extra_ports: Ports to try on top of the ones found with the patterns (eg; a pty of a fake reader)
+        :param port_patterns: Glob patterns of the device paths to try
+        :param identify_timeout: How long (in seconds) to wait for a line of the reader, when there are several ports
+        """
+        self._baud_rate = baud_rate
+        self._extra_ports = list(extra_ports or [])
+        self._port_patterns = port_patterns
+        self._identify_timeout = identify_timeout
+        self._last_good_port: Optional[str] = None
+
+    def getLastGoodPort(self) -> Optional[str]:
+        return self._last_good_port
+
+    def getCandidatePorts(self) -> List[str]:
+        """
+        All ports that could be the reader, in order of preference. Aliases of the same device (eg; a by-id link and
+        the ttyUSB it points to) are only listed once.
+        """
+        candidates = []
+        if self._last_good_port is not None:
+            candidates.append(self._last_good_port)
+        for pattern in self._port_patterns:
+            candidates.extend(sorted(glob.glob(pattern)))
+        candidates.extend(self._extra_ports)
+
+        result = []
+        seen_devices = set()
+        for port in candidates:
+            device = os.path.realpath(port)
+            if device in seen_devices:
+                continue
+            seen_devices.add(device)
+            result.append(port)
+        return result
+
+    def findPort(self) -> Optional[ProbedPort]:
+        """
+        Probe all candidate ports concurrently. With a single candidate, that's just opening it; with several, this
+        blocks for up to identify_timeout.
+        :return: The opened (non-blocking) port to use, or None if none of them could be opened. Ports that were
+                 identified as the reader go first, then the order of preference.
+        """
+        candidates = self.getCandidatePorts()
+        if not candidates:
+            return None
+
+        identify = len(candidates) > 1
+        executor = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="SerialProbe")
+        futures: Dict[str, Future] = {port: executor.submit(self._probe, port, identify) for port in candidates}
+        # Some slack on top of the time a probe takes, for opening the port
+        wait(futures.values(), timeout=(self._identify_timeout if identify else 0) + 0.5)
+        executor.shutdown(wait=False)
+
+        opened = [futures[port].result() for port in candidates
+                  if futures[port].done() and futures[port].exception() is None]
+        result = next((probed for probed in opened if probed.identified), opened[0] if opened else None)
+        for port in candidates:
+            if result is None or port != result.port:
+                # Close everything we don't use, including probes that are still running
+                futures[port].add_done_callback(self._closeProbedPort)
+        if result is not None:
+            self._last_good_port = result.port
+            logging.info(f"Connected with serial {result.port}"
+                         f"{'' if result.identified or not identify else ' (it did not answer, but nothing else did)'}")
+        return result
+
+    def _probe(self, port: str, identify: bool) -> ProbedPort:
+        connection = serial.Serial()
+        connection.port = port
+        connection.baudrate = self._baud_rate
+        # Applied as the port is opened, so the Arduino isn't reset
+        connection.dtr = False
+        connection.timeout = 0.05
+        connection.write_timeout = 0.1
+        connection.open()
+        try:
+            # Anything that was buffered before we opened the port is stale
+            connection.reset_input_buffer()
+            received, identified = b"", False
+            if identify:
+                connection.write(b"\nREAD ALL\n")
+                received, identified = self._waitForReaderLine(connection)
+            # From here on, the port is used by the reactor, which doesn't want to block
+            connection.timeout = 0
+            connection.write_timeout = 0
+        except Exception:
+            connection.close()
+            raise
+        return ProbedPort(port, connection, received, identified)
+
+    def _waitForReaderLine(self, connection: serial.Serial) -> Tuple[bytes, bool]:
+        """
+        :return: Everything that was read, and if it contains a line of the reader (else it timed out)
+        """
+        deadline = time.monotonic() + self._identify_timeout
+        received = b""
+        while time.monotonic() < deadline:
+            received += connection.read(connection.in_waiting or 1)
+            *lines, _ = received.split(b"\n")
+            if any(line.strip().startswith(READER_LINE_PREFIXES) for line in lines):
+                return received, True
+        return received, False
+
+    @staticmethod
+    def _closeProbedPort(future: Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            future.result().connection.close()
+        except Exception:
+            pass
@@ -0,0 +1,182 @@
+import logging
+import os
+import random
+import selectors
+import threading
+import time
+import tty
+from typing import Dict, Iterator, Optional, Tuple
+
+from sql_app.schemas import Action, Purity, Target
+
+
+class SimulatedRFIDReader:
+    """
+    Pretends to be the RFID reader on a pseudo-terminal, so the display can be run (and benchmarked) without hardware.
+    Pass the port of the reader (getPort) to the RFIDController.
+
+    It either replays a script, or swaps randomly generated cards at a given rate. A script has a line per message,
+    prefixed with the delay (in seconds) since the previous one. Empty lines and lines starting with # are ignored:
+
+        0.5 Tag found: 04A1B2 RAW HEATING FLESH COOLING MIND ACTIVE
+        2.0 Tag lost: 04A1B2
+
+    Like the real reader, it answers READ ALL with the traits of the card that is on it.
+    """
+    def __init__(self, script_path: Optional[str] = None, swap_rate: float = 1.0, num_cards: int = 10,
+                 malformed_ratio: float = 0.05, empty_ratio: float = 0.05, flap_ratio: float = 0.05,
+                 seed: Optional[int] = None, loop: bool = False) -> None:
+        """
+        :param script_path: Script to replay. If not set, random cards are swapped.
+        :param swap_rate: How many cards are put on the reader per second (random mode)
+        :param num_cards: How many different cards there are to choose from (random mode)
+        :param malformed_ratio: Fraction of the cards that are read with garbled traits (random mode)
+        :param empty_ratio: Fraction of the cards that are read as EMPTY (random mode)
+        :param flap_ratio: Fraction of the cards that are briefly lost and found again (random mode)
+        :param seed: Seed for the random mode, to make runs reproducible
+        :param loop: Start the script over once it's done
+        """
+        self._script_path = script_path
+        self._swap_rate = swap_rate
+        self._malformed_ratio = malformed_ratio
+        self._empty_ratio = empty_ratio
+        self._flap_ratio = flap_ratio
+        self._loop = loop
+        self._random = random.Random(seed)
+        self._cards = {self._createCardId(): self._createTraits() for _ in range(num_cards)}
+
+        self._master_fd, self._slave_fd = os.openpty()
+        # No echo or line editing, we want the bytes to go through exactly like on a real serial port.
+        tty.setraw(self._master_fd)
+        tty.setraw(self._slave_fd)
+        os.set_blocking(self._master_fd, False)
+        self._port = os.ttyname(self._slave_fd)
+
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._current_card: Optional[str] = None
+        self._command_buffer = b""
+        self._stats = {"lines_sent": 0, "lines_dropped": 0, "cards_swapped": 0, "read_all_answered": 0}
+
+    def getPort(self) -> str:
+        return self._port
+
+    def getStats(self) -> Dict[str, int]:
+        return dict(self._stats)
+
+    def start(self) -> None:
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="SimulatedRFIDReader")
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+        for fd in (self._master_fd, self._slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        logging.info(f"Simulated RFID reader stopped: {self._stats}")
+
+    def _run(self) -> None:
+        logging.info(f"Simulated RFID reader running on {self._port}")
+        selector = selectors.DefaultSelector()
+        selector.register(self._master_fd, selectors.EVENT_READ)
+        messages = self._createScriptMessages() if self._script_path else self._createRandomMessages()
+        next_message = next(messages, None)
+        send_at = time.monotonic() + next_message[0] if next_message else None
+
+        while self._running:
+            timeout = 0.1 if send_at is None else min(max(send_at - time.monotonic(), 0), 0.1)
+            if selector.select(timeout):
+                self._handleCommands()
+            if send_at is not None and time.monotonic() >= send_at:
+                self._sendLine(next_message[1])
+                next_message = next(messages, None)
+                # Once the script is done, we keep answering commands for the card that was left on the reader.
+                send_at = send_at + next_message[0] if next_message else None
+        selector.close()
+
+    def _createScriptMessages(self) -> Iterator[Tuple[float, str]]:
+        while True:
+            with open(self._script_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    delay, message = line.split(" ", 1)
+                    yield float(delay), message
+            if not self._loop:
+                return
+
+    def _createRandomMessages(self) -> Iterator[Tuple[float, str]]:
+        while True:
+            card_id = self._random.choice(list(self._cards))
+            hold_time = self._random.uniform(0.5, 1.5) / self._swap_rate
+            yield 0.0, f"Tag found: {card_id} {self._readTraits(card_id)}"
+            if self._random.random() < self._flap_ratio:
+                # Card wobbles on the reader; it's lost and found again right away.
+                yield hold_time * 0.1, f"Tag lost: {card_id}"
+                yield 0.01, f"Tag found: {card_id} {self._readTraits(card_id)}"
+            yield hold_time, f"Tag lost: {card_id}"
+
+    def _readTraits(self, card_id: str) -> str:
+        """
+        The traits as the reader would report them when it finds the card, which goes wrong every now and then.
+        """
+        roll = self._random.random()
+        if roll < self._empty_ratio:
+            return "EMPTY"
+        if roll < self._empty_ratio + self._malformed_ratio:
+            # Bits got flipped, which the controller notices as the traits are no longer in all caps.
+            return self._cards[card_id].lower()
+        return self._cards[card_id]
+
+    def _createCardId(self) -> str:
+        return "".join(self._random.choice("0123456789ABCDEF") for _ in range(8))
+
+    def _createTraits(self) -> str:
+        actions = [action.value.upper() for action in Action]
+        targets = [target.value.upper() for target in Target]
+        traits = [self._random.choice(actions), self._random.choice(targets),
+                  self._random.choice(actions), self._random.choice(targets)]
+        if self._random.random() < 0.5:
+            traits = ["RAW"] + traits
+        else:
+            traits = ["REFINED"] + traits + [self._random.choice(list(Purity)).value.upper()]
+        traits.append(self._random.choice(["ACTIVE", "ACTIVE", "ACTIVE", "DEPLETED"]))
+        return " ".join(traits)
+
+    def _sendLine(self, line: str) -> None:
+        if line.startswith("Tag found: "):
+            card_id, _, traits = line[len("Tag found: "):].partition(" ")
+            self._current_card = card_id
+            self._stats["cards_swapped"] += 1
+            if card_id not in self._cards and traits.upper() == traits and traits != "EMPTY":
+                # A card from a script, remember what is on it for when the controller asks for it again
+                self._cards[card_id] = traits
+        elif line.startswith("Tag lost: "):
+            self._current_card = None
+        try:
+            os.write(self._master_fd, line.encode("utf-8") + b"\n")
+            self._stats["lines_sent"] += 1
+        except BlockingIOError:
+            # Nobody is reading the port, so there is no point in keeping it.
+            self._stats["lines_dropped"] += 1
+
+    def _handleCommands(self) -> None:
+        try:
+            self._command_buffer += os.read(self._master_fd, 4096)
+        except (BlockingIOError, OSError):
+            return
+        *commands, self._command_buffer = self._command_buffer.split(b"\n")
+        for command in commands:
+            command = command.strip().decode("utf-8", errors="replace")
+            if command == "READ ALL" and self._current_card is not None:
+                self._sendLine(f"Traits: {self._cards.get(self._current_card, 'EMPTY')}")
+                self._stats["read_all_answered"] += 1
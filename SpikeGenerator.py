@@ -1,103 +1,30 @@
-
-
 import random
+from functools import partial
+from typing import Callable
 
-from sql_app.schemas import Target
-
-
-class SpikeGenerator:
-
-    @staticmethod
-    def generateSpikes1(start_angle, end_angle):
-        half_angle = abs(end_angle - start_angle) / 2
-        result = [(start_angle + half_angle, 40, 0.15),
-                  (start_angle + half_angle, 30, -0.05),
-                  (start_angle + half_angle, 15, -0.15),
-                  (start_angle + half_angle, 2, 0.2)]
-        return result
-
-    @staticmethod
-    def generateSpikes2(start_angle, end_angle):
-        third_angle = abs(end_angle - start_angle) / 3
-        result = [(start_angle + third_angle, 20, 0.05),
-                  (end_angle - third_angle, 20, -0.05)]
-        return result
-
-    @staticmethod
-    def generateSpikes3(start_angle, end_angle):
-        third_angle = abs(end_angle - start_angle) / 3
-        half_angle = abs(end_angle - start_angle) / 2
-        result = [(start_angle + third_angle, 20, 0.05),
-                  (start_angle + half_angle, 20, -0.05),
-                  (end_angle - third_angle, 20, 0.05)]
-        return result
+import numpy as np
 
-    @staticmethod
-    def generateSpikes4(start_angle, end_angle):
-        quarter_angle = abs(end_angle - start_angle) / 4
-        third_angle = abs(end_angle - start_angle) / 3
-        result = [(start_angle + quarter_angle, 20, 0.1),
-                  (start_angle + third_angle, 5, -0.1),
-                  (end_angle - third_angle, 5, -0.1),
-                  (end_angle - quarter_angle, 20, 0.1)]
-        return result
-
-    @staticmethod
-    def generateSpikes5(start_angle, end_angle):
-        quarter_angle = abs(end_angle - start_angle) / 4
-        third_angle = abs(end_angle - start_angle) / 3
-        result = [(start_angle + quarter_angle, 5, -0.1),
-                  (start_angle + third_angle, 5, -0.1),
-                  (end_angle - third_angle, 5, -0.1),
-                  (end_angle - quarter_angle, 5, -0.1)]
-        return result
+from PatternTable import PatternTable
+from sql_app.schemas import Target
 
-    @staticmethod
-    def generateSpikes6(start_angle, end_angle):
-        quarter_angle = abs(end_angle - start_angle) / 4
-        third_angle = abs(end_angle - start_angle) / 3
-        half_angle = abs(end_angle - start_angle) / 2
-        result = [(start_angle + quarter_angle, 10, -0.1),
-                  (start_angle + third_angle, 10, -0.1),
-                  (start_angle + half_angle, 10, -0.15),
-                  (end_angle - third_angle, 10, -0.1),
-                  (end_angle - quarter_angle, 10, -0.1)]
-        return result
+# Lookup from (lowercase) target to the index of the spikes in the pattern table
+TARGET_INDICES = {target.value.lower(): index for index, target in enumerate(Target)}
 
-    @staticmethod
-    def generateSpikes7(start_angle, end_angle):
-        half_angle = abs(end_angle - start_angle) / 2
-        result = [(start_angle + half_angle, half_angle, -0.15)]
-        return result
 
-    @staticmethod
-    def generateSpikes8(start_angle, end_angle):
-        half_angle = abs(end_angle - start_angle) / 2
-        result = [(start_angle + half_angle, half_angle, 0.15)]
-        return result
-
-    @staticmethod
-    def generateSpikes9(start_angle, end_angle):
-        half_angle = abs(end_angle - start_angle) / 2
-        quarter_angle = abs(end_angle - start_angle) / 4
-        third_angle = abs(end_angle - start_angle) / 3
-        result = [(start_angle + third_angle, quarter_angle, 0.05),
-                  (start_angle + quarter_angle, 5, -0.1),
-                  (start_angle + half_angle, third_angle, 0.15),
-                  (start_angle + half_angle, 5, -0.15),
-                  (end_angle - quarter_angle, 5, -0.1),
-                  (end_angle - third_angle, quarter_angle, 0.05)]
-        return result
+class SpikeGenerator:
 
     @staticmethod
-    def generateSpikes10(start_angle, end_angle):
-        half_angle = abs(end_angle - start_angle) / 2
-        quarter_angle = abs(end_angle - start_angle) / 4
-
-        result = [(start_angle + quarter_angle, 10, 0.15),
-                  (start_angle + half_angle, 10, -0.15),
-                  (end_angle - quarter_angle, 10, 0.15)]
-        return result
+    def generateSpikes(target_index: int, start_angle, end_angle) -> np.ndarray:
+        """
+        Generate the spikes for a target (by index in the Target enum)
+        :return: Array of shape (N, 3) with the (angle, width, intensity) of each spike.
+        """
+        definition = PatternTable.getDefault().getSpikeDefinition(target_index)
+        angle_span = abs(end_angle - start_angle)
+        anchors = np.array([start_angle, end_angle], dtype=float)
+        angles = anchors[definition[:, 0].astype(int)] + definition[:, 1] * angle_span + definition[:, 2]
+        widths = definition[:, 3] * angle_span + definition[:, 4]
+        return np.column_stack((angles, widths, definition[:, 5]))
 
     @staticmethod
     def getRandomSpikeFunction():
@@ -106,9 +33,7 @@ class SpikeGenerator:
         return SpikeGenerator.getSpikeFunctionByTarget(target)
 
     @staticmethod
-    def getSpikeFunctionByTarget(target):
+    def getSpikeFunctionByTarget(target) -> Callable[[float, float], np.ndarray]:
         if target == "random":
             return SpikeGenerator.getRandomSpikeFunction()
-        target_list = list(Target)
-        result = getattr(SpikeGenerator, f"generateSpikes{target_list.index(target.title()) + 1}")
-        return result
+        return partial(SpikeGenerator.generateSpikes, TARGET_INDICES[target.lower()])
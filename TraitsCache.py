@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+DEFAULT_TRAITS_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traits_cache.json")
+
+
+class TraitsCache:
+    """
+    Remembers the last validated traits of the cards that were seen, so a card whose traits were misread can be shown
+    right away instead of after a READ ALL round-trip. The same cards come back to the reader over and over during an
+    event, so it's kept on disk and survives restarts. Once it's full, the least recently seen card is dropped.
+    """
+    def __init__(self, path: Optional[str] = DEFAULT_TRAITS_CACHE_FILE, max_entries: int = 512) -> None:
+        """
+        :param path: File to keep the cache in. If None, the cache is only kept in memory.
+        :param max_entries: How many cards to remember
+        """
+        self._path = path
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._load()
+
+    def get(self, card_id: str) -> Optional[List[str]]:
+        with self._lock:
+            traits = self._entries.get(card_id)
+            if traits is None:
+                return None
+            self._entries.move_to_end(card_id)
+            return list(traits)
+
+    def put(self, card_id: str, traits: List[str]) -> bool:
+        """
+        Store the (validated) traits of a card
+        :return: If the traits differ from what was stored for that card.
+        """
+        with self._lock:
+            changed = self._entries.get(card_id) != traits
+            self._entries[card_id] = list(traits)
+            self._entries.move_to_end(card_id)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            if changed:
+                self._save()
+        return changed
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _load(self) -> None:
+        if self._path is None or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+            # Stored from least to most recently used
+            for card_id, traits in data["cards"]:
+                self._entries[card_id] = traits
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Ignoring unreadable traits cache {self._path}: {e}")
+            self._entries.clear()
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self) -> None:
+        if self._path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self._path))
+        temp_path = None
+        try:
+            # Write to a temporary file and move that over the old one, so a crash never leaves half a cache behind.
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".traits_cache", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"cards": list(self._entries.items())}, f)
+            os.replace(temp_path, self._path)
+        except OSError as e:
+            logging.warning(f"Unable to write traits cache {self._path}: {e}")
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
@@ -0,0 +1,141 @@
+"""
+Hammers the CardEventQueue with producer threads swiping cards while a consumer drains it like the render loop, and
+checks that coalescing never loses anything it shouldn't:
+
+- every event that is put is either drained exactly once or reported as dropped by the event that superseded it,
+- the events of a producer are drained in the order they were put,
+- once everything is drained, the last detected or lost event of every card is the last one that was put for it.
+
+    python3 card_event_stress.py --producers 4 --events 200000
+
+It exits with 1 if anything was lost or reordered, so it can be used as a check.
+"""
+import argparse
+import random
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from CardEventQueue import CardEvent, CardEventKind, CardEventQueue, supersedes
+
+
+def produce(queue: CardEventQueue, producer: int, num_events: int, num_cards: int, seed: Optional[int],
+            put_events: List[CardEvent], dropped: List[Tuple[CardEvent, CardEvent]]) -> None:
+    """
+    Swipe random cards (only this producer's), which flap and get their sample read every now and then.
+    The trace of every event is used as its unique id, which goes up in the order the events are put.
+    """
+    rng = random.Random(seed)
+    cards = [f"{producer}-{card}" for card in range(num_cards)]
+    for index in range(num_events):
+        card_id = rng.choice(cards)
+        kind = rng.choice(list(CardEventKind))
+        sample = {"index": index} if kind == CardEventKind.SAMPLE else None
+        event = CardEvent(kind, time.monotonic(), card_id=card_id, sample=sample, trace=producer * num_events + index)
+        put_events.append(event)
+        for dropped_event in queue.put(event):
+            dropped.append((event, dropped_event))
+
+
+def _getProducer(event: CardEvent) -> int:
+    return int(event.card_id.split("-")[0])
+
+
+def runStressTest(num_producers: int = 4, num_events: int = 100000, num_cards: int = 3,
+                  seed: Optional[int] = None) -> Dict:
+    """
+    :param num_producers: How many threads put events at the same time
+    :param num_events: How many events every producer puts
+    :param num_cards: How many different cards every producer swipes
+    :param seed: Seed for the random events, to make the runs reproducible (the interleaving of the threads isn't)
+    :return: Statistics of the run, and under "failures" everything the queue lost or reordered (empty if it's fine)
+    """
+    queue = CardEventQueue()
+    put_events: List[List[CardEvent]] = [[] for _ in range(num_producers)]
+    dropped: List[List[Tuple[CardEvent, CardEvent]]] = [[] for _ in range(num_producers)]
+    producers = [threading.Thread(target=produce, name=f"Producer{producer}",
+                                  args=(queue, producer, num_events, num_cards,
+                                        None if seed is None else seed + producer,
+                                        put_events[producer], dropped[producer]))
+                 for producer in range(num_producers)]
+
+    drained: List[CardEvent] = []
+    largest_batch = 0
+    start_time = time.monotonic()
+    for thread in producers:
+        thread.start()
+    while any(thread.is_alive() for thread in producers) or len(queue):
+        batch = queue.drain()
+        largest_batch = max(largest_batch, len(batch))
+        drained.extend(batch)
+    for thread in producers:
+        thread.join()
+    duration = time.monotonic() - start_time
+
+    all_put = [event for events in put_events for event in events]
+    all_dropped = [pair for pairs in dropped for pair in pairs]
+    drained_ids = [event.trace for event in drained]
+    dropped_ids = [dropped_event.trace for _, dropped_event in all_dropped]
+
+    failures: List[str] = []
+
+    # Nothing is lost or delivered twice
+    if len(set(drained_ids)) != len(drained_ids):
+        failures.append("An event was drained more than once")
+    if len(set(dropped_ids)) != len(dropped_ids):
+        failures.append("An event was dropped more than once")
+    if set(drained_ids) & set(dropped_ids):
+        failures.append("An event was both drained and dropped")
+    if set(drained_ids) | set(dropped_ids) != {event.trace for event in all_put}:
+        failures.append("An event disappeared")
+
+    # Events are only dropped by later events that supersede them
+    for event, dropped_event in all_dropped:
+        if not supersedes(event, dropped_event):
+            failures.append(f"{event} dropped {dropped_event}, which it doesn't supersede")
+        if _getProducer(event) == _getProducer(dropped_event) and dropped_event.trace > event.trace:
+            failures.append(f"{event} dropped {dropped_event}, which came after it")
+
+    # Every producer's events come out in the order they went in
+    for producer in range(num_producers):
+        ids = [event.trace for event in drained if _getProducer(event) == producer]
+        if ids != sorted(ids):
+            failures.append(f"The events of producer {producer} were reordered")
+
+    # The last state of every card wins
+    presence_kinds = (CardEventKind.DETECTED, CardEventKind.LOST)
+    last_put = {event.card_id: event for event in all_put if event.kind in presence_kinds}
+    last_drained = {event.card_id: event for event in drained if event.kind in presence_kinds}
+    for card_id, event in last_put.items():
+        if last_drained.get(card_id) != event:
+            failures.append(f"The last state of {card_id} was {event.kind.value}, "
+                            f"but {last_drained.get(card_id)} was drained last")
+
+    return {"events_put": len(all_put),
+            "events_drained": len(drained),
+            "events_dropped": len(all_dropped),
+            "largest_batch": largest_batch,
+            "events_per_second": len(all_put) / duration,
+            "failures": failures}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stress test the coalescing of the card event queue")
+    parser.add_argument("--producers", type=int, default=4, help="Number of threads putting events")
+    parser.add_argument("--events", type=int, default=100000, help="Number of events per producer")
+    parser.add_argument("--cards", type=int, default=3, help="Number of different cards per producer")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    stats = runStressTest(args.producers, args.events, args.cards, args.seed)
+    print(f"Put {stats['events_put']} events ({stats['events_per_second']:.0f}/s): "
+          f"{stats['events_drained']} drained, {stats['events_dropped']} dropped, "
+          f"largest batch {stats['largest_batch']}.")
+    if stats["failures"]:
+        # A broken rule tends to break for many events, the first few say enough
+        for failure in stats["failures"][:20]:
+            print(f"FAILED: {failure}")
+        print(f"{len(stats['failures'])} failures")
+        sys.exit(1)
+    print("Nothing was lost.")
@@ -1,16 +1,22 @@
 import argparse
 import contextlib
+import os
 import random
-from typing import List
+from typing import List, Optional
 
 import requests
 import logging
 import sys
+import time
 
 
+from CardEventQueue import CardEvent, CardEventKind, CardEventQueue
 from Fader import Fader
 from GlitchHandler import GlitchHandler
+from LatencyTracer import LatencyTracer
 from RFIDController import RFIDController
+from SimulatedRFIDReader import SimulatedRFIDReader
+from TraitsCache import TraitsCache, DEFAULT_TRAITS_CACHE_FILE
 from sql_app.schemas import Action, Target
 
 # This suppresses the `Hello from pygame` message.
@@ -47,7 +53,10 @@ def addRandomLinesToCrystalograph(crystalograph):
 
 
 class PygameWrapper:
-    def __init__(self, fullscreen: bool = True):
+    def __init__(self, fullscreen: bool = True, quality: str = "high", render_scale: float = 1.0,
+                 target_fps: Optional[float] = None, upscale_filter: str = "linear",
+                 latency_dump_path: Optional[str] = None, rfid_ports: Optional[List[str]] = None,
+                 traits_cache: Optional[TraitsCache] = None):
         pygame.init()
         self._screen_width = 1280
         self._screen_height = 720
@@ -57,12 +66,25 @@ class PygameWrapper:
             self._screen = pygame.display.set_mode((self._screen_width, self._screen_height))
         self._clock = pygame.time.Clock()
         self._running = True
-        self._crystalograph = Crystalograph.Crystalograph()
+        self._crystalograph = Crystalograph.Crystalograph(quality, render_scale, upscale_filter)
+        if target_fps:
+            self._crystalograph.setTargetFrameTime(1000 / target_fps)
         self._glitch_handler = GlitchHandler()
-        self._rfid_controller = RFIDController(self._onCardDetected, self._onCardLost, self._onTraitsDetected)
+
+        # Traces the time from a tag being read to the new pattern being shown
+        self._latency_tracer = LatencyTracer()
+        self._latency_dump_path = latency_dump_path
+        self._new_sample_trace: Optional[int] = None
+        self._first_frame_trace: Optional[int] = None  # Pattern has been set up, waiting for it to be presented
+        self._fade_in_started_at: Optional[float] = None
+
+        # The RFID callbacks run on the reactor thread. They only queue events, which the render loop handles.
+        self._card_events = CardEventQueue()
+        self._rfid_controller = RFIDController(self._onCardDetected, self._onCardLost, self._onTraitsDetected,
+                                               ports=rfid_ports, traits_cache=traits_cache)
         self._rfid_controller.start()
 
-        self._crystalograph.createEmptyImage((self._screen_width, self._screen_height))
+        self._crystalograph.setOutputSize((self._screen_width, self._screen_height))
 
         self._base_server_url: str = "http://127.0.0.1:8000"
 
@@ -90,76 +112,95 @@ class PygameWrapper:
         handler.setFormatter(formatter)
         root.addHandler(handler)
 
-    def _onTraitsDetected(self, traits: List[str]) -> None:
+    def _queueCardEvent(self, event: CardEvent) -> None:
+        # Events that were replaced by this one will never make it to the screen.
+        for dropped in self._card_events.put(event):
+            self._latency_tracer.discardTrace(dropped.trace)
+
+    def _onTraitsDetected(self, traits: List[str], received_at: float) -> None:
+        trace = self._latency_tracer.startTrace(received_at)
+        self._latency_tracer.mark(trace, "dispatched")
         logging.info(f"Traits detected: {traits}")
-        self._crystalograph.clearLinesToDraw()
 
         if traits[0] == "RAW":
-            self._new_sample_to_draw = {"positive_action": traits[1].lower(),
-                                        "positive_target": traits[2].lower(),
-                                        "negative_action": traits[3].lower(),
-                                        "negative_target": traits[4].lower(),
-                                        "vulgarity": "HACK",  # Sorry. But I'm faking the old API
-                                        "depleted": traits[5] != "ACTIVE"
-                                        }
+            sample = {"positive_action": traits[1].lower(),
+                      "positive_target": traits[2].lower(),
+                      "negative_action": traits[3].lower(),
+                      "negative_target": traits[4].lower(),
+                      "vulgarity": "HACK",  # Sorry. But I'm faking the old API
+                      "depleted": traits[5] != "ACTIVE"
+                      }
         else:
-            self._new_sample_to_draw = {"primary_action": traits[1].lower(),
-                                        "primary_target": traits[2].lower(),
-                                        "secondary_action": traits[3].lower(),
-                                        "secondary_target": traits[4].lower(),
-                                        "depleted": traits[6] != "ACTIVE"
-                                        }
-
-    def _onCardLost(self, rfid_id: str) -> None:
+            sample = {"primary_action": traits[1].lower(),
+                      "primary_target": traits[2].lower(),
+                      "secondary_action": traits[3].lower(),
+                      "secondary_target": traits[4].lower(),
+                      "depleted": traits[6] != "ACTIVE"
+                      }
+        self._queueCardEvent(CardEvent(CardEventKind.SAMPLE, received_at, sample=sample, trace=trace))
+
+    def _onCardLost(self, rfid_id: str, received_at: float) -> None:
         logging.info(f"Card lost {rfid_id}")
+        self._queueCardEvent(CardEvent(CardEventKind.LOST, received_at, card_id=rfid_id))
 
-        # We only fade out, as we don't want the pattern to disappear right away
-        self._fader.fadeOut()
-
-    def _onCardDetected(self, rfid_id: str) -> None:
+    def _onCardDetected(self, rfid_id: str, received_at: float) -> None:
         logging.info(f"Card detected {rfid_id}")
+        self._queueCardEvent(CardEvent(CardEventKind.DETECTED, received_at, card_id=rfid_id))
 
         ## Disable the HTTP stuff for now as we're reading from tags themselves now
         return
         try:
-            r = requests.get(f"{self._base_server_url}/samples/{rfid_id}")
+            r = requests.get(f"{self._base_server_url}/items/{rfid_id}")
         except requests.exceptions.ConnectionError:
             logging.error("Failed to connect to the server")
             return
 
         if r.status_code == 200:
-            self._crystalograph.clearLinesToDraw()
-
             data = r.json()
-            # Set the data for next update draw loop to be updated. Since this is called outside of the main thread,
-            # we do it like this to prevent threading issues.
-            self._new_sample_to_draw = data
-        elif r.status_code == 404:
-            # It's not a raw sample, find out if it's a refined one
-            try:
-                r = requests.get(f"{self._base_server_url}/refined/{rfid_id}")
-            except requests.exceptions.ConnectionError:
-                logging.error("Failed to connect to the server")
+            if data["kind"] == "blood":
+                logging.info(f"{rfid_id} is a blood sample, nothing to show")
                 return
-            if r.status_code == 200:
-                self._crystalograph.clearLinesToDraw()
-
-                data = r.json()
-                # Set the data for next update draw loop to be updated. Since this is called outside of the main thread,
-                # we do it like this to prevent threading issues.
-                self._new_sample_to_draw = data
-            else:
-
-                logging.warning(f"Failed to get remote info for {rfid_id}, got status code {r.status_code}")
+            # Hand the data to the render loop. Since this is called outside of the main thread, we do it like this to
+            # prevent threading issues.
+            self._queueCardEvent(CardEvent(CardEventKind.SAMPLE, received_at, card_id=rfid_id, sample=data["item"]))
         else:
             logging.warning(f"Failed to get remote info for {rfid_id}, got status code {r.status_code}")
 
-    def run(self):
+    def _handleCardEvents(self) -> None:
+        for event in self._card_events.drain():
+            if event.kind == CardEventKind.SAMPLE:
+                self._latency_tracer.mark(event.trace, "dequeued")
+                self._crystalograph.clearLinesToDraw()
+                # If the previous sample hasn't been picked up yet, it never will be.
+                self._latency_tracer.discardTrace(self._new_sample_trace)
+                self._new_sample_trace = event.trace
+                self._new_sample_to_draw = event.sample
+            elif event.kind == CardEventKind.LOST:
+                # The card is gone, so whatever it was still waiting to be drawn is no longer relevant.
+                self._latency_tracer.discardTrace(self._new_sample_trace)
+                self._new_sample_trace = None
+                self._new_sample_to_draw = None
+                # We only fade out, as we don't want the pattern to disappear right away
+                self._fader.fadeOut()
+            # A detected card has nothing to draw until we know its sample; queueing it only serves to cancel a
+            # pending lost event when the card flaps.
+
+    def run(self, duration: Optional[float] = None):
+        """
+        :param duration: Stop after this many seconds. Runs until quit if not set.
+        """
         logging.info("Display has started")
         pygame.mouse.set_visible(False)
+        stop_at = time.monotonic() + duration if duration else None
         while self._running:
+            if stop_at is not None and time.monotonic() >= stop_at:
+                break
+            self._handleCardEvents()
             if self._new_sample_to_draw is not None and not self._fader.isFading():
                 # Only re-draw if we have a new sample, and we are done with any fade operation!
+                trace = self._new_sample_trace
+                self._new_sample_trace = None
+                self._latency_tracer.mark(trace, "fade_wait")
                 circle_shift = 125
                 circle_radius = 200
                 line_thickness = 3
@@ -195,14 +236,20 @@ class PygameWrapper:
                 self._crystalograph.drawVerticalPatterns(f"{inner_color}_2", f"{outer_color}_2", inner_line_thickness,
                                                          outer_line_thickness, circle_radius,
                                                          circle_shift, vertical_action, vertical_target)
+                self._latency_tracer.mark(trace, "built")
 
                 self._crystalograph.setup()
+                self._latency_tracer.mark(trace, "setup")
                 # We have something to show, fade in the new pattern!
                 self._fader.fadeIn()
+                self._fade_in_started_at = time.monotonic()
+                self._latency_tracer.discardTrace(self._first_frame_trace)
+                self._first_frame_trace = trace
 
                 self._new_sample_to_draw = None
 
-            image = self._crystalograph.draw()
+            # Rendered at the internal resolution, scaled up to the screen size once here.
+            image = self._crystalograph.upscale(self._crystalograph.draw())
             self._screen.fill((0, 0, 0))
 
             for event in pygame.event.get():
@@ -271,6 +318,11 @@ class PygameWrapper:
 
             self._fader.update()
             self._glitch_handler.update()
+            if self._fade_in_started_at is not None and not self._fader.isFadingIn():
+                # Only count fade ins that completed, not the ones interrupted by the card being removed
+                if not self._fader.isFading():
+                    self._latency_tracer.addSample("fade_in", (time.monotonic() - self._fade_in_started_at) * 1000)
+                self._fade_in_started_at = None
 
             # This is where we insert the numpy array.
             # Because pygame and numpy use different coordinate systems,
@@ -285,18 +337,72 @@ class PygameWrapper:
             self._glitch_handler.draw(self._screen)
 
             pygame.display.flip()
+            if self._first_frame_trace is not None:
+                # The new pattern is on screen (although still mostly hidden by the fader)
+                self._latency_tracer.finishTrace(self._first_frame_trace, "first_frame")
+                self._first_frame_trace = None
             self._crystalograph.update()
-            self._clock.tick()
+            frame_time = self._clock.tick()
+            self._latency_tracer.addSample("frame_time", frame_time)
+            self._crystalograph.adaptRenderScale(frame_time)
 
         self._rfid_controller.stop()
+        self._latency_tracer.logSummary()
+        if self._latency_dump_path:
+            self._latency_tracer.dumpJson(self._latency_dump_path)
         quit()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-w", "--windowed", action="store_true")
+    parser.add_argument("-q", "--quality", choices=list(Crystalograph.QUALITY_PRESETS), default="high",
+                        help="Level of detail of the line geometry. Use a lower one on weak hardware")
+
+    parser.add_argument("--render-scale", type=float, default=1.0,
+                        help="Render at this fraction of the screen resolution and scale the result up")
+    parser.add_argument("--target-fps", type=float, default=None,
+                        help="Dynamically adjust the render scale to try and reach this frame rate")
+    parser.add_argument("--upscale-filter", choices=list(Crystalograph.INTERPOLATIONS), default="linear")
+    parser.add_argument("--latency-dump", default=None,
+                        help="Write the tag-to-screen latency histograms as JSON to this file on exit")
+
+    parser.add_argument("--simulate", action="store_true",
+                        help="Use a simulated RFID reader that swaps random cards instead of the real reader")
+    parser.add_argument("--simulate-script", default=None,
+                        help="Let the simulated RFID reader replay this script (implies --simulate)")
+    parser.add_argument("--swap-rate", type=float, default=1.0,
+                        help="Cards per second the simulated reader swaps")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the simulated reader, for reproducible runs")
+    parser.add_argument("--headless", action="store_true", help="Don't open a window (for benchmarking)")
+    parser.add_argument("--duration", type=float, default=None, help="Stop after this many seconds")
+    parser.add_argument("--traits-cache", default=None,
+                        help=f"File to remember the traits of known cards in (default: {DEFAULT_TRAITS_CACHE_FILE}, "
+                             f"or only in memory when simulating)")
 
     args = parser.parse_args()
-    wrapper = PygameWrapper(fullscreen = not args.windowed)
-
-    wrapper.run()
+    if args.headless:
+        # Needs to be set before pygame is initialised
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+    simulated_reader = None
+    simulating = args.simulate or args.simulate_script
+    # Don't fill the cache of the real cards with the simulated ones
+    traits_cache = TraitsCache(args.traits_cache or (None if simulating else DEFAULT_TRAITS_CACHE_FILE))
+    if simulating:
+        simulated_reader = SimulatedRFIDReader(script_path = args.simulate_script, swap_rate = args.swap_rate,
+                                               seed = args.seed)
+        simulated_reader.start()
+
+    wrapper = PygameWrapper(fullscreen = not (args.windowed or args.headless), quality = args.quality,
+                            render_scale = args.render_scale, target_fps = args.target_fps,
+                            upscale_filter = args.upscale_filter, latency_dump_path = args.latency_dump,
+                            rfid_ports = [simulated_reader.getPort()] if simulated_reader else None,
+                            traits_cache = traits_cache)
+
+    try:
+        wrapper.run(args.duration)
+    finally:
+        if simulated_reader is not None:
+            simulated_reader.stop()
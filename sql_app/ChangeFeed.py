@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from .schemas import ItemKind
+
+
+class _Subscriber:
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_queued: int) -> None:
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self.overflowed = False
+
+    def deliver(self, event: Dict) -> None:
+        # Runs on the event loop of the subscriber
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class ChangeFeed:
+    """
+    Publishes what happens to the items (created, deleted and depleted), so the displays can keep their own copy up to
+    date instead of asking about every card they scan. Every event gets a sequence number, which only goes up. The
+    last events are kept, so a client that lost its connection can pick up where it left off; if it was gone for too
+    long, it's told to start over instead.
+
+    The sequence starts over when the server restarts, so the id of an event (which clients resume from) is the
+    sequence prefixed with an epoch that is picked at random when the feed is created ("<epoch>:<sequence>"). An id of
+    another epoch can't be resumed from; those clients are told to start over as well.
+
+    Events are published from whatever thread handles the request, and read by async subscribers. They are published
+    after the transaction of the request committed, so the events of two requests that change the same RFID at the
+    same time (eg; one deleting what the other just created) can be published in another order than they committed.
+    As that only happens for writes that race each other anyway, clients that need to be sure should look the RFID up.
+    """
+    CREATED = "created"
+    DELETED = "deleted"
+    DEPLETED = "depleted"
+    RESET = "reset"
+
+    def __init__(self, max_events: int = 10000) -> None:
+        """
+        :param max_events: How many events to keep for clients that resume, and to queue for a slow client before it
+                           gets disconnected
+        """
+        self._max_events = max_events
+        self._lock = threading.Lock()
+        self._events: deque = deque(maxlen=max_events)
+        self._sequence = 0
+        self._epoch = uuid.uuid4().hex[:12]
+        self._subscribers: Set[_Subscriber] = set()
+
+    def getSequence(self) -> int:
+        return self._sequence
+
+    def getEpoch(self) -> str:
+        return self._epoch
+
+    def getLastEventId(self) -> str:
+        """
+        The id of the last event that was published, to resume from (even if there are no events yet)
+        """
+        return self._createEventId(self._sequence)
+
+    def _createEventId(self, sequence: int) -> str:
+        return f"{self._epoch}:{sequence}"
+
+    def _parseEventId(self, event_id: str) -> Optional[int]:
+        """
+        :return: The sequence of the event, or None if the id isn't one of this epoch
+        """
+        epoch, _, sequence = event_id.rpartition(":")
+        if epoch != self._epoch or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def publish(self, event_type: str, kind: Optional[ItemKind], rfid_id: str, item: Optional[Dict] = None) -> Dict:
+        """
+        :param event_type: CREATED, DELETED or DEPLETED
+        :param item: The item as it would be returned by the API (for CREATED)
+        """
+        with self._lock:
+            self._sequence += 1
+            event = {"id": self._createEventId(self._sequence), "sequence": self._sequence, "type": event_type,
+                     "kind": kind.value if kind else None, "rfid_id": rfid_id, "time": time.time()}
+            if item is not None:
+                event["item"] = item
+            self._events.append(event)
+            # Still holding the lock, so every subscriber gets the events in order
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber.loop.call_soon_threadsafe(subscriber.deliver, event)
+                except RuntimeError:
+                    # Its event loop is gone
+                    self._subscribers.discard(subscriber)
+        return event
+
+    def _subscribe(self, after: Optional[str]) -> Tuple[List[Dict], _Subscriber]:
+        """
+        :return: The events after the one with the given id that were already published (or a reset event if they're no
+                 longer all there), and the subscriber that gets everything published from now on.
+        """
+        subscriber = _Subscriber(asyncio.get_running_loop(), self._max_events)
+        with self._lock:
+            backlog = []
+            if after is not None:
+                after_sequence = self._parseEventId(after)
+                oldest = self._events[0]["sequence"] if self._events else self._sequence + 1
+                if after_sequence is None or after_sequence > self._sequence or after_sequence < oldest - 1:
+                    backlog = [{"id": self.getLastEventId(), "sequence": self._sequence, "type": self.RESET}]
+                else:
+                    backlog = [event for event in self._events if event["sequence"] > after_sequence]
+            self._subscribers.add(subscriber)
+        return backlog, subscriber
+
+    def _unsubscribe(self, subscriber: _Subscriber) -> None:
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    async def iterateEvents(self, after: Optional[str] = None, keepalive: float = 15.0) -> AsyncIterator[Optional[Dict]]:
+        """
+        Go through the events as they are published, until the subscriber can't keep up.
+        :param after: Id of the last event the client has seen. If None, it only gets new events.
+        :param keepalive: Seconds after which None is yielded if nothing happened, so the connection can be checked
+        """
+        backlog, subscriber = self._subscribe(after)
+        try:
+            for event in backlog:
+                yield event
+            while not subscriber.overflowed:
+                try:
+                    yield await asyncio.wait_for(subscriber.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            self._unsubscribe(subscriber)
+
+    def __len__(self) -> int:
+        return len(self._events)
@@ -1,6 +1,8 @@
 from collections import defaultdict
 from typing import List
 
+import numpy as np
+
 
 class OpposingTraitController:
     def __init__(self):
@@ -18,3 +20,15 @@ class OpposingTraitController:
 
     def getOpposites(self, key):
         return self._oppositions.get(key, [])
+
+    def getMatrix(self, traits: List) -> np.ndarray:
+        """
+        The oppositions as a matrix, so they can be looked up (or combined) by index instead of by value.
+        :param traits: All the traits, in the order they get in the matrix
+        :return: Boolean matrix where [i, j] is set if traits[i] and traits[j] are opposed
+        """
+        matrix = np.zeros((len(traits), len(traits)), dtype=bool)
+        for i, trait in enumerate(traits):
+            for j, other_trait in enumerate(traits):
+                matrix[i, j] = self.areOpposed(trait, other_trait)
+        return matrix
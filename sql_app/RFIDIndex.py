@@ -0,0 +1,44 @@
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from .schemas import ItemKind
+
+
+class RFIDIndex:
+    """
+    In-memory map of every RFID to the kind of item it belongs to and the id of that item, so resolving a card is a dict
+    lookup instead of a query per table. Needs to be told about everything that is created or deleted; changes made
+    to the database by anything else (another process) are not seen.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[ItemKind, int]] = {}
+        self._loaded = False
+
+    def isLoaded(self) -> bool:
+        return self._loaded
+
+    def load(self, items_by_kind: Dict[ItemKind, Iterable[Tuple[str, int]]]) -> None:
+        """
+        Replace the contents of the index
+        :param items_by_kind: (rfid_id, id) of all the items, per kind of item
+        """
+        entries = {rfid_id: (kind, item_id) for kind, items in items_by_kind.items() for rfid_id, item_id in items}
+        with self._lock:
+            self._entries = entries
+            self._loaded = True
+
+    def get(self, rfid_id: str) -> Optional[Tuple[ItemKind, int]]:
+        return self._entries.get(rfid_id)
+
+    def add(self, rfid_id: str, kind: ItemKind, item_id: int) -> None:
+        with self._lock:
+            if self._loaded:
+                self._entries[rfid_id] = (kind, item_id)
+
+    def remove(self, rfid_id: str) -> None:
+        with self._lock:
+            self._entries.pop(rfid_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
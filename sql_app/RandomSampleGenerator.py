@@ -0,0 +1,60 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .schemas import Action, Target, Vulgarity
+
+
+class RandomSampleGenerator:
+    """
+    Draws the traits of many random samples at once. For every vulgarity it knows all the trait combinations that
+    have it, so a sample of a given vulgarity is simply one of those, picked at random (every combination is as likely).
+    Without a vulgarity, all the traits are picked independently, like they are for a single random sample.
+    """
+    def __init__(self, vulgarity_table: np.ndarray, actions: List[Action], targets: List[Target],
+                 vulgarities: List[Vulgarity], seed: Optional[int] = None) -> None:
+        """
+        :param vulgarity_table: Index into vulgarities, by [positive action, negative action, positive target,
+                                negative target] (see crud)
+        :param actions: The actions in the order of the table
+        :param targets: The targets in the order of the table
+        :param vulgarities: The vulgarities the table refers to
+        :param seed: Seed for the random numbers, to make the results reproducible
+        """
+        self._vulgarity_table = vulgarity_table
+        self._actions = np.array([action.value for action in actions])
+        self._targets = np.array([target.value for target in targets])
+        self._vulgarities = np.array([vulgarity.value for vulgarity in vulgarities])
+        # Per vulgarity, the (positive action, negative action, positive target, negative target) of every combination
+        self._combinations = {vulgarity: np.argwhere(vulgarity_table == index)
+                              for index, vulgarity in enumerate(vulgarities)}
+        self._random = np.random.default_rng(seed)
+
+    def seed(self, seed: Optional[int]) -> None:
+        self._random = np.random.default_rng(seed)
+
+    def getNumCombinations(self, vulgarity: Vulgarity) -> int:
+        return len(self._combinations[vulgarity])
+
+    def generate(self, num_samples: int, vulgarity: Optional[Vulgarity] = None) -> Dict[str, np.ndarray]:
+        """
+        :param num_samples: How many samples to draw
+        :param vulgarity: The vulgarity all samples should have. If None, it's completely random.
+        :return: The columns of the samples (positive_action, negative_action, positive_target, negative_target and
+                 vulgarity), as arrays of the values of the enums
+        """
+        if vulgarity is None:
+            indices = np.stack([self._random.integers(0, size, num_samples) for size in self._vulgarity_table.shape],
+                               axis=1)
+        else:
+            combinations = self._combinations[vulgarity]
+            indices = combinations[self._random.integers(0, len(combinations), num_samples)]
+        positive_action, negative_action, positive_target, negative_target = indices.T
+        return {
+            "positive_action": self._actions[positive_action],
+            "negative_action": self._actions[negative_action],
+            "positive_target": self._targets[positive_target],
+            "negative_target": self._targets[negative_target],
+            "vulgarity": self._vulgarities[self._vulgarity_table[positive_action, negative_action,
+                                                                 positive_target, negative_target]],
+        }
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from .schemas import ItemKind
+
+
+class ResponseCache:
+    """
+    Keeps the serialized (JSON) response for recently scanned RFIDs, so scanning the same card again doesn't need the
+    database or pydantic. Like the RFIDIndex, it has to be told about every change; crud invalidates an RFID whenever
+    the item it belongs to is created, changed or deleted. Once it's full, the least recently used RFID is dropped.
+    """
+    def __init__(self, max_entries: int = 4096) -> None:
+        """
+        :param max_entries: How many responses to keep. 0 disables the cache.
+        """
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[ItemKind, bytes]]" = OrderedDict()
+        # Goes up with every invalidation, so a response that was read before one can't be stored after it.
+        self._generation = 0
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def getGeneration(self) -> int:
+        """
+        Get this before reading the item from the database, and pass it to put.
+        """
+        return self._generation
+
+    def get(self, rfid_id: str) -> Optional[Tuple[ItemKind, bytes]]:
+        """
+        :return: The kind of item and its serialized response, or None if it isn't cached
+        """
+        with self._lock:
+            entry = self._entries.get(rfid_id)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(rfid_id)
+            self._stats["hits"] += 1
+            return entry
+
+    def put(self, rfid_id: str, kind: ItemKind, response: bytes, generation: int) -> None:
+        """
+        :param generation: What getGeneration returned before the item was read. If anything was invalidated since,
+                           the response might be outdated and isn't stored.
+        """
+        with self._lock:
+            if generation != self._generation or self._max_entries <= 0:
+                return
+            self._entries[rfid_id] = (kind, response)
+            self._entries.move_to_end(rfid_id)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, *rfid_ids: str) -> None:
+        with self._lock:
+            self._generation += 1
+            for rfid_id in rfid_ids:
+                if self._entries.pop(rfid_id, None) is not None:
+                    self._stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def getStats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["max_entries"] = self._max_entries
+            return stats
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,209 @@
+"""
+Async versions of the functions in crud. Everything that doesn't touch the database is shared with it.
+"""
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, schemas
+from .crud import _createSample, _createRandomSample, _createRandomSamples, _createRandomRefined, \
+    _createRefinedKrystaliumFromSamples, _depleteSamples, _indexItem, _forgetItem, _depleteItems, _selectPage, \
+    item_models, rfid_index
+from .schemas import Vulgarity, Purity, ItemKind
+
+
+async def loadRFIDIndex(db: AsyncSession) -> None:
+    """
+    Unlike crud, the index can't be loaded lazily from a sync lookup, so this has to be done before serving anything.
+    """
+    rfid_index.load({kind: (await db.execute(select(model.rfid_id, model.id))).all()
+                     for kind, model in item_models.items()})
+
+
+def getKindByRFID(rfid_id: str) -> Optional[ItemKind]:
+    entry = rfid_index.get(rfid_id)
+    return entry[0] if entry else None
+
+
+def getKindsByRFID(rfid_ids: Iterable[str]) -> Dict[str, ItemKind]:
+    """
+    See crud.getKindsByRFID
+    """
+    return {rfid_id: entry[0] for rfid_id in rfid_ids if (entry := rfid_index.get(rfid_id)) is not None}
+
+
+async def getItemByRFID(db: AsyncSession, rfid_id: str) -> Optional[Tuple[ItemKind, object]]:
+    """
+    See crud.getItemByRFID
+    """
+    entry = rfid_index.get(rfid_id)
+    if entry is None:
+        return None
+    kind, item_id = entry
+    db_item = await db.get(item_models[kind], item_id)
+    if db_item is None:
+        # Deleted behind our back, see crud.getItemByRFID
+        rfid_index.remove(rfid_id)
+        return None
+    return kind, db_item
+
+
+async def getAllKrystaliumSamples(db: AsyncSession, after_id: Optional[int] = None, limit: Optional[int] = None):
+    return (await db.scalars(_selectPage(models.KrystaliumSample, after_id, limit))).all()
+
+
+async def getAllRefinedKrystalium(db: AsyncSession, after_id: Optional[int] = None, limit: Optional[int] = None):
+    return (await db.scalars(_selectPage(models.RefinedKrystalium, after_id, limit))).all()
+
+
+async def getAllBloodSamples(db: AsyncSession, after_id: Optional[int] = None, limit: Optional[int] = None):
+    return (await db.scalars(_selectPage(models.BloodSample, after_id, limit))).all()
+
+
+async def getItemRows(db: AsyncSession, kind: ItemKind, field_names: List[str], after_id: Optional[int] = None,
+                      limit: Optional[int] = None) -> List[Tuple]:
+    """
+    See crud.getItemRows
+    """
+    return (await db.execute(_selectPage(item_models[kind], after_id, limit, field_names))).all()
+
+
+async def iterateItemRows(db: AsyncSession, kind: ItemKind, field_names: List[str], after_id: Optional[int] = None,
+                          limit: Optional[int] = None, chunk_size: int = 500) -> AsyncIterator[List[Tuple]]:
+    """
+    See crud.iterateItemRows
+    """
+    statement = _selectPage(item_models[kind], after_id, limit, field_names).execution_options(yield_per=chunk_size)
+    result = await db.stream(statement)
+    async for rows in result.partitions():
+        yield rows
+
+
+async def createSample(db: AsyncSession, sample: schemas.KrystaliumSampleCreate):
+    db_sample = _createSample(sample)
+    db.add(db_sample)
+    await db.commit()
+    _indexItem(ItemKind.sample, db_sample)
+    return db_sample
+
+
+async def createRefinedKrystalium(db: AsyncSession, refined_krystalium: schemas.RefinedKrystaliumCreate):
+    db_refined_krystalium = models.RefinedKrystalium(**refined_krystalium.__dict__)
+    db.add(db_refined_krystalium)
+    await db.commit()
+    _indexItem(ItemKind.refined, db_refined_krystalium)
+    return db_refined_krystalium
+
+
+async def createBloodSample(db: AsyncSession, blood_sample: schemas.BloodSampleCreate):
+    db_blood_sample = models.BloodSample(**blood_sample.__dict__)
+    db.add(db_blood_sample)
+    await db.commit()
+    _indexItem(ItemKind.blood, db_blood_sample)
+    return db_blood_sample
+
+
+async def createItems(db: AsyncSession, kind: ItemKind, db_items: List) -> List:
+    """
+    See crud.createItems
+    """
+    db.add_all(db_items)
+    await db.commit()
+    for db_item in db_items:
+        _indexItem(kind, db_item)
+    return db_items
+
+
+async def createSamples(db: AsyncSession, samples: List[schemas.KrystaliumSampleCreate]) -> List[models.KrystaliumSample]:
+    return await createItems(db, ItemKind.sample, [_createSample(sample) for sample in samples])
+
+
+async def createRefinedKrystaliums(db: AsyncSession, refined_krystaliums: List[schemas.RefinedKrystaliumCreate]) -> List[models.RefinedKrystalium]:
+    return await createItems(db, ItemKind.refined, [models.RefinedKrystalium(**refined_krystalium.__dict__)
+                                                    for refined_krystalium in refined_krystaliums])
+
+
+async def createBloodSamples(db: AsyncSession, blood_samples: List[schemas.BloodSampleCreate]) -> List[models.BloodSample]:
+    return await createItems(db, ItemKind.blood, [models.BloodSample(**blood_sample.__dict__)
+                                                  for blood_sample in blood_samples])
+
+
+async def createRandomSamples(db: AsyncSession, rfid_ids_and_vulgarities: List[Tuple[str, Optional[Vulgarity]]]) -> List[models.KrystaliumSample]:
+    return await createItems(db, ItemKind.sample, _createRandomSamples(rfid_ids_and_vulgarities))
+
+
+async def createRefinedKrystaliumFromSamples(db: AsyncSession, positive_sample: models.KrystaliumSample, negative_sample: models.KrystaliumSample, refined_rfid_id: str) -> Optional[models.RefinedKrystalium]:
+    """
+    See crud.createRefinedKrystaliumFromSamples
+    :return: The refined Krystalium, or None if one of the samples was depleted in the meantime
+    """
+    if (await db.execute(_depleteSamples(positive_sample.id, negative_sample.id))).rowcount != 2:
+        await db.rollback()
+        return None
+    db_refined = _createRefinedKrystaliumFromSamples(positive_sample, negative_sample, refined_rfid_id)
+    db.add(db_refined)
+    await db.commit()
+    _depleteItems(positive_sample.rfid_id, negative_sample.rfid_id)
+    _indexItem(ItemKind.refined, db_refined)
+    return db_refined
+
+
+async def createRandomRefined(db: AsyncSession, rfid_id: str, purity: Optional[Purity]):
+    db_refined = _createRandomRefined(rfid_id, purity)
+    db.add(db_refined)
+    await db.commit()
+    _indexItem(ItemKind.refined, db_refined)
+    return db_refined
+
+
+async def createRandomSample(db: AsyncSession, rfid_id: str, vulgarity: Optional[Vulgarity]):
+    db_sample = _createRandomSample(vulgarity)
+    db_sample.rfid_id = rfid_id
+
+    db.add(db_sample)
+    await db.commit()
+    _indexItem(ItemKind.sample, db_sample)
+    return db_sample
+
+
+async def getSampleByRFID(db: AsyncSession, rfid_id: str) -> Optional[models.KrystaliumSample]:
+    return await db.scalar(select(models.KrystaliumSample).where(models.KrystaliumSample.rfid_id == rfid_id).limit(1))
+
+
+async def deleteSampleByRFID(db: AsyncSession, rfid_id: str) -> bool:
+    """
+    :param db:
+    :param rfid_id: The RFID id of the sample that needs to be deleted
+    :return: True if it was able to delete it, false otherwise
+    """
+    sample = await getSampleByRFID(db, rfid_id)
+    if sample:
+        await db.delete(sample)
+        await db.commit()
+        _forgetItem(rfid_id)
+        return True
+    return False
+
+
+async def deleteRefinedKrystaliumByRFID(db: AsyncSession, rfid_id: str) -> bool:
+    """
+    :param db:
+    :param rfid_id: The RFID id of the refined Krystalium that needs to be deleted
+    :return: True if it was able to delete it, false otherwise
+    """
+    refined = await getRefineKrystaliumByRFID(db, rfid_id)
+    if refined:
+        await db.delete(refined)
+        await db.commit()
+        _forgetItem(rfid_id)
+        return True
+    return False
+
+
+async def getRefineKrystaliumByRFID(db: AsyncSession, rfid_id: str) -> Optional[models.RefinedKrystalium]:
+    return await db.scalar(select(models.RefinedKrystalium).where(models.RefinedKrystalium.rfid_id == rfid_id).limit(1))
+
+
+async def getBloodSampleByRFID(db: AsyncSession, rfid_id: str) -> Optional[models.BloodSample]:
+    return await db.scalar(select(models.BloodSample).where(models.BloodSample.rfid_id == rfid_id).limit(1))
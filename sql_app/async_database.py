@@ -0,0 +1,17 @@
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from .database import SQLALCHEMY_DATABASE_URL, DATABASE_PROFILE, applyDatabasePragmas, getDatabaseProfile, \
+    getPoolArguments
+
+# Same database as the sync engine, but through an async driver
+ASYNC_SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+
+_profile = getDatabaseProfile(DATABASE_PROFILE)
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    connect_args={"cached_statements": _profile["cached_statements"]},
+    **getPoolArguments(ASYNC_SQLALCHEMY_DATABASE_URL, DATABASE_PROFILE),
+)
+applyDatabasePragmas(async_engine.sync_engine, DATABASE_PROFILE)
+# Objects can't lazily load expired attributes in async code, so keep them loaded after a commit
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
@@ -0,0 +1,375 @@
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.openapi.docs import (
+    get_redoc_html,
+    get_swagger_ui_html,
+    get_swagger_ui_oauth2_redirect_html
+)
+from fastapi.responses import Response, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import async_crud as crud, models, schemas, serialization
+from .crud import response_cache
+from .async_database import AsyncSessionLocal, async_engine
+from .endpoints import LIST_DESCRIPTION, EVENTS_DESCRIPTION, EVENTS_RESPONSES, checkRFIDKind, findRFIDErrors, \
+    planRandomSamples, removeFailedItems, checkSamplesCanBeRefined, cacheItemResponse, createItemResponseOfKind, \
+    createItemResponse, createListResponse, createStreamingListResponse, createEventStream, getLastEvent
+from .purity_simulator import simulatePurity
+from .schemas import BadRequestError, BulkItemError, NotFoundError, ItemKind
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with async_engine.begin() as connection:
+        await connection.run_sync(models.Base.metadata.create_all)
+    # Load it before serving anything, so nothing that is created in the meantime can be missed
+    async with AsyncSessionLocal() as db:
+        await crud.loadRFIDIndex(db)
+    yield
+    await async_engine.dispose()
+
+
+# The same API as main, but with async endpoints on an async engine. Everything that doesn't touch the database is
+# shared with it (see endpoints), as are the RFID index, the response cache and the change feed. It's experimental;
+# benchmark it against main (see benchmark) before using it at an event. Run it with `uvicorn sql_app.async_main:app`
+# Mount the swagger & redoc stuff locally.
+app = FastAPI(docs_url = None, redoc_url= None, lifespan = lifespan)
+app.mount("/static", StaticFiles(directory="static"), name="static")
+
+
+# Dependency
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def checkUniqueRFID(rfid_id: str):
+    checkRFIDKind(rfid_id, crud.getKindByRFID(rfid_id))
+
+
+def checkUniqueRFIDs(rfid_ids: List[Optional[str]]) -> List[BulkItemError]:
+    """
+    See endpoints.findRFIDErrors
+    """
+    return findRFIDErrors(rfid_ids, crud.getKindsByRFID([rfid_id for rfid_id in rfid_ids if rfid_id is not None]))
+
+
+async def createInBulk(db, items: List, create_items: Callable) -> dict:
+    """
+    See main.createInBulk
+    :param create_items: async_crud function that creates a list of items
+    """
+    errors = checkUniqueRFIDs([item.rfid_id for item in items])
+    valid_items = removeFailedItems(items, errors)
+    return {"created": await create_items(db, valid_items) if valid_items else [], "errors": errors}
+
+
+async def getItemResponse(db, rfid_id: str) -> Optional[Tuple[ItemKind, bytes]]:
+    """
+    See main.getItemResponse
+    """
+    cached = response_cache.get(rfid_id)
+    if cached is not None:
+        return cached
+    generation = response_cache.getGeneration()
+    return cacheItemResponse(rfid_id, await crud.getItemByRFID(db, rfid_id), generation)
+
+
+async def getItemResponseOfKind(db, rfid_id: str, kind: ItemKind, not_found_message: str) -> Response:
+    return createItemResponseOfKind(await getItemResponse(db, rfid_id), kind, not_found_message)
+
+
+async def streamItems(kind: ItemKind, after_id: Optional[int], limit: Optional[int]) -> AsyncIterator[bytes]:
+    # This runs after the request's own session has been closed, so it needs its own.
+    async with AsyncSessionLocal() as db:
+        async for rows in crud.iterateItemRows(db, kind, serialization.item_fields[kind], after_id, limit):
+            yield serialization.dumpItemsNDJSON(kind, rows)
+
+
+async def listItems(db, kind: ItemKind, after_id: Optional[int], limit: Optional[int], stream: bool) -> Response:
+    if stream:
+        return createStreamingListResponse(streamItems(kind, after_id, limit))
+    return createListResponse(kind, await crud.getItemRows(db, kind, serialization.item_fields[kind], after_id, limit))
+
+
+@app.get("/docs", include_in_schema=False)
+async def custom_swagger_ui_html():
+    # This function is required to locally host the swagger API. This means that the docs will work without internet
+    # connection
+    return get_swagger_ui_html(
+        openapi_url=app.openapi_url,
+        title=app.title + " - Swagger UI",
+        oauth2_redirect_url=app.swagger_ui_oauth2_redirect_url,
+        swagger_js_url="/static/swagger-ui-bundle.js",
+        swagger_css_url="/static/swagger-ui.css",
+    )
+
+
+@app.get(app.swagger_ui_oauth2_redirect_url, include_in_schema=False)
+async def swagger_ui_redirect():
+    # This function is required to locally host the swagger API. This means that the docs will work without internet
+    # connection
+    return get_swagger_ui_oauth2_redirect_html()
+
+
+@app.get("/redoc", include_in_schema=False)
+async def redoc_html():
+    # This function is required to locally host the swagger API. This means that the docs will work without internet
+    # connection
+    return get_redoc_html(
+        openapi_url=app.openapi_url,
+        title=app.title + " - ReDoc",
+        redoc_js_url="/static/redoc.standalone.js",
+    )
+
+
+@app.get("/items/{rfid_id}", response_model=schemas.Item, responses={404: {"model": NotFoundError}})
+async def get_item_by_rfid(rfid_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Get whatever the RFID belongs to (raw Krystalium sample, refined Krystalium or blood sample), together with what
+    kind of item it is.
+    """
+    return createItemResponse(await getItemResponse(db, rfid_id), rfid_id)
+
+
+@app.get("/events", response_class=StreamingResponse, responses=EVENTS_RESPONSES, description=EVENTS_DESCRIPTION)
+async def get_events(request: Request, after: Optional[str] = None, last_event_id: Optional[str] = Header(None)):
+    return createEventStream(request, after, last_event_id)
+
+
+@app.get("/events/sequence")
+async def get_events_sequence():
+    """
+    The id (and its epoch and sequence number) of the last event that was published, to subscribe to /events after
+    """
+    return getLastEvent()
+
+
+@app.get("/cache/stats", response_model=schemas.ResponseCacheStats)
+async def get_response_cache_stats():
+    """
+    How well the cache of the responses for single RFIDs is doing. Its size is set with CRYSTAL_RESPONSE_CACHE_SIZE.
+    """
+    return response_cache.getStats()
+
+
+@app.post("/simulation/purity", response_model=schemas.PuritySimulationResult)
+async def simulate_purity(simulation: schemas.PuritySimulationRequest):
+    """
+    Simulate how likely every vulgarity (of random samples) and purity (of random refined Krystalium) is. Opposing
+    actions and targets can be given to see what changing them would do; it doesn't change the ones that are used.
+    """
+    # Millions of draws keep the CPU busy for a while, which shouldn't hold up the event loop
+    return await run_in_threadpool(simulatePurity, simulation.num_draws, simulation.action_pairs,
+                                   simulation.target_pairs, simulation.seed)
+
+
+@app.get("/samples/", response_model=list[schemas.KrystaliumSample], description="Get all known (raw) Krystalium samples" + LIST_DESCRIPTION)
+async def get_all_krystalium_samples(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), stream: bool = False,
+                                     db: AsyncSession = Depends(get_db)):
+    return await listItems(db, ItemKind.sample, after_id, limit, stream)
+
+
+@app.get("/samples/{rfid_id}", response_model=schemas.KrystaliumSample, responses={404: {"model": NotFoundError}})
+async def get_krystalium_sample_by_rfid(rfid_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Get a single raw Krystalium sample by RFID. If it doesn't find anything, you might want to try checking if it's
+    refined Krystalium instead!
+    """
+    return await getItemResponseOfKind(db, rfid_id, ItemKind.sample, f"Krystalium Sample with RFID [{rfid_id}] was not found")
+
+
+@app.delete("/samples/{rfid_id}", responses={404: {"model": NotFoundError}})
+async def delete_krystalium_sample_by_rfid(rfid_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Get a single refined Krystalium by RFID. If it doesn't find anything, you might want to try checking if it's
+    a sample instead!
+    """
+    success = await crud.deleteSampleByRFID(db, rfid_id=rfid_id)
+    if not success:
+        raise HTTPException(status_code=404, detail=f"Krystalium sample with RFID [{rfid_id}] was not found")
+
+
+@app.post("/samples/", response_model=schemas.KrystaliumSample, responses={400: {"model": BadRequestError}})
+async def create_krystalium_sample(sample: schemas.KrystaliumSampleCreate, db: AsyncSession = Depends(get_db)):
+    """
+    Add a new (raw) Krystalium sample to the DB.
+    """
+    # Check if the RFID is already used for a sample
+    checkUniqueRFID(sample.rfid_id)
+    return await crud.createSample(db=db, sample=sample)
+
+
+@app.post("/samples/bulk", response_model=schemas.BulkCreateResult[schemas.KrystaliumSample])
+async def create_krystalium_samples(samples: List[schemas.KrystaliumSampleCreate], db: AsyncSession = Depends(get_db)):
+    """
+    Add a batch of (raw) Krystalium samples to the DB, in a single transaction. Samples whose RFID is already in use
+    (or used more than once in the batch) are skipped and reported in the errors.
+    """
+    return await createInBulk(db, samples, crud.createSamples)
+
+
+@app.post("/sample/random/", response_model=schemas.KrystaliumSample, responses={400: {"model": BadRequestError}})
+async def create_random_krystalium_sample(sample: schemas.RandomKrystaliumSampleCreate, db: AsyncSession = Depends(get_db)):
+    """
+    Create random raw sample(s) of Krystalium.
+    If the num_samples is larger than 1, you can't set the RFID, as each sample needs a unique one. The num_samples
+    parameter is just there for debug purposes. If it is set, all the RFID tags will get a random rfid tag.
+
+    If the vulgarity is not set, it will create a completely random sample. If it is set, its guaranteed to create a
+    sample of that Vulgarity (or multiple samples if the num samples is set)
+    """
+    if sample.num_samples > 1 and sample.rfid_id is not None:
+        raise HTTPException(status_code=400, detail=f"Impossible to create multiple RFID samples with the same RFID id")
+
+    if sample.num_samples == 1:
+        checkUniqueRFID(str(sample.rfid_id))
+        return await crud.createRandomSample(db, rfid_id = str(sample.rfid_id), vulgarity = sample.vulgarity)
+    else:
+        result = None
+        for i in range(0, sample.num_samples):
+            result = await crud.createRandomSample(db, rfid_id = str(uuid.uuid4()), vulgarity = sample.vulgarity)
+        return result
+
+
+@app.post("/sample/random/bulk", response_model=schemas.BulkCreateResult[schemas.KrystaliumSample])
+async def create_random_krystalium_samples(samples: List[schemas.RandomKrystaliumSampleCreate], db: AsyncSession = Depends(get_db)):
+    """
+    Create a batch of random raw samples of Krystalium, in a single transaction. Every entry works like it does for
+    /sample/random/. Entries that can't be created are skipped and reported in the errors (with their position in the
+    request).
+    """
+    errors = checkUniqueRFIDs([sample.rfid_id for sample in samples])
+    rfid_ids_and_vulgarities, errors = planRandomSamples(samples, errors)
+    created = await crud.createRandomSamples(db, rfid_ids_and_vulgarities) if rfid_ids_and_vulgarities else []
+    return {"created": created, "errors": errors}
+
+
+@app.post("/refined/random/", response_model=schemas.RefinedKrystalium, responses={400: {"model": BadRequestError}})
+async def create_random_refined_krystalium(refined_create: schemas.RandomRefinedKrystaliumCreate, db: AsyncSession = Depends(get_db)):
+    """
+    Create random refined Krystalium.
+    If the num_samples is larger than 1, you can't set the RFID, as each sample needs a unique one. The num_samples
+    parameter is just there for debug purposes. If it is set, all the RFID tags will get a random rfid tag.
+
+    Note that the random purity is done by creating random samples. This means that a low purity is *much* more common
+    than a high one!
+    """
+    if refined_create.num_samples > 1 and refined_create.rfid_id is not None:
+        raise HTTPException(status_code=400, detail=f"Impossible to create multiple refined krystalium with the same RFID id")
+
+    if refined_create.num_samples == 1:
+        checkUniqueRFID(str(refined_create.rfid_id))
+        return await crud.createRandomRefined(db, rfid_id = str(refined_create.rfid_id), purity = refined_create.purity)
+    else:
+        result = None
+        for i in range(0, refined_create.num_samples):
+            result = await crud.createRandomRefined(db, rfid_id = str(uuid.uuid4()), purity = refined_create.purity)
+        return result
+
+
+@app.get("/refined/", response_model=list[schemas.RefinedKrystalium], description="Get a list of all known refined Krystalium" + LIST_DESCRIPTION)
+async def get_all_refined_krystalium(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), stream: bool = False,
+                                     db: AsyncSession = Depends(get_db)):
+    return await listItems(db, ItemKind.refined, after_id, limit, stream)
+
+
+@app.get("/refined/{rfid_id}", response_model=schemas.RefinedKrystalium, responses={404: {"model": NotFoundError}})
+async def get_refined_krystalium_by_rfid(rfid_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Get a single refined Krystalium by RFID. If it doesn't find anything, you might want to try checking if it's
+    a sample instead!
+    """
+    return await getItemResponseOfKind(db, rfid_id, ItemKind.refined, f"Refined Krystalium with RFID [{rfid_id}] was not found")
+
+
+@app.delete("/refined/{rfid_id}", responses={404: {"model": NotFoundError}})
+async def delete_refined_krystalium_by_rfid(rfid_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Get a single refined Krystalium by RFID. If it doesn't find anything, you might want to try checking if it's
+    a sample instead!
+    """
+    success = await crud.deleteRefinedKrystaliumByRFID(db, rfid_id=rfid_id)
+    if not success:
+        raise HTTPException(status_code=404, detail=f"Refined Krystalium with RFID [{rfid_id}] was not found")
+
+
+@app.post("/refined/", response_model=schemas.RefinedKrystalium, responses={400: {"model": BadRequestError}})
+async def create_refined_krystalium(refined_krystalium: schemas.RefinedKrystaliumCreate, db: AsyncSession = Depends(get_db)):
+    # Check if the RFID is already used for a sample
+    checkUniqueRFID(refined_krystalium.rfid_id)
+    return await crud.createRefinedKrystalium(db=db, refined_krystalium=refined_krystalium)
+
+
+@app.post("/refined/bulk", response_model=schemas.BulkCreateResult[schemas.RefinedKrystalium])
+async def create_refined_krystaliums(refined_krystaliums: List[schemas.RefinedKrystaliumCreate], db: AsyncSession = Depends(get_db)):
+    """
+    Add a batch of refined Krystalium to the DB, in a single transaction. Refined Krystalium whose RFID is already in
+    use (or used more than once in the batch) is skipped and reported in the errors.
+    """
+    return await createInBulk(db, refined_krystaliums, crud.createRefinedKrystaliums)
+
+
+@app.post("/refined/create_from_samples/", response_model=schemas.RefinedKrystalium, responses={400: {"model": BadRequestError}})
+async def create_refined_crystalium_from_samples(creation_request: schemas.RefinedKrystaliumFromSample, db: AsyncSession = Depends(get_db)):
+    """
+    Combine two raw Krystalium samples into a refined Krystalium sample.
+
+    This can fail in the following situations:
+
+    1. You try to use the exact same sample (so scan same RFID twice)
+    2. You use two samples that have the exact same properties
+    3. The refined krystalium rfid is already used by something else
+    """
+    if creation_request.positive_sample_rfid_id == creation_request.negative_sample_rfid_id:
+        raise HTTPException(status_code=400,
+                            detail=f"You must use different samples")
+
+    db_positive_sample = await crud.getSampleByRFID(db, rfid_id=creation_request.positive_sample_rfid_id)
+    db_negative_sample = await crud.getSampleByRFID(db, rfid_id=creation_request.negative_sample_rfid_id)
+    checkSamplesCanBeRefined(creation_request, db_positive_sample, db_negative_sample)
+    # The provided refined Krystalium rfid id must be unique
+    checkUniqueRFID(creation_request.refined_krystalium_rfid_id)
+
+    # We're good to go! Unless another station just used one of the samples, which is only known once they're depleted.
+    db_refined = await crud.createRefinedKrystaliumFromSamples(db, negative_sample=db_negative_sample, positive_sample=db_positive_sample, refined_rfid_id=creation_request.refined_krystalium_rfid_id)
+    if db_refined is None:
+        raise HTTPException(status_code=400, detail=f"One of the samples was depleted by another refinement, so it can't be used")
+    return db_refined
+
+
+@app.get("/blood", response_model = list[schemas.BloodSample], responses = {400: {"model": BadRequestError}}, description = "Get a list of all blood samples." + LIST_DESCRIPTION)
+async def get_all_blood_samples(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), stream: bool = False,
+                                db: AsyncSession = Depends(get_db)):
+    return await listItems(db, ItemKind.blood, after_id, limit, stream)
+
+
+@app.post("/blood", response_model = schemas.BloodSample, responses = {400: {"model": BadRequestError}})
+async def create_blood_sample(sample: schemas.BloodSampleCreate, db: AsyncSession = Depends(get_db)):
+    """
+    Create a new blood sample.
+    """
+    checkUniqueRFID(sample.rfid_id)
+    return await crud.createBloodSample(db = db, blood_sample = sample)
+
+
+@app.post("/blood/bulk", response_model = schemas.BulkCreateResult[schemas.BloodSample])
+async def create_blood_samples(samples: List[schemas.BloodSampleCreate], db: AsyncSession = Depends(get_db)):
+    """
+    Create a batch of blood samples, in a single transaction. Samples whose RFID is already in use (or used more than
+    once in the batch) are skipped and reported in the errors.
+    """
+    return await createInBulk(db, samples, crud.createBloodSamples)
+
+
+@app.get("/blood/{rfid_id}", response_model = schemas.BloodSample, responses = {404: {"model": NotFoundError}})
+async def get_blood_sample_by_rfid(rfid_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Get a single blood sample by RFID ID.
+    """
+    return await getItemResponseOfKind(db, rfid_id, ItemKind.blood, f"Blood sample with RFID [{rfid_id}] was not found")
@@ -0,0 +1,334 @@
+"""
+Compare the sync (main) and async (async_main) API under concurrent load.
+
+    python -m sql_app.benchmark --clients 1 10 100 --requests 2000
+
+Both apps are called in-process (no network) and run against the same temporary database, which is seeded with
+samples first. Every client looks up random samples (GET /samples/{rfid_id}), and a fraction of the requests creates a
+new sample instead (POST /samples/). Both apps answer lookups from the same response cache, which is emptied before
+every run; set CRYSTAL_RESPONSE_CACHE_SIZE=0 to compare them without it.
+
+Or compare the read and write throughput of the database performance profiles (see database.py), directly on crud:
+
+    python -m sql_app.benchmark --mode profiles
+
+Or compare the cost per row of sending out a list of samples through the models and pydantic, against the fast path in
+serialization:
+
+    python -m sql_app.benchmark --mode serialization --rows 5000
+
+Or have stations refine at the same time. First all stations try to refine the same two samples at once (only one of
+them may succeed), then every station refines its own samples, to see how throughput goes with more stations:
+
+    python -m sql_app.benchmark --mode refinement --clients 1 2 4 8 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import httpx
+
+
+def _percentile(ordered: List[float], percentile: float) -> float:
+    return ordered[min(int(len(ordered) * percentile / 100), len(ordered) - 1)]
+
+
+def _createSampleData(rfid_id: str) -> Dict:
+    return {"rfid_id": rfid_id, "positive_action": "Heating", "positive_target": "Flesh",
+            "negative_action": "Cooling", "negative_target": "Mind"}
+
+
+async def _runClient(client: httpx.AsyncClient, num_requests: int, rfid_ids: List[str], write_ratio: float,
+                     rng: random.Random, latencies: List[float]) -> int:
+    errors = 0
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        try:
+            if rng.random() < write_ratio:
+                response = await client.post("/samples/", json=_createSampleData(str(uuid.uuid4())))
+            else:
+                response = await client.get(f"/samples/{rng.choice(rfid_ids)}")
+            failed = response.status_code != 200
+        except Exception:
+            # The app is called in-process, so server errors (eg; the connection pool running dry) end up here
+            failed = True
+        latencies.append((time.perf_counter() - start) * 1000)
+        if failed:
+            errors += 1
+    return errors
+
+
+async def _runScenario(app, num_clients: int, num_requests: int, rfid_ids: List[str], write_ratio: float,
+                       seed: int) -> Dict:
+    latencies: List[float] = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        requests_per_client = max(num_requests // num_clients, 1)
+        start = time.perf_counter()
+        errors = await asyncio.gather(*[_runClient(client, requests_per_client, rfid_ids, write_ratio,
+                                                   random.Random(seed + index), latencies)
+                                        for index in range(num_clients)])
+        duration = time.perf_counter() - start
+    latencies.sort()
+    return {"clients": num_clients,
+            "requests": len(latencies),
+            "errors": sum(errors),
+            "requests_per_second": len(latencies) / duration,
+            "p50_ms": _percentile(latencies, 50),
+            "p95_ms": _percentile(latencies, 95),
+            "p99_ms": _percentile(latencies, 99),
+            "max_ms": latencies[-1]}
+
+
+async def runBenchmark(clients: List[int], num_requests: int, num_seed_samples: int, write_ratio: float,
+                       seed: int) -> Dict[str, List[Dict]]:
+    # Only import the apps now, as they pick up the database url when they are imported.
+    from . import crud, main, async_main, schemas
+    from .async_database import async_engine
+    from .database import SessionLocal
+
+    rfid_ids = [str(uuid.uuid4()) for _ in range(num_seed_samples)]
+    with SessionLocal() as db:
+        for rfid_id in rfid_ids:
+            crud.createSample(db, schemas.KrystaliumSampleCreate(**_createSampleData(rfid_id)))
+
+    max_cached = crud.response_cache.getStats()["max_entries"]
+    print(f"Comparing GET /samples/{{rfid_id}} and POST /samples/ ({write_ratio:.0%} of the requests), "
+          f"response cache {f'of {max_cached} entries' if max_cached > 0 else 'off'} for both")
+    results = {"sync": [], "async": []}
+    for name, app in (("sync", main.app), ("async", async_main.app)):
+        for num_clients in clients:
+            # Otherwise whichever app runs later finds the lookups of the earlier one in the cache
+            crud.response_cache.clear()
+            result = await _runScenario(app, num_clients, num_requests, rfid_ids, write_ratio, seed)
+            results[name].append(result)
+            print(f"{name:>5} {num_clients:>4} clients: {result['requests_per_second']:8.1f} req/s, "
+                  f"p50 {result['p50_ms']:7.1f} ms, p95 {result['p95_ms']:7.1f} ms, p99 {result['p99_ms']:7.1f} ms"
+                  f"{', ' + str(result['errors']) + ' errors' if result['errors'] else ''}")
+    await async_engine.dispose()
+    return results
+
+
+def _runProfileBenchmark(url: str, profile_name: str, num_operations: int, num_threads: int,
+                         write_ratio: float, seed: int) -> Dict:
+    from . import crud, models, schemas
+    from .database import createDatabaseEngine, createSessionMaker
+
+    database_engine = createDatabaseEngine(url, profile_name)
+    models.Base.metadata.create_all(bind=database_engine)
+    session_maker = createSessionMaker(database_engine)
+    rng = random.Random(seed)
+    result = {"profile": profile_name}
+
+    # Every write is its own transaction, like it is in the API
+    rfid_ids = [str(uuid.uuid4()) for _ in range(num_operations)]
+    start = time.perf_counter()
+    with session_maker() as db:
+        for rfid_id in rfid_ids:
+            crud.createSample(db, schemas.KrystaliumSampleCreate(**_createSampleData(rfid_id)))
+    result["writes_per_second"] = num_operations / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with session_maker() as db:
+        for _ in range(num_operations):
+            crud.getSampleByRFID(db, rng.choice(rfid_ids))
+    result["reads_per_second"] = num_operations / (time.perf_counter() - start)
+
+    def runMixedOperation(index: int) -> bool:
+        operation_rng = random.Random(seed + index)
+        try:
+            with session_maker() as db:
+                if operation_rng.random() < write_ratio:
+                    crud.createSample(db, schemas.KrystaliumSampleCreate(**_createSampleData(str(uuid.uuid4()))))
+                else:
+                    crud.getSampleByRFID(db, operation_rng.choice(rfid_ids))
+            return True
+        except Exception:
+            # Most likely "database is locked"
+            return False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        succeeded = list(executor.map(runMixedOperation, range(num_operations)))
+    result["mixed_operations_per_second"] = num_operations / (time.perf_counter() - start)
+    result["mixed_errors"] = succeeded.count(False)
+    database_engine.dispose()
+    return result
+
+
+def runProfileBenchmark(profile_names: List[str], directory: str, num_operations: int, num_threads: int,
+                        write_ratio: float, seed: int) -> List[Dict]:
+    results = []
+    for profile_name in profile_names:
+        # Every profile gets a fresh database, as the journal mode sticks to the database file
+        url = f"sqlite:///{os.path.join(directory, f'benchmark_{profile_name}.db')}"
+        result = _runProfileBenchmark(url, profile_name, num_operations, num_threads, write_ratio, seed)
+        results.append(result)
+        print(f"{profile_name:>8}: {result['writes_per_second']:8.1f} writes/s, {result['reads_per_second']:8.1f} reads/s, "
+              f"{result['mixed_operations_per_second']:8.1f} mixed ops/s with {num_threads} threads"
+              f"{', ' + str(result['mixed_errors']) + ' errors' if result['mixed_errors'] else ''}")
+    return results
+
+
+def _createSamplePair(index: int, prefix: str) -> List[Dict]:
+    # Two samples that are different enough to be refined
+    positive = _createSampleData(f"{prefix}-{index}-positive")
+    negative = dict(_createSampleData(f"{prefix}-{index}-negative"), positive_action="Cooling", negative_action="Heating")
+    return [positive, negative]
+
+
+async def _refine(client: httpx.AsyncClient, pair: List[Dict], refined_rfid_id: str) -> int:
+    response = await client.post("/refined/create_from_samples/",
+                                 json={"positive_sample_rfid_id": pair[0]["rfid_id"],
+                                       "negative_sample_rfid_id": pair[1]["rfid_id"],
+                                       "refined_krystalium_rfid_id": refined_rfid_id})
+    return response.status_code
+
+
+async def runRefinementBenchmark(stations: List[int], num_refinements: int, contention_rounds: int) -> Dict:
+    from . import crud, main, schemas
+    from .database import SessionLocal
+
+    def createPairs(prefix: str, count: int) -> List[List[Dict]]:
+        pairs = [_createSamplePair(index, prefix) for index in range(count)]
+        with SessionLocal() as db:
+            crud.createSamples(db, [schemas.KrystaliumSampleCreate(**sample) for pair in pairs for sample in pair])
+        return pairs
+
+    results = {"contention": [], "throughput": []}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for num_stations in stations:
+            # Every station tries the same pair at the same moment
+            wins = []
+            for round_index, pair in enumerate(createPairs(f"contention-{num_stations}", contention_rounds)):
+                status_codes = await asyncio.gather(*[_refine(client, pair, f"refined-{num_stations}-{round_index}-{station}")
+                                                      for station in range(num_stations)])
+                wins.append(status_codes.count(200))
+            result = {"stations": num_stations, "rounds": contention_rounds,
+                      "rounds_with_one_winner": wins.count(1), "most_winners": max(wins)}
+            results["contention"].append(result)
+            print(f"{num_stations:>4} stations on the same samples: exactly one winner in "
+                  f"{result['rounds_with_one_winner']}/{contention_rounds} rounds (most winners: {result['most_winners']})")
+
+        for num_stations in stations:
+            # Every station has samples of its own
+            pairs = createPairs(f"throughput-{num_stations}", num_refinements)
+            refinements_per_station = num_refinements // num_stations
+
+            async def runStation(station: int) -> int:
+                failures = 0
+                for pair_index in range(station * refinements_per_station, (station + 1) * refinements_per_station):
+                    if await _refine(client, pairs[pair_index], f"refined-throughput-{num_stations}-{pair_index}") != 200:
+                        failures += 1
+                return failures
+
+            start = time.perf_counter()
+            failures = await asyncio.gather(*[runStation(station) for station in range(num_stations)])
+            duration = time.perf_counter() - start
+            result = {"stations": num_stations, "refinements": refinements_per_station * num_stations,
+                      "refinements_per_second": refinements_per_station * num_stations / duration,
+                      "errors": sum(failures)}
+            results["throughput"].append(result)
+            print(f"{num_stations:>4} stations on their own samples: {result['refinements_per_second']:8.1f} refinements/s"
+                  f"{', ' + str(result['errors']) + ' errors' if result['errors'] else ''}")
+    return results
+
+
+def _timePerRow(function, num_rows: int, repeats: int) -> float:
+    # Best of the repeats, in microseconds per row
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best / num_rows * 1e6
+
+
+def runSerializationBenchmark(num_rows: int, repeats: int, seed: int) -> Dict[str, float]:
+    from pydantic import TypeAdapter
+    from . import crud, models, serialization
+    from .database import SessionLocal, engine
+    from .schemas import ItemKind, KrystaliumSample
+
+    models.Base.metadata.create_all(bind=engine)
+    crud.random_sample_generator.seed(seed)
+    with SessionLocal() as db:
+        crud.createRandomSamples(db, [(str(uuid.uuid4()), None) for _ in range(num_rows)])
+
+    adapter = TypeAdapter(List[KrystaliumSample])
+    field_names = serialization.item_fields[ItemKind.sample]
+
+    def throughModels():
+        # What the list endpoints used to do (and FastAPI does for a response_model)
+        with SessionLocal() as db:
+            samples = adapter.validate_python(crud.getAllKrystaliumSamples(db), from_attributes=True)
+            return adapter.dump_json(samples)
+
+    def throughRows():
+        with SessionLocal() as db:
+            return serialization.dumpItems(ItemKind.sample, crud.getItemRows(db, ItemKind.sample, field_names))
+
+    assert json.loads(throughModels()) == json.loads(throughRows()), "Both paths should give the same result"
+    results = {"rows": num_rows, "models_us_per_row": _timePerRow(throughModels, num_rows, repeats)}
+    orjson_enabled = serialization.orjson_enabled
+    serialization.orjson_enabled = False
+    results["rows_json_us_per_row"] = _timePerRow(throughRows, num_rows, repeats)
+    serialization.orjson_enabled = orjson_enabled
+    if orjson_enabled:
+        results["rows_orjson_us_per_row"] = _timePerRow(throughRows, num_rows, repeats)
+    for name, value in results.items():
+        if name != "rows":
+            print(f"{name[:-len('_us_per_row')]:>11}: {value:6.2f} us per row "
+                  f"({results['models_us_per_row'] / value:4.1f}x)")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the sync against the async API, or the database profiles")
+    parser.add_argument("--mode", choices=["api", "profiles", "serialization", "refinement"], default="api")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100],
+                        help="Number of concurrent clients to run each benchmark with")
+    parser.add_argument("--requests", type=int, default=2000, help="Total number of requests per benchmark")
+    parser.add_argument("--seed-samples", type=int, default=500, help="Samples in the database before starting")
+    parser.add_argument("--write-ratio", type=float, default=0.1, help="Fraction of the requests that create a sample")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="Also write the results as JSON to this file")
+    parser.add_argument("--profile", default=None,
+                        help="Database profile to run the API with (api mode), defaults to CRYSTAL_DATABASE_PROFILE")
+    parser.add_argument("--profiles", nargs="+", default=None,
+                        help="Database profiles to compare (profiles mode), defaults to all of them")
+    parser.add_argument("--threads", type=int, default=8, help="Threads for the mixed workload (profiles mode)")
+    parser.add_argument("--rows", type=int, default=5000, help="Number of samples to send out (serialization mode)")
+    parser.add_argument("--repeats", type=int, default=5, help="Take the best of this many runs (serialization mode)")
+    parser.add_argument("--rounds", type=int, default=50,
+                        help="How often all stations fight over the same samples (refinement mode)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Never benchmark against the real database
+        os.environ["CRYSTAL_DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        if args.profile:
+            os.environ["CRYSTAL_DATABASE_PROFILE"] = args.profile
+        if args.mode == "profiles":
+            from .database import DATABASE_PROFILES
+            benchmark_results = runProfileBenchmark(args.profiles or list(DATABASE_PROFILES), directory, args.requests,
+                                                    args.threads, args.write_ratio, args.seed)
+        elif args.mode == "serialization":
+            benchmark_results = runSerializationBenchmark(args.rows, args.repeats, args.seed)
+        elif args.mode == "refinement":
+            benchmark_results = asyncio.run(runRefinementBenchmark(args.clients, args.requests, args.rounds))
+        else:
+            benchmark_results = asyncio.run(runBenchmark(args.clients, args.requests, args.seed_samples,
+                                                         args.write_ratio, args.seed))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(benchmark_results, f, indent=2)
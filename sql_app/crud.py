@@ -1,11 +1,19 @@
-from typing import Optional
+import os
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
 
-from . import models, schemas
+from . import models, schemas, serialization
+from .ChangeFeed import ChangeFeed
 from .OpposingTraitController import OpposingTraitController
+from .RandomSampleGenerator import RandomSampleGenerator
+from .RFIDIndex import RFIDIndex
+from .ResponseCache import ResponseCache
 
-from .schemas import Vulgarity, Target, Action, Purity
+from .schemas import Vulgarity, Target, Action, Purity, ItemKind
 import random
 
 
@@ -31,56 +39,208 @@ opposing_actions.addPair(Action.lightening, Action.encumbering)
 
 action_list = list(Action)
 target_list = list(Target)
+vulgarity_list = list(Vulgarity)
+purity_list = list(Purity)
 
+# Position of every trait in the lists above. The enums are strings, so the plain values work as keys just as well.
+action_indices = {action: index for index, action in enumerate(action_list)}
+target_indices = {target: index for index, target in enumerate(target_list)}
+vulgarity_indices = {vulgarity: index for index, vulgarity in enumerate(vulgarity_list)}
 
-def getAllKrystaliumSamples(db: Session):
-    return db.query(models.KrystaliumSample).all()
+opposing_action_matrix = opposing_actions.getMatrix(action_list)
+opposing_target_matrix = opposing_targets.getMatrix(target_list)
 
 
-def getAllRefinedKrystalium(db: Session):
-    return db.query(models.RefinedKrystalium).all()
+def createVulgarityTable(action_matrix: np.ndarray, target_matrix: np.ndarray) -> np.ndarray:
+    """
+    Work out the vulgarity of every possible sample.
+    :param action_matrix: Which actions are opposed (see OpposingTraitController.getMatrix)
+    :param target_matrix: Which targets are opposed
+    :return: Index into vulgarity_list, by [positive action, negative action, positive target, negative target]
+    """
+    positive_action = np.arange(len(action_list))[:, None, None, None]
+    negative_action = np.arange(len(action_list))[None, :, None, None]
+    positive_target = np.arange(len(target_list))[None, None, :, None]
+    negative_target = np.arange(len(target_list))[None, None, None, :]
+
+    action_invariant = positive_action == negative_action
+    target_invariant = positive_target == negative_target
+    action_opposing = action_matrix[positive_action, negative_action]
+    target_opposing = target_matrix[positive_target, negative_target]
+
+    # The first rule that matches wins
+    rules = [
+        (action_invariant & target_invariant, Vulgarity.precious),
+        # Semi-precious: one of the pairs is the same, the other one decides if it's high or low
+        (target_invariant & action_opposing, Vulgarity.high_semi_precious),
+        (target_invariant, Vulgarity.low_semi_precious),
+        (action_invariant & target_opposing, Vulgarity.high_semi_precious),
+        (action_invariant, Vulgarity.low_semi_precious),
+        (action_opposing & target_opposing, Vulgarity.high_mundane),
+        (action_opposing | target_opposing, Vulgarity.low_mundane),
+    ]
+    shape = (len(action_list), len(action_list), len(target_list), len(target_list))
+    conditions = [np.broadcast_to(condition, shape) for condition, _ in rules]
+    return np.select(conditions, [vulgarity_indices[vulgarity] for _, vulgarity in rules],
+                     default=vulgarity_indices[Vulgarity.vulgar]).astype(np.int8)
+
+
+def _createPurityTable() -> np.ndarray:
+    """
+    :return: Index into purity_list, by [vulgarity index of one sample, vulgarity index of the other]
+    """
+    scores = np.array([Vulgarity.getScore(vulgarity) for vulgarity in vulgarity_list])
+    # Purity scores start at 2 (two vulgar samples)
+    return (scores[:, None] + scores[None, :] - 2).astype(np.int8)
 
 
-def getAllBloodSamples(db: Session):
-    return db.query(models.BloodSample).all()
+vulgarity_table = createVulgarityTable(opposing_action_matrix, opposing_target_matrix)
+purity_table = _createPurityTable()
 
+# Used when creating many random samples at once
+random_sample_generator = RandomSampleGenerator(vulgarity_table, action_list, target_list, vulgarity_list)
 
-def findVulgarityFromProperties(positive_action, negative_action, positive_target, negative_target, *args, **kwargs) -> Vulgarity:
-    target_invariant = positive_target == negative_target
-    action_invariant = positive_action == negative_action
+item_models = {ItemKind.sample: models.KrystaliumSample,
+               ItemKind.refined: models.RefinedKrystalium,
+               ItemKind.blood: models.BloodSample}
 
-    if target_invariant and action_invariant:
-        return Vulgarity.precious
+# Which RFID belongs to what. Every function here that creates or deletes something keeps it up to date.
+rfid_index = RFIDIndex()
+# Serialized responses per RFID. Every function here that creates, changes or deletes something invalidates it.
+response_cache = ResponseCache(int(os.environ.get("CRYSTAL_RESPONSE_CACHE_SIZE", 4096)))
+# Everything that is created, deleted or depleted, for the clients that keep their own copy
+change_feed = ChangeFeed()
 
-    is_action_opposing = opposing_actions.areOpposed(positive_action, negative_action)
 
-    is_target_opposing = opposing_targets.areOpposed(positive_target.value, negative_target)
+def loadRFIDIndex(db: Session) -> None:
+    rfid_index.load({kind: db.execute(select(model.rfid_id, model.id)).all() for kind, model in item_models.items()})
 
-    if target_invariant or action_invariant:
-        # It's semi-precious, but now to figure out if it's high or low!
-        if target_invariant:
-            return Vulgarity.high_semi_precious if is_action_opposing else Vulgarity.low_semi_precious
-        else:
-            return Vulgarity.high_semi_precious if is_target_opposing else Vulgarity.low_semi_precious
 
-    if not is_action_opposing and not is_target_opposing:
-        return Vulgarity.vulgar
+def _getRFIDIndex(db: Session) -> RFIDIndex:
+    if not rfid_index.isLoaded():
+        loadRFIDIndex(db)
+    return rfid_index
 
-    # Now to find out if it's high or low mundane
-    if is_action_opposing and is_target_opposing:
-        return Vulgarity.high_mundane
 
-    # Only one left, so it's low mundane
-    return Vulgarity.low_mundane
+def _indexItem(kind: ItemKind, db_item) -> None:
+    rfid_index.add(db_item.rfid_id, kind, db_item.id)
+    response_cache.invalidate(db_item.rfid_id)
+    change_feed.publish(ChangeFeed.CREATED, kind, db_item.rfid_id, serialization.modelToDict(kind, db_item))
 
 
-def createSample(db: Session, sample: schemas.KrystaliumSampleCreate):
+def _forgetItem(rfid_id: str) -> None:
+    entry = rfid_index.get(rfid_id)
+    rfid_index.remove(rfid_id)
+    response_cache.invalidate(rfid_id)
+    change_feed.publish(ChangeFeed.DELETED, entry[0] if entry else None, rfid_id)
+
+
+def _depleteItems(*rfid_ids: str) -> None:
+    response_cache.invalidate(*rfid_ids)
+    for rfid_id in rfid_ids:
+        change_feed.publish(ChangeFeed.DEPLETED, ItemKind.sample, rfid_id)
+
+
+def getKindByRFID(db: Session, rfid_id: str) -> Optional[ItemKind]:
+    entry = _getRFIDIndex(db).get(rfid_id)
+    return entry[0] if entry else None
+
+
+def getKindsByRFID(db: Session, rfid_ids: Iterable[str]) -> Dict[str, ItemKind]:
+    """
+    Check a whole batch of RFIDs at once.
+    :return: The kind of item of every RFID that is already in use
+    """
+    index = _getRFIDIndex(db)
+    return {rfid_id: entry[0] for rfid_id in rfid_ids if (entry := index.get(rfid_id)) is not None}
+
+
+def getItemByRFID(db: Session, rfid_id: str) -> Optional[Tuple[ItemKind, object]]:
+    """
+    Find whatever the RFID belongs to, with a single primary key lookup.
+    :return: The kind of item and the item, or None if the RFID isn't known
+    """
+    index = _getRFIDIndex(db)
+    entry = index.get(rfid_id)
+    if entry is None:
+        return None
+    kind, item_id = entry
+    db_item = db.get(item_models[kind], item_id)
+    if db_item is None:
+        # Deleted behind our back. Whoever deleted it takes care of the cache and the change feed; a lookup only
+        # fixes the index.
+        index.remove(rfid_id)
+        return None
+    return kind, db_item
+
+
+def _selectPage(model, after_id: Optional[int], limit: Optional[int], field_names: Optional[List[str]] = None):
+    # Keyset pagination; the id is indexed, so getting a page doesn't get slower the further along it is.
+    statement = select(*[getattr(model, name) for name in field_names]) if field_names else select(model)
+    statement = statement.order_by(model.id)
+    if after_id is not None:
+        statement = statement.where(model.id > after_id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def getAllKrystaliumSamples(db: Session, after_id: Optional[int] = None, limit: Optional[int] = None):
+    return db.scalars(_selectPage(models.KrystaliumSample, after_id, limit)).all()
+
+
+def getAllRefinedKrystalium(db: Session, after_id: Optional[int] = None, limit: Optional[int] = None):
+    return db.scalars(_selectPage(models.RefinedKrystalium, after_id, limit)).all()
+
+
+def getAllBloodSamples(db: Session, after_id: Optional[int] = None, limit: Optional[int] = None):
+    return db.scalars(_selectPage(models.BloodSample, after_id, limit)).all()
+
+
+def getItemRows(db: Session, kind: ItemKind, field_names: List[str], after_id: Optional[int] = None,
+                limit: Optional[int] = None) -> List[Tuple]:
+    """
+    Get just the given columns of the items of a kind, as plain tuples. Much cheaper than loading the models when
+    they are only going to be sent out.
+    """
+    return db.execute(_selectPage(item_models[kind], after_id, limit, field_names)).all()
+
+
+def iterateItemRows(db: Session, kind: ItemKind, field_names: List[str], after_id: Optional[int] = None,
+                    limit: Optional[int] = None, chunk_size: int = 500) -> Iterator[List[Tuple]]:
+    """
+    Go through the items of a kind in chunks (like getItemRows), without loading all of them at once.
+    :return: Lists of at most chunk_size rows, in order of id
+    """
+    statement = _selectPage(item_models[kind], after_id, limit, field_names).execution_options(yield_per=chunk_size)
+    yield from db.execute(statement).partitions()
+
+
+def findVulgarityFromProperties(positive_action, negative_action, positive_target, negative_target, *args, **kwargs) -> Vulgarity:
+    # See createVulgarityTable for how it's decided
+    return vulgarity_list[vulgarity_table[action_indices[positive_action], action_indices[negative_action],
+                                          target_indices[positive_target], target_indices[negative_target]]]
+
+
+def findPurityFromVulgarities(vulgarity_1, vulgarity_2) -> Purity:
+    """
+    The purity of refined Krystalium made from two samples with the given vulgarities
+    """
+    return purity_list[purity_table[vulgarity_indices[vulgarity_1], vulgarity_indices[vulgarity_2]]]
+
+
+def _createSample(sample: schemas.KrystaliumSampleCreate) -> models.KrystaliumSample:
     # Just unpack all of it, we don't use any diffrent names, and DRY is a thing y'all.
     db_sample = models.KrystaliumSample(**sample.__dict__)
     db_sample.vulgarity = findVulgarityFromProperties(**sample.__dict__)
+    return db_sample
+
+
+def createSample(db: Session, sample: schemas.KrystaliumSampleCreate):
+    db_sample = _createSample(sample)
     db.add(db_sample)
     db.commit()
-    db.refresh(db_sample)
+    _indexItem(ItemKind.sample, db_sample)
     return db_sample
 
 
@@ -89,7 +249,7 @@ def createRefinedKrystalium(db: Session, refined_krystalium: schemas.RefinedKrys
     db_refined_krystalium = models.RefinedKrystalium(**refined_krystalium.__dict__)
     db.add(db_refined_krystalium)
     db.commit()
-    db.refresh(db_refined_krystalium)
+    _indexItem(ItemKind.refined, db_refined_krystalium)
     return db_refined_krystalium
 
 
@@ -97,11 +257,88 @@ def createBloodSample(db: Session, blood_sample: schemas.BloodSampleCreate):
     db_blood_sample = models.BloodSample(**blood_sample.__dict__)
     db.add(db_blood_sample)
     db.commit()
-    db.refresh(db_blood_sample)
+    _indexItem(ItemKind.blood, db_blood_sample)
     return db_blood_sample
 
 
-def createRefinedKrystaliumFromSamples(db: Session, positive_sample: models.KrystaliumSample, negative_sample: models.KrystaliumSample, refined_rfid_id: str):
+def createItems(db: Session, kind: ItemKind, db_items: List) -> List:
+    """
+    Add a batch of items of the same kind in a single transaction. They are inserted together (executemany), instead
+    of a round trip per item.
+    :param db_items: The (not yet added) models to insert
+    :return: The inserted items
+    """
+    db.add_all(db_items)
+    db.commit()
+    for db_item in db_items:
+        _indexItem(kind, db_item)
+    return db_items
+
+
+def createSamples(db: Session, samples: List[schemas.KrystaliumSampleCreate]) -> List[models.KrystaliumSample]:
+    return createItems(db, ItemKind.sample, [_createSample(sample) for sample in samples])
+
+
+def createRefinedKrystaliums(db: Session, refined_krystaliums: List[schemas.RefinedKrystaliumCreate]) -> List[models.RefinedKrystalium]:
+    return createItems(db, ItemKind.refined, [models.RefinedKrystalium(**refined_krystalium.__dict__)
+                                              for refined_krystalium in refined_krystaliums])
+
+
+def createBloodSamples(db: Session, blood_samples: List[schemas.BloodSampleCreate]) -> List[models.BloodSample]:
+    return createItems(db, ItemKind.blood, [models.BloodSample(**blood_sample.__dict__) for blood_sample in blood_samples])
+
+
+def createRandomSamples(db: Session, rfid_ids_and_vulgarities: List[Tuple[str, Optional[Vulgarity]]]) -> List[models.KrystaliumSample]:
+    return createItems(db, ItemKind.sample, _createRandomSamples(rfid_ids_and_vulgarities))
+
+
+def _createRandomSamples(rfid_ids_and_vulgarities: List[Tuple[str, Optional[Vulgarity]]]) -> List[models.KrystaliumSample]:
+    # The traits of all samples with the same vulgarity are drawn in one go
+    positions_by_vulgarity = defaultdict(list)
+    for position, (_, vulgarity) in enumerate(rfid_ids_and_vulgarities):
+        positions_by_vulgarity[vulgarity].append(position)
+
+    db_samples = [None] * len(rfid_ids_and_vulgarities)
+    for vulgarity, positions in positions_by_vulgarity.items():
+        columns = {name: values.tolist() for name, values in random_sample_generator.generate(len(positions), vulgarity).items()}
+        for i, position in enumerate(positions):
+            db_samples[position] = models.KrystaliumSample(rfid_id=rfid_ids_and_vulgarities[position][0],
+                                                           **{name: values[i] for name, values in columns.items()})
+    return db_samples
+
+
+def createRefinedKrystaliumFromSamples(db: Session, positive_sample: models.KrystaliumSample, negative_sample: models.KrystaliumSample, refined_rfid_id: str) -> Optional[models.RefinedKrystalium]:
+    """
+    Refine two samples, which depletes them. Another station could be using the same samples at the same time, so
+    they are only depleted if they aren't yet, in the same transaction that creates the refined Krystalium.
+    :return: The refined Krystalium, or None if one of the samples was depleted in the meantime
+    """
+    if db.execute(_depleteSamples(positive_sample.id, negative_sample.id)).rowcount != 2:
+        db.rollback()
+        return None
+    db_refined = _createRefinedKrystaliumFromSamples(positive_sample, negative_sample, refined_rfid_id)
+    db.add(db_refined)
+    db.commit()
+    _depleteItems(positive_sample.rfid_id, negative_sample.rfid_id)
+    _indexItem(ItemKind.refined, db_refined)
+    return db_refined
+
+
+def _depleteSamples(*sample_ids: int):
+    """
+    The UPDATE that marks the samples as depleted, but only the ones that weren't already. If the number of rows it
+    changed is less than the number of samples, one of them was used already.
+    """
+    return update(models.KrystaliumSample)\
+        .where(models.KrystaliumSample.id.in_(sample_ids), models.KrystaliumSample.depleted.is_not(True))\
+        .values(depleted=True)
+
+
+def _createRefinedKrystaliumFromSamples(positive_sample: models.KrystaliumSample, negative_sample: models.KrystaliumSample, refined_rfid_id: str) -> models.RefinedKrystalium:
+    """
+    Create the refined Krystalium for two samples and mark the samples as depleted, without adding it to the database
+    or comitting it.
+    """
     db_refined = models.RefinedKrystalium()
     db_refined.primary_action = positive_sample.positive_action
     db_refined.primary_target = negative_sample.negative_target
@@ -113,11 +350,7 @@ def createRefinedKrystaliumFromSamples(db: Session, positive_sample: models.Krys
     positive_sample.depleted = True
     negative_sample.depleted = True
 
-    db_refined.purity = Purity.getByScore(Vulgarity.getScore(positive_sample.vulgarity) + Vulgarity.getScore(negative_sample.vulgarity))
-
-    db.add(db_refined)
-    db.commit()
-    db.refresh(db_refined)
+    db_refined.purity = findPurityFromVulgarities(positive_sample.vulgarity, negative_sample.vulgarity)
     return db_refined
 
 
@@ -174,6 +407,17 @@ def createInvariantActionPair():
 
 
 def createRandomRefined(db: Session, rfid_id: str, purity: Optional[Purity]):
+    db_refined = _createRandomRefined(rfid_id, purity)
+    db.add(db_refined)
+    db.commit()
+    _indexItem(ItemKind.refined, db_refined)
+    return db_refined
+
+
+def _createRandomRefined(rfid_id: str, purity: Optional[Purity]) -> models.RefinedKrystalium:
+    """
+    Create random refined Krystalium without adding it to the database or comitting it.
+    """
     db_refined = models.RefinedKrystalium()
 
     if purity is None:
@@ -187,14 +431,12 @@ def createRandomRefined(db: Session, rfid_id: str, purity: Optional[Purity]):
         db_refined.secondary_action = negative_sample.negative_action
         db_refined.secondary_target = positive_sample.positive_target
 
-        db_refined.purity = Purity.getByScore(Vulgarity.getScore(positive_sample.vulgarity) + Vulgarity.getScore(negative_sample.vulgarity))
+        db_refined.purity = findPurityFromVulgarities(positive_sample.vulgarity, negative_sample.vulgarity)
     else:
         db_refined.primary_action, db_refined.secondary_action = createRandomActionPair()
         db_refined.primary_target, db_refined.secondary_target = createRandomTargetPair()
         db_refined.purity = purity
     db_refined.rfid_id = rfid_id
-    db.add(db_refined)
-    db.commit()
     return db_refined
 
 
@@ -261,7 +503,7 @@ def createRandomSample(db: Session, rfid_id: str, vulgarity: Optional[Vulgarity]
 
     db.add(db_sample)
     db.commit()
-    db.refresh(db_sample)
+    _indexItem(ItemKind.sample, db_sample)
     return db_sample
 
 
@@ -280,6 +522,7 @@ def deleteSampleByRFID(db: Session, rfid_id: str) -> bool:
     if sample:
         db.delete(sample)
         db.commit()
+        _forgetItem(rfid_id)
         return True
     return False
 
@@ -294,6 +537,7 @@ def deleteRefinedKrystaliumByRFID(db: Session, rfid_id: str) -> bool:
     if refined:
         db.delete(refined)
         db.commit()
+        _forgetItem(rfid_id)
         return True
     return False
 
@@ -0,0 +1,204 @@
+"""
+What the sync (main) and async (async_main) API have in common: everything about the endpoints that doesn't touch the
+database, so the two only differ in how they get to it.
+"""
+import uuid
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple, Union
+
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+from . import crud, models, schemas, serialization
+from .schemas import BulkItemError, ItemKind, Vulgarity, rfid_in_use_messages
+
+LIST_DESCRIPTION = """
+
+Results are ordered by id. Use `limit` to get them in pages, and pass the id of the last item of a page as `after_id`
+to get the next one.
+
+With `stream` set, the items are sent as newline delimited JSON (one item per line) while they are read from the
+database, so even the full list never has to be in memory at once.
+"""
+
+EVENTS_DESCRIPTION = """
+Stream what happens to the items as server-sent events: created (with the item), deleted and depleted (when a
+sample is used for refining). Every event has an id, `<epoch>:<sequence>`; the sequence only goes up, and the
+epoch changes when the server restarts.
+
+To keep a copy of everything up to date, get the id of the last event (/events/sequence), then all the items, and
+then subscribe with `after` set to that id. Events that happened in between are sent again, so applying them
+should not mind seeing something twice. After losing the connection, subscribe again with the id of the last
+event (browsers do this on their own with the Last-Event-ID header). If those events are no longer known (or the
+server restarted), a reset event is sent instead; get all the items again and continue from its id.
+
+Events are published once the change is committed, so when the same RFID is created and deleted at the same
+time, their events can arrive in the other order. Look the RFID up if that matters.
+"""
+
+EVENTS_RESPONSES = {200: {"content": {"text/event-stream": {}}, "description": "Server-sent events, until the client disconnects"}}
+
+
+def checkRFIDKind(rfid_id: str, kind: Optional[ItemKind]) -> None:
+    """
+    :param kind: What the RFID is already used for, if anything
+    """
+    if kind is not None:
+        raise HTTPException(status_code=400, detail=rfid_in_use_messages[kind].format(rfid_id))
+
+
+def findRFIDErrors(rfid_ids: List[Optional[str]], kinds: dict) -> List[BulkItemError]:
+    """
+    Check the RFIDs of a whole batch, both against what is already registered and against each other.
+    :param rfid_ids: The RFID of every item in the batch (None for items that get a random one)
+    :param kinds: The kind of item of every RFID that is already in use
+    :return: An error for every item whose RFID can't be used
+    """
+    errors = []
+    seen = set()
+    for index, rfid_id in enumerate(rfid_ids):
+        if rfid_id is None:
+            continue
+        if rfid_id in kinds:
+            errors.append(BulkItemError(index=index, rfid_id=rfid_id, detail=rfid_in_use_messages[kinds[rfid_id]].format(rfid_id)))
+        elif rfid_id in seen:
+            errors.append(BulkItemError(index=index, rfid_id=rfid_id, detail=f"The RFID id [{rfid_id}] is used more than once in this request"))
+        seen.add(rfid_id)
+    return errors
+
+
+def planRandomSamples(samples: List[schemas.RandomKrystaliumSampleCreate],
+                      errors: List[BulkItemError]) -> Tuple[List[Tuple[str, Optional[Vulgarity]]], List[BulkItemError]]:
+    """
+    Work out which random samples of a batch to create (see /sample/random/bulk).
+    :param errors: The errors of the RFIDs of the batch (see findRFIDErrors)
+    :return: The RFID and vulgarity of every sample to create, and the errors of the entries that can't be created
+    """
+    errors = list(errors)
+    for index, sample in enumerate(samples):
+        if sample.num_samples > 1 and sample.rfid_id is not None:
+            errors.append(BulkItemError(index=index, rfid_id=sample.rfid_id, detail="Impossible to create multiple RFID samples with the same RFID id"))
+    failed = {error.index for error in errors}
+
+    rfid_ids_and_vulgarities = []
+    for index, sample in enumerate(samples):
+        if index in failed:
+            continue
+        if sample.rfid_id is not None:
+            rfid_ids_and_vulgarities.append((sample.rfid_id, sample.vulgarity))
+        else:
+            rfid_ids_and_vulgarities.extend((str(uuid.uuid4()), sample.vulgarity) for _ in range(sample.num_samples))
+    return rfid_ids_and_vulgarities, sorted(errors, key=lambda error: error.index)
+
+
+def removeFailedItems(items: List, errors: List[BulkItemError]) -> List:
+    failed = {error.index for error in errors}
+    return [item for index, item in enumerate(items) if index not in failed]
+
+
+def checkSamplesCanBeRefined(creation_request: schemas.RefinedKrystaliumFromSample,
+                             db_positive_sample: Optional[models.KrystaliumSample],
+                             db_negative_sample: Optional[models.KrystaliumSample]) -> None:
+    """
+    Raise if the samples can't be refined (see /refined/create_from_samples/). The RFID of the refined Krystalium is
+    checked separately.
+    """
+    if not db_positive_sample:
+        raise HTTPException(status_code=400, detail=f"Krystalium Sample for the positive slot with RFID [{creation_request.positive_sample_rfid_id}] was not found")
+
+    if db_positive_sample.depleted:
+        raise HTTPException(status_code=400, detail=f"The positive sample is depleted, so it can't be used")
+
+    if not db_negative_sample:
+        raise HTTPException(status_code=400,
+                            detail=f"Krystalium Sample for the negative slot with RFID [{creation_request.negative_sample_rfid_id}] was not found")
+
+    if db_negative_sample.depleted:
+        raise HTTPException(status_code=400, detail=f"The negative sample is depleted, so it can't be used")
+
+    # Check if the samples are exactly the same (eg have same targets & actions)
+    if db_positive_sample.positive_target == db_negative_sample.positive_target and \
+            db_positive_sample.negative_target == db_negative_sample.negative_target and \
+            db_positive_sample.positive_action == db_negative_sample.positive_action and \
+            db_positive_sample.negative_action == db_negative_sample.negative_action:
+        raise HTTPException(status_code=400,
+                            detail=f"The samples must have at least one property different from each other")
+
+
+def serializeItem(kind: ItemKind, db_item) -> bytes:
+    return serialization.item_schemas[kind].model_validate(db_item, from_attributes=True).model_dump_json().encode("utf-8")
+
+
+def cacheItemResponse(rfid_id: str, result: Optional[Tuple[ItemKind, object]], generation: int) -> Optional[Tuple[ItemKind, bytes]]:
+    """
+    Serialize an item that was looked up, and put it in the response cache.
+    :param result: The kind of item and the item, or None if the RFID isn't known
+    :param generation: The generation of the cache from before the item was looked up
+    """
+    if result is None:
+        return None
+    kind, db_item = result
+    response = serializeItem(kind, db_item)
+    crud.response_cache.put(rfid_id, kind, response, generation)
+    return kind, response
+
+
+def createItemResponseOfKind(result: Optional[Tuple[ItemKind, bytes]], kind: ItemKind, not_found_message: str) -> Response:
+    if result is None or result[0] != kind:
+        raise HTTPException(status_code=404, detail=not_found_message)
+    # Already serialized, so it's sent as is (skipping the response_model)
+    return Response(content=result[1], media_type="application/json")
+
+
+def createItemResponse(result: Optional[Tuple[ItemKind, bytes]], rfid_id: str) -> Response:
+    """
+    The response of /items, with the kind of the item next to it
+    """
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"Nothing with RFID [{rfid_id}] was found")
+    kind, item_response = result
+    return Response(content=b'{"kind":"' + kind.value.encode("utf-8") + b'","item":' + item_response + b"}",
+                    media_type="application/json")
+
+
+def createListResponse(kind: ItemKind, rows: Iterable[Tuple]) -> Response:
+    # Lists can be long, so they skip the models and pydantic (see serialization)
+    return Response(content=serialization.dumpItems(kind, rows), media_type="application/json")
+
+
+def createStreamingListResponse(chunks: Union[Iterator[bytes], AsyncIterator[bytes]]) -> StreamingResponse:
+    """
+    :param chunks: The items as newline delimited JSON, a chunk of them at a time
+    """
+    return StreamingResponse(chunks, media_type="application/x-ndjson")
+
+
+def formatServerSentEvent(event: Optional[dict]) -> bytes:
+    if event is None:
+        # Nothing happened for a while; a comment keeps the connection (and any proxy in between) alive
+        return b": keepalive\n\n"
+    return b"id: %s\nevent: %s\ndata: %s\n\n" % (event["id"].encode("utf-8"), event["type"].encode("utf-8"),
+                                                    serialization.dumps(event))
+
+
+def createEventStream(request: Request, after: Optional[str], last_event_id: Optional[str]) -> StreamingResponse:
+    """
+    The response of /events
+    """
+    if after is None:
+        after = last_event_id
+
+    async def generateEvents():
+        async for event in crud.change_feed.iterateEvents(after):
+            if await request.is_disconnected():
+                break
+            yield formatServerSentEvent(event)
+
+    return StreamingResponse(generateEvents(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def getLastEvent() -> dict:
+    """
+    The response of /events/sequence
+    """
+    return {"id": crud.change_feed.getLastEventId(), "epoch": crud.change_feed.getEpoch(),
+            "sequence": crud.change_feed.getSequence()}
@@ -0,0 +1,311 @@
+"""
+Load test the API with a number of stations that all do their own thing at the same time.
+
+    python -m sql_app.loadtest --stations 50 --duration 30
+    python -m sql_app.loadtest --stations 20 --requests 200 --scenario my_event.txt --json results.json
+    python -m sql_app.loadtest --url http://localhost:8000 --stations 20 --duration 30
+
+Without --url, the app is called in-process, on a temporary database. With it, the requests go to an API that is
+already running (and to its database, so don't point it at the one of an event!).
+
+What the stations do is described by a scenario: a line per operation with how often it happens relative to the others.
+Empty lines and lines starting with # are ignored:
+
+    # A station at an event mostly scans cards
+    70 scan
+    10 create
+    10 refine
+    5 delete
+    5 list
+
+The operations are:
+    scan           GET /items/{rfid_id}, of a random known item
+    scan_sample    GET /samples/{rfid_id}, of a random sample
+    create         POST /samples/, with random traits
+    create_random  POST /sample/random/
+    create_bulk    POST /samples/bulk, with 100 samples
+    refine         POST /refined/create_from_samples/, with two samples that are not depleted
+    delete         DELETE /samples/{rfid_id}, of a sample that isn't depleted
+    list           GET /samples/?limit=100, from a random point
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from .benchmark import _percentile
+from .schemas import Action, Target
+
+DEFAULT_SCENARIO = """
+70 scan
+10 create
+10 refine
+5 delete
+5 list
+"""
+
+OPERATION_ENDPOINTS = {
+    "scan": "GET /items/{rfid_id}",
+    "scan_sample": "GET /samples/{rfid_id}",
+    "create": "POST /samples/",
+    "create_random": "POST /sample/random/",
+    "create_bulk": "POST /samples/bulk",
+    "refine": "POST /refined/create_from_samples/",
+    "delete": "DELETE /samples/{rfid_id}",
+    "list": "GET /samples/",
+}
+
+
+def parseScenario(text: str) -> Dict[str, float]:
+    """
+    :return: The weight of every operation in the scenario
+    """
+    weights = {}
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        weight, _, operation = line.partition(" ")
+        operation = operation.strip()
+        if operation not in OPERATION_ENDPOINTS:
+            raise ValueError(f"Unknown operation {operation!r} on line {line_number}, should be one of {list(OPERATION_ENDPOINTS)}")
+        weights[operation] = weights.get(operation, 0) + float(weight)
+    if not weights or sum(weights.values()) <= 0:
+        raise ValueError("The scenario doesn't do anything")
+    return weights
+
+
+class LoadTestState:
+    """
+    What the stations know about the database, so they only ask for things that exist. All stations run on the same
+    event loop, so this doesn't need a lock.
+    """
+    def __init__(self, rng: random.Random) -> None:
+        self.rng = rng
+        self.samples: List[str] = []  # RFIDs of samples that aren't depleted (or being used) yet
+        self.items: List[str] = []  # RFIDs of everything, including what was deleted since (scanning those is a 404)
+
+    def addSamples(self, rfid_ids: List[str]) -> None:
+        self.samples.extend(rfid_ids)
+        self.items.extend(rfid_ids)
+
+    def takeSample(self) -> Optional[str]:
+        """
+        Remove a random sample from the pool, so no other station uses it at the same time
+        """
+        if not self.samples:
+            return None
+        index = self.rng.randrange(len(self.samples))
+        self.samples[index], self.samples[-1] = self.samples[-1], self.samples[index]
+        return self.samples.pop()
+
+
+def createSampleData(rng: random.Random, rfid_id: Optional[str] = None) -> Dict:
+    return {"rfid_id": rfid_id or str(uuid.uuid4()),
+            "positive_action": rng.choice(list(Action)).value, "positive_target": rng.choice(list(Target)).value,
+            "negative_action": rng.choice(list(Action)).value, "negative_target": rng.choice(list(Target)).value}
+
+
+async def runOperation(client: httpx.AsyncClient, operation: str, state: LoadTestState) -> Optional[bool]:
+    """
+    :return: If the request succeeded, or None if there was nothing to do it with (eg; no samples left to refine)
+    """
+    rng = state.rng
+    if operation in ("scan", "scan_sample"):
+        if not state.items:
+            return None
+        path = "/items/" if operation == "scan" else "/samples/"
+        response = await client.get(path + rng.choice(state.items))
+        # Scanning something that was deleted is a normal thing to happen
+        return response.status_code in (200, 404)
+    if operation == "create":
+        sample = createSampleData(rng)
+        response = await client.post("/samples/", json=sample)
+        if response.status_code == 200:
+            state.addSamples([sample["rfid_id"]])
+        return response.status_code == 200
+    if operation == "create_random":
+        rfid_id = str(uuid.uuid4())
+        response = await client.post("/sample/random/", json={"rfid_id": rfid_id})
+        if response.status_code == 200:
+            state.addSamples([rfid_id])
+        return response.status_code == 200
+    if operation == "create_bulk":
+        samples = [createSampleData(rng) for _ in range(100)]
+        response = await client.post("/samples/bulk", json=samples)
+        if response.status_code == 200:
+            state.addSamples([sample["rfid_id"] for sample in response.json()["created"]])
+        return response.status_code == 200
+    if operation == "refine":
+        if len(state.samples) < 2:
+            return None
+        positive, negative = state.takeSample(), state.takeSample()
+        refined_rfid_id = str(uuid.uuid4())
+        response = await client.post("/refined/create_from_samples/",
+                                     json={"positive_sample_rfid_id": positive, "negative_sample_rfid_id": negative,
+                                           "refined_krystalium_rfid_id": refined_rfid_id})
+        if response.status_code == 200:
+            state.items.append(refined_rfid_id)
+        elif response.status_code == 400 and "property different" in response.text:
+            # Happens to have the same traits, so both can still be used with something else
+            state.samples.extend([positive, negative])
+            return True
+        return response.status_code == 200
+    if operation == "delete":
+        rfid_id = state.takeSample()
+        if rfid_id is None:
+            return None
+        response = await client.delete(f"/samples/{rfid_id}")
+        return response.status_code == 200
+    if operation == "list":
+        response = await client.get("/samples/", params={"limit": 100, "after_id": rng.randrange(max(len(state.items), 1))})
+        return response.status_code == 200
+    raise ValueError(f"Unknown operation {operation}")
+
+
+async def _runStation(client: httpx.AsyncClient, state: LoadTestState, operations: List[str], weights: List[float],
+                      num_requests: Optional[int], stop_at: Optional[float], think_time: float,
+                      latencies: Dict[str, List[float]], errors: Dict[str, int]) -> None:
+    done = 0
+    while (num_requests is None or done < num_requests) and (stop_at is None or time.perf_counter() < stop_at):
+        operation = state.rng.choices(operations, weights)[0]
+        start = time.perf_counter()
+        try:
+            succeeded = await runOperation(client, operation, state)
+        except Exception:
+            # In-process, server errors end up here (and connection errors against a real server)
+            succeeded = False
+        if succeeded is not None:
+            latencies[operation].append((time.perf_counter() - start) * 1000)
+            if not succeeded:
+                errors[operation] += 1
+            done += 1
+        if think_time:
+            await asyncio.sleep(state.rng.expovariate(1 / think_time))
+
+
+def _summarize(latencies: List[float], num_errors: int, duration: float) -> Dict:
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"requests": 0, "errors": 0, "error_rate": 0.0, "requests_per_second": 0.0}
+    return {"requests": len(latencies),
+            "errors": num_errors,
+            "error_rate": num_errors / len(latencies),
+            "requests_per_second": len(latencies) / duration,
+            "p50_ms": _percentile(latencies, 50),
+            "p95_ms": _percentile(latencies, 95),
+            "p99_ms": _percentile(latencies, 99),
+            "max_ms": latencies[-1]}
+
+
+async def runLoadTest(weights: Dict[str, float], num_stations: int, num_requests: Optional[int] = None,
+                      duration: Optional[float] = None, think_time: float = 0.0, num_seed_samples: int = 500,
+                      url: Optional[str] = None, seed: int = 0) -> Dict:
+    """
+    :param weights: How often each operation happens, relative to the others (see parseScenario)
+    :param num_stations: How many stations send requests at the same time
+    :param num_requests: How many requests every station sends. If not set, they keep going for the duration.
+    :param duration: Seconds to keep going for
+    :param think_time: Average seconds between the requests of a station
+    :param num_seed_samples: Samples to create before starting
+    :param url: The API to test. If not set, the app is called in-process.
+    :return: Throughput, latency percentiles and error rates, in total and per operation
+    """
+    if num_requests is None and duration is None:
+        raise ValueError("Either the number of requests or the duration needs to be set")
+    if url is None:
+        # Only import the app now, as it picks up the database url when it's imported.
+        from . import main
+        transport = httpx.ASGITransport(app=main.app)
+        client = httpx.AsyncClient(transport=transport, base_url="http://loadtest")
+    else:
+        client = httpx.AsyncClient(base_url=url, timeout=30, limits=httpx.Limits(max_connections=num_stations))
+
+    state = LoadTestState(random.Random(seed))
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    async with client:
+        for start in range(0, num_seed_samples, 1000):
+            samples = [createSampleData(state.rng) for _ in range(min(1000, num_seed_samples - start))]
+            response = await client.post("/samples/bulk", json=samples)
+            response.raise_for_status()
+            state.addSamples([sample["rfid_id"] for sample in response.json()["created"]])
+
+        operations, operation_weights = list(weights), list(weights.values())
+        start = time.perf_counter()
+        stop_at = start + duration if duration is not None else None
+        stations = []
+        for station in range(num_stations):
+            # Every station gets its own random numbers, but they share what they know about the database
+            station_state = LoadTestState(random.Random(seed + station + 1))
+            station_state.samples, station_state.items = state.samples, state.items
+            stations.append(_runStation(client, station_state, operations, operation_weights, num_requests, stop_at,
+                                        think_time, latencies, errors))
+        await asyncio.gather(*stations)
+        elapsed = time.perf_counter() - start
+
+    all_latencies = [latency for operation_latencies in latencies.values() for latency in operation_latencies]
+    return {"config": {"stations": num_stations, "requests_per_station": num_requests, "duration": duration,
+                       "think_time": think_time, "seed_samples": num_seed_samples, "url": url, "scenario": weights},
+            "duration": elapsed,
+            "total": _summarize(all_latencies, sum(errors.values()), elapsed),
+            "operations": {operation: dict(endpoint=OPERATION_ENDPOINTS[operation],
+                                           **_summarize(latencies[operation], errors[operation], elapsed))
+                           for operation in operations}}
+
+
+def _printResults(results: Dict) -> None:
+    for name, summary in [("total", results["total"])] + list(results["operations"].items()):
+        if not summary["requests"]:
+            print(f"{name:>14}: no requests")
+            continue
+        print(f"{name:>14}: {summary['requests']:7d} requests, {summary['requests_per_second']:8.1f} req/s, "
+              f"p50 {summary['p50_ms']:7.1f} ms, p95 {summary['p95_ms']:7.1f} ms, p99 {summary['p99_ms']:7.1f} ms, "
+              f"{summary['error_rate'] * 100:5.1f}% errors")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the API with a number of stations at the same time")
+    parser.add_argument("--stations", type=int, default=10, help="Number of stations sending requests at the same time")
+    parser.add_argument("--requests", type=int, default=None, help="Requests per station")
+    parser.add_argument("--duration", type=float, default=None, help="Seconds to run for (default 10, unless --requests is set)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Average seconds between the requests of a station")
+    parser.add_argument("--scenario", default=None, help="Scenario file (see the top of this file), defaults to mostly scans")
+    parser.add_argument("--seed-samples", type=int, default=500, help="Samples in the database before starting")
+    parser.add_argument("--url", default=None, help="Test the API running here, instead of in-process on a temporary database")
+    parser.add_argument("--profile", default=None, help="Database profile to run the in-process API with")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="Also write the results as JSON to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    if args.scenario:
+        with open(args.scenario) as f:
+            scenario = parseScenario(f.read())
+    else:
+        scenario = parseScenario(DEFAULT_SCENARIO)
+    run_duration = args.duration if args.duration is not None or args.requests is not None else 10.0
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.url is None:
+            # Never load test the real database
+            os.environ["CRYSTAL_DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'loadtest.db')}"
+            if args.profile:
+                os.environ["CRYSTAL_DATABASE_PROFILE"] = args.profile
+        load_test_results = asyncio.run(runLoadTest(scenario, args.stations, args.requests, run_duration,
+                                                    args.think_time, args.seed_samples, args.url, args.seed))
+
+    if args.json == "-":
+        print(json.dumps(load_test_results, indent=2))
+    else:
+        _printResults(load_test_results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(load_test_results, f, indent=2)
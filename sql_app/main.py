@@ -1,19 +1,28 @@
 import uuid
+from typing import Callable, Iterator, List, Optional, Tuple
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
 from fastapi.openapi.docs import (
     get_redoc_html,
     get_swagger_ui_html,
     get_swagger_ui_oauth2_redirect_html
 )
+from fastapi.responses import Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy.orm import Session
 
-from . import crud, models, schemas
+from . import crud, models, schemas, serialization
+from .purity_simulator import simulatePurity
 from .database import SessionLocal, engine
-from .schemas import BadRequestError, NotFoundError
+from .endpoints import LIST_DESCRIPTION, EVENTS_DESCRIPTION, EVENTS_RESPONSES, checkRFIDKind, findRFIDErrors, \
+    planRandomSamples, removeFailedItems, checkSamplesCanBeRefined, cacheItemResponse, createItemResponseOfKind, \
+    createItemResponse, createListResponse, createStreamingListResponse, createEventStream, getLastEvent
+from .schemas import BadRequestError, BulkItemError, NotFoundError, ItemKind
 
 models.Base.metadata.create_all(bind=engine)
+# Load it before serving anything, so nothing that is created in the meantime can be missed
+with SessionLocal() as _db:
+    crud.loadRFIDIndex(_db)
 
 # Mount the swagger & redoc stuff locally.
 app = FastAPI(docs_url = None, redoc_url= None)
@@ -30,15 +39,53 @@ def get_db():
 
 
 def checkUniqueRFID(db, rfid_id: str):
-    db_sample = crud.getSampleByRFID(db, rfid_id=rfid_id)
-    if db_sample:
-        raise HTTPException(status_code=400, detail=f"A Krystalium sample with the RFID id [{rfid_id}] has already been registered")
+    checkRFIDKind(rfid_id, crud.getKindByRFID(db, rfid_id))
 
-    # Check if the RFID is already used for a refined Krystalium
-    db_refined = crud.getRefineKrystaliumByRFID(db, rfid_id=rfid_id)
-    if db_refined:
-        raise HTTPException(status_code=400,
-                            detail=f"A refined Krystalium with the RFID id [{rfid_id}] has already been registered")
+
+def checkUniqueRFIDs(db, rfid_ids: List[Optional[str]]) -> List[BulkItemError]:
+    """
+    See endpoints.findRFIDErrors
+    """
+    return findRFIDErrors(rfid_ids, crud.getKindsByRFID(db, [rfid_id for rfid_id in rfid_ids if rfid_id is not None]))
+
+
+def createInBulk(db, items: List, create_items: Callable) -> dict:
+    """
+    Create all items of a batch with a unique RFID in one go, and report the rest as errors.
+    :param create_items: crud function that creates a list of items
+    """
+    errors = checkUniqueRFIDs(db, [item.rfid_id for item in items])
+    valid_items = removeFailedItems(items, errors)
+    return {"created": create_items(db, valid_items) if valid_items else [], "errors": errors}
+
+
+def getItemResponse(db, rfid_id: str) -> Optional[Tuple[ItemKind, bytes]]:
+    """
+    Get the serialized item of an RFID, from the response cache if it's in there.
+    :return: The kind of item and the JSON of it, or None if the RFID isn't known
+    """
+    cached = crud.response_cache.get(rfid_id)
+    if cached is not None:
+        return cached
+    generation = crud.response_cache.getGeneration()
+    return cacheItemResponse(rfid_id, crud.getItemByRFID(db, rfid_id), generation)
+
+
+def getItemResponseOfKind(db, rfid_id: str, kind: ItemKind, not_found_message: str) -> Response:
+    return createItemResponseOfKind(getItemResponse(db, rfid_id), kind, not_found_message)
+
+
+def streamItems(kind: ItemKind, after_id: Optional[int], limit: Optional[int]) -> Iterator[bytes]:
+    # This runs after the request's own session has been closed, so it needs its own.
+    with SessionLocal() as db:
+        for rows in crud.iterateItemRows(db, kind, serialization.item_fields[kind], after_id, limit):
+            yield serialization.dumpItemsNDJSON(kind, rows)
+
+
+def listItems(db, kind: ItemKind, after_id: Optional[int], limit: Optional[int], stream: bool) -> Response:
+    if stream:
+        return createStreamingListResponse(streamItems(kind, after_id, limit))
+    return createListResponse(kind, crud.getItemRows(db, kind, serialization.item_fields[kind], after_id, limit))
 
 
 @app.get("/docs", include_in_schema=False)
@@ -72,24 +119,58 @@ async def redoc_html():
     )
 
 
-@app.get("/samples/", response_model=list[schemas.KrystaliumSample])
-def get_all_krystalium_samples(db: Session = Depends(get_db)):
+@app.get("/items/{rfid_id}", response_model=schemas.Item, responses={404: {"model": NotFoundError}})
+def get_item_by_rfid(rfid_id: str, db: Session = Depends(get_db)):
+    """
+    Get whatever the RFID belongs to (raw Krystalium sample, refined Krystalium or blood sample), together with what
+    kind of item it is.
+    """
+    return createItemResponse(getItemResponse(db, rfid_id), rfid_id)
+
+
+@app.get("/events", response_class=StreamingResponse, responses=EVENTS_RESPONSES, description=EVENTS_DESCRIPTION)
+async def get_events(request: Request, after: Optional[str] = None, last_event_id: Optional[str] = Header(None)):
+    return createEventStream(request, after, last_event_id)
+
+
+@app.get("/events/sequence")
+def get_events_sequence():
+    """
+    The id (and its epoch and sequence number) of the last event that was published, to subscribe to /events after
+    """
+    return getLastEvent()
+
+
+@app.get("/cache/stats", response_model=schemas.ResponseCacheStats)
+def get_response_cache_stats():
+    """
+    How well the cache of the responses for single RFIDs is doing. Its size is set with CRYSTAL_RESPONSE_CACHE_SIZE.
+    """
+    return crud.response_cache.getStats()
+
+
+@app.post("/simulation/purity", response_model=schemas.PuritySimulationResult)
+def simulate_purity(simulation: schemas.PuritySimulationRequest):
     """
-    Get all known (raw) Krystalium samples
+    Simulate how likely every vulgarity (of random samples) and purity (of random refined Krystalium) is. Opposing
+    actions and targets can be given to see what changing them would do; it doesn't change the ones that are used.
     """
-    return crud.getAllKrystaliumSamples(db)
+    return simulatePurity(simulation.num_draws, simulation.action_pairs, simulation.target_pairs, simulation.seed)
 
 
-@app.get("/samples/{rfid_id}", response_model=schemas.KrystaliumSample)
+@app.get("/samples/", response_model=list[schemas.KrystaliumSample], description="Get all known (raw) Krystalium samples" + LIST_DESCRIPTION)
+def get_all_krystalium_samples(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), stream: bool = False,
+                               db: Session = Depends(get_db)):
+    return listItems(db, ItemKind.sample, after_id, limit, stream)
+
+
+@app.get("/samples/{rfid_id}", response_model=schemas.KrystaliumSample, responses={404: {"model": NotFoundError}})
 def get_krystalium_sample_by_rfid(rfid_id: str, db: Session = Depends(get_db)):
     """
     Get a single raw Krystalium sample by RFID. If it doesn't find anything, you might want to try checking if it's
     refined Krystalium instead!
     """
-    db_sample = crud.getSampleByRFID(db, rfid_id=rfid_id)
-    if not db_sample:
-        raise HTTPException(status_code=404, detail=f"Krystalium Sample with RFID [{rfid_id}] was not found")
-    return db_sample
+    return getItemResponseOfKind(db, rfid_id, ItemKind.sample, f"Krystalium Sample with RFID [{rfid_id}] was not found")
 
 
 @app.delete("/samples/{rfid_id}", responses={404: {"model": NotFoundError}})
@@ -113,6 +194,15 @@ def create_krystalium_sample(sample: schemas.KrystaliumSampleCreate, db: Session
     return crud.createSample(db=db, sample=sample)
 
 
+@app.post("/samples/bulk", response_model=schemas.BulkCreateResult[schemas.KrystaliumSample])
+def create_krystalium_samples(samples: List[schemas.KrystaliumSampleCreate], db: Session = Depends(get_db)):
+    """
+    Add a batch of (raw) Krystalium samples to the DB, in a single transaction. Samples whose RFID is already in use
+    (or used more than once in the batch) are skipped and reported in the errors.
+    """
+    return createInBulk(db, samples, crud.createSamples)
+
+
 @app.post("/sample/random/", response_model=schemas.KrystaliumSample, responses={400: {"model": BadRequestError}})
 def create_random_krystalium_sample(sample: schemas.RandomKrystaliumSampleCreate, db: Session = Depends(get_db)):
     """
@@ -136,6 +226,19 @@ def create_random_krystalium_sample(sample: schemas.RandomKrystaliumSampleCreate
         return result
 
 
+@app.post("/sample/random/bulk", response_model=schemas.BulkCreateResult[schemas.KrystaliumSample])
+def create_random_krystalium_samples(samples: List[schemas.RandomKrystaliumSampleCreate], db: Session = Depends(get_db)):
+    """
+    Create a batch of random raw samples of Krystalium, in a single transaction. Every entry works like it does for
+    /sample/random/. Entries that can't be created are skipped and reported in the errors (with their position in the
+    request).
+    """
+    errors = checkUniqueRFIDs(db, [sample.rfid_id for sample in samples])
+    rfid_ids_and_vulgarities, errors = planRandomSamples(samples, errors)
+    created = crud.createRandomSamples(db, rfid_ids_and_vulgarities) if rfid_ids_and_vulgarities else []
+    return {"created": created, "errors": errors}
+
+
 @app.post("/refined/random/", response_model=schemas.RefinedKrystalium, responses={400: {"model": BadRequestError}})
 def create_random_refined_krystalium(refined_create: schemas.RandomRefinedKrystaliumCreate, db: Session = Depends(get_db)):
     """
@@ -159,12 +262,10 @@ def create_random_refined_krystalium(refined_create: schemas.RandomRefinedKrysta
         return result
 
 
-@app.get("/refined/", response_model=list[schemas.RefinedKrystalium])
-def get_all_refined_krystalium(db: Session = Depends(get_db)):
-    """
-    Get a list of all known refined Krystalium
-    """
-    return crud.getAllRefinedKrystalium(db)
+@app.get("/refined/", response_model=list[schemas.RefinedKrystalium], description="Get a list of all known refined Krystalium" + LIST_DESCRIPTION)
+def get_all_refined_krystalium(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), stream: bool = False,
+                               db: Session = Depends(get_db)):
+    return listItems(db, ItemKind.refined, after_id, limit, stream)
 
 
 @app.get("/refined/{rfid_id}", response_model=schemas.RefinedKrystalium, responses={404: {"model": NotFoundError}})
@@ -173,10 +274,7 @@ def get_refined_krystalium_by_rfid(rfid_id: str, db: Session = Depends(get_db)):
     Get a single refined Krystalium by RFID. If it doesn't find anything, you might want to try checking if it's
     a sample instead!
     """
-    db_refined = crud.getRefineKrystaliumByRFID(db, rfid_id=rfid_id)
-    if not db_refined:
-        raise HTTPException(status_code=404, detail=f"Refined Krystalium with RFID [{rfid_id}] was not found")
-    return db_refined
+    return getItemResponseOfKind(db, rfid_id, ItemKind.refined, f"Refined Krystalium with RFID [{rfid_id}] was not found")
 
 
 @app.delete("/refined/{rfid_id}", responses={404: {"model": NotFoundError}})
@@ -197,6 +295,15 @@ def create_refined_krystalium(refined_krystalium: schemas.RefinedKrystaliumCreat
     return crud.createRefinedKrystalium(db=db, refined_krystalium=refined_krystalium)
 
 
+@app.post("/refined/bulk", response_model=schemas.BulkCreateResult[schemas.RefinedKrystalium])
+def create_refined_krystaliums(refined_krystaliums: List[schemas.RefinedKrystaliumCreate], db: Session = Depends(get_db)):
+    """
+    Add a batch of refined Krystalium to the DB, in a single transaction. Refined Krystalium whose RFID is already in
+    use (or used more than once in the batch) is skipped and reported in the errors.
+    """
+    return createInBulk(db, refined_krystaliums, crud.createRefinedKrystaliums)
+
+
 @app.post("/refined/create_from_samples/", response_model=schemas.RefinedKrystalium, responses={400: {"model": BadRequestError}})
 def create_refined_crystalium_from_samples(creation_request: schemas.RefinedKrystaliumFromSample, db: Session = Depends(get_db)):
     """
@@ -213,40 +320,22 @@ def create_refined_crystalium_from_samples(creation_request: schemas.RefinedKrys
                             detail=f"You must use different samples")
 
     db_positive_sample = crud.getSampleByRFID(db, rfid_id=creation_request.positive_sample_rfid_id)
-    if not db_positive_sample:
-        raise HTTPException(status_code=400, detail=f"Krystalium Sample for the positive slot with RFID [{creation_request.positive_sample_rfid_id}] was not found")
-
-    if db_positive_sample.depleted:
-        raise HTTPException(status_code=400, detail=f"The positive sample is depleted, so it can't be used")
-
     db_negative_sample = crud.getSampleByRFID(db, rfid_id=creation_request.negative_sample_rfid_id)
-    if not db_negative_sample:
-        raise HTTPException(status_code=400,
-                            detail=f"Krystalium Sample for the negative slot with RFID [{creation_request.negative_sample_rfid_id}] was not found")
-
-    if db_negative_sample.depleted:
-        raise HTTPException(status_code=400, detail=f"The negative sample is depleted, so it can't be used")
-
-    # Check if the samples are exactly the same (eg have same targets & actions)
-    if db_positive_sample.positive_target == db_negative_sample.positive_target and \
-            db_positive_sample.negative_target == db_negative_sample.negative_target and \
-            db_positive_sample.positive_action == db_negative_sample.positive_action and \
-            db_positive_sample.negative_action == db_negative_sample.negative_action:
-        raise HTTPException(status_code=400,
-                            detail=f"The samples must have at least one property different from each other")
+    checkSamplesCanBeRefined(creation_request, db_positive_sample, db_negative_sample)
     # The provided refined Krystalium rfid id must be unique
     checkUniqueRFID(db, creation_request.refined_krystalium_rfid_id)
 
-    # We're good to go!
-    return crud.createRefinedKrystaliumFromSamples(db, negative_sample=db_negative_sample, positive_sample=db_positive_sample, refined_rfid_id=creation_request.refined_krystalium_rfid_id)
+    # We're good to go! Unless another station just used one of the samples, which is only known once they're depleted.
+    db_refined = crud.createRefinedKrystaliumFromSamples(db, negative_sample=db_negative_sample, positive_sample=db_positive_sample, refined_rfid_id=creation_request.refined_krystalium_rfid_id)
+    if db_refined is None:
+        raise HTTPException(status_code=400, detail=f"One of the samples was depleted by another refinement, so it can't be used")
+    return db_refined
 
 
-@app.get("/blood", response_model = list[schemas.BloodSample], responses = {400: {"model": BadRequestError}})
-def get_all_blood_samples(db: Session = Depends(get_db)):
-    """
-    Get a list of all blood samples.
-    """
-    return crud.getAllBloodSamples(db)
+@app.get("/blood", response_model = list[schemas.BloodSample], responses = {400: {"model": BadRequestError}}, description = "Get a list of all blood samples." + LIST_DESCRIPTION)
+def get_all_blood_samples(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), stream: bool = False,
+                          db: Session = Depends(get_db)):
+    return listItems(db, ItemKind.blood, after_id, limit, stream)
 
 
 @app.post("/blood", response_model = schemas.BloodSample, responses = {400: {"model": BadRequestError}})
@@ -258,12 +347,21 @@ def create_blood_sample(sample: schemas.BloodSampleCreate, db: Session = Depends
     return crud.createBloodSample(db = db, blood_sample = sample)
 
 
-@app.get("/blood/{rfid_id}", response_model = schemas.BloodSample, responses = {400: {"model": BadRequestError}})
+@app.post("/blood/bulk", response_model = schemas.BulkCreateResult[schemas.BloodSample])
+def create_blood_samples(samples: List[schemas.BloodSampleCreate], db: Session = Depends(get_db)):
+    """
+    Create a batch of blood samples, in a single transaction. Samples whose RFID is already in use (or used more than
+    once in the batch) are skipped and reported in the errors.
+    """
+    return createInBulk(db, samples, crud.createBloodSamples)
+
+
+@app.get("/blood/{rfid_id}", response_model = schemas.BloodSample, responses = {404: {"model": NotFoundError}})
 def get_blood_sample_by_rfid(rfid_id: str, db: Session = Depends(get_db)):
     """
     Get a single blood sample by RFID ID.
     """
-    return crud.getBloodSampleByRFID(db, rfid_id)
+    return getItemResponseOfKind(db, rfid_id, ItemKind.blood, f"Blood sample with RFID [{rfid_id}] was not found")
 
 
 # @app.post("/blood/random", response_model = schemas.BloodSample, responses = {400: {"model": BadRequestError}})
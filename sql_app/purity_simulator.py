@@ -0,0 +1,111 @@
+"""
+Shows how likely every vulgarity and purity is, and how that changes when other traits are made opposing.
+
+    python -m sql_app.purity_simulator --draws 10000000
+    python -m sql_app.purity_simulator --action-pairs Heating:Cooling Creating:Destroying --target-pairs Mind:Flesh
+
+Random samples are drawn (every trait independently, like the random sample endpoints do without a vulgarity) and
+pairs of them are refined, like the random refined endpoints do without a purity. Everything goes through the lookup
+tables in crud, so millions of draws take a few seconds. As the traits are uniform, the exact distribution can be
+worked out from the tables as well, which is reported next to the simulated one.
+"""
+import argparse
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from . import crud
+from .OpposingTraitController import OpposingTraitController
+from .schemas import Action, Target
+
+
+def createOpposingTraitController(pairs: Iterable[Tuple]) -> OpposingTraitController:
+    controller = OpposingTraitController()
+    for value_1, value_2 in pairs:
+        controller.addPair(value_1, value_2)
+    return controller
+
+
+def _getHistogram(counts: np.ndarray, names: List[str]) -> Dict[str, float]:
+    return {name: float(count) / max(float(counts.sum()), 1) for name, count in zip(names, counts)}
+
+
+def simulatePurity(num_draws: int = 1000000, action_pairs: Optional[Iterable[Tuple[Action, Action]]] = None,
+                   target_pairs: Optional[Iterable[Tuple[Target, Target]]] = None, seed: Optional[int] = None,
+                   chunk_size: int = 1000000) -> Dict:
+    """
+    :param num_draws: How many refined Krystalium to simulate (twice as many samples are drawn)
+    :param action_pairs: The opposing actions to use instead of the ones in crud
+    :param target_pairs: The opposing targets to use instead of the ones in crud
+    :param seed: Seed for the random numbers, to make the results reproducible
+    :param chunk_size: How many draws to do at once, which bounds the memory that is used
+    :return: The fraction of samples per vulgarity and of refined Krystalium per purity, both simulated and exact
+    """
+    opposing_actions = crud.opposing_actions if action_pairs is None else createOpposingTraitController(action_pairs)
+    opposing_targets = crud.opposing_targets if target_pairs is None else createOpposingTraitController(target_pairs)
+    vulgarity_table = crud.createVulgarityTable(opposing_actions.getMatrix(crud.action_list),
+                                                opposing_targets.getMatrix(crud.target_list)).ravel()
+    num_vulgarities = len(crud.vulgarity_list)
+    num_purities = len(crud.purity_list)
+
+    random = np.random.default_rng(seed)
+    vulgarity_counts = np.zeros(num_vulgarities, dtype=np.int64)
+    purity_counts = np.zeros(num_purities, dtype=np.int64)
+    for start in range(0, num_draws, chunk_size):
+        size = min(chunk_size, num_draws - start)
+        # Every entry of the table is one combination of traits, and they are all as likely
+        positive_samples = vulgarity_table[random.integers(0, len(vulgarity_table), size)]
+        negative_samples = vulgarity_table[random.integers(0, len(vulgarity_table), size)]
+        vulgarity_counts += np.bincount(positive_samples, minlength=num_vulgarities)
+        vulgarity_counts += np.bincount(negative_samples, minlength=num_vulgarities)
+        purity_counts += np.bincount(crud.purity_table[positive_samples, negative_samples], minlength=num_purities)
+
+    exact_vulgarity = np.bincount(vulgarity_table, minlength=num_vulgarities) / len(vulgarity_table)
+    exact_purity = np.zeros(num_purities)
+    np.add.at(exact_purity, crud.purity_table, np.outer(exact_vulgarity, exact_vulgarity))
+
+    vulgarity_names = [vulgarity.value for vulgarity in crud.vulgarity_list]
+    purity_names = [purity.value for purity in crud.purity_list]
+    return {"num_draws": num_draws,
+            "vulgarity": _getHistogram(vulgarity_counts, vulgarity_names),
+            "purity": _getHistogram(purity_counts, purity_names),
+            "exact_vulgarity": dict(zip(vulgarity_names, exact_vulgarity.tolist())),
+            "exact_purity": dict(zip(purity_names, exact_purity.tolist()))}
+
+
+def _parsePairs(pairs: Optional[List[str]], enum) -> Optional[List[Tuple]]:
+    if pairs is None:
+        return None
+    parsed = []
+    for pair in pairs:
+        value_1, _, value_2 = pair.partition(":")
+        parsed.append((enum(value_1), enum(value_2)))
+    return parsed
+
+
+def _printHistogram(title: str, simulated: Dict[str, float], exact: Dict[str, float]) -> None:
+    print(title)
+    for name, fraction in simulated.items():
+        print(f"  {name:>20}: {fraction * 100:6.2f}% (exact {exact[name] * 100:6.2f}%) {'#' * round(fraction * 100)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the distribution of vulgarity and purity")
+    parser.add_argument("--draws", type=int, default=1000000, help="Number of refined Krystalium to simulate")
+    parser.add_argument("--action-pairs", nargs="*", default=None,
+                        help="Opposing actions to use instead of the current ones, as Action:Action")
+    parser.add_argument("--target-pairs", nargs="*", default=None,
+                        help="Opposing targets to use instead of the current ones, as Target:Target")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", default=None, help="Also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    simulation = simulatePurity(args.draws, _parsePairs(args.action_pairs, Action), _parsePairs(args.target_pairs, Target),
+                                args.seed)
+    _printHistogram("Vulgarity of random samples", simulation["vulgarity"], simulation["exact_vulgarity"])
+    _printHistogram("Purity of random refined Krystalium", simulation["purity"], simulation["exact_purity"])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(simulation, f, indent=2)
@@ -1,4 +1,4 @@
-from typing import Optional, Union
+from typing import Dict, Generic, List, Optional, Tuple, TypeVar, Union
 
 from pydantic import BaseModel, Field, computed_field
 from enum import Enum
@@ -77,11 +77,16 @@ class Vulgarity(str, Enum):
 
     @staticmethod
     def getScore(vulgarity: Union["Vulgarity", str]) -> int:
-        return list(Vulgarity).index(vulgarity) + 1
+        return _vulgarity_scores[vulgarity]
 
     @staticmethod
     def getByScore(score: int) -> "Vulgarity":
-        return list(Vulgarity)[score - 1]
+        return _vulgarities[score - 1]
+
+
+_vulgarities = list(Vulgarity)
+# The enum is a string, so the plain values work as keys too
+_vulgarity_scores = {vulgarity: index + 1 for index, vulgarity in enumerate(_vulgarities)}
 
 
 class Purity(str, Enum):
@@ -104,11 +109,24 @@ class Purity(str, Enum):
 
     @staticmethod
     def getScore(purity: Union["Purity", str]) -> int:
-        return list(Purity).index(purity) + 2
+        return _purity_scores[purity]
 
     @staticmethod
     def getByScore(score: int) -> "Purity":
-        return list(Purity)[score - 2]
+        return _purities[score - 2]
+
+
+_purities = list(Purity)
+_purity_scores = {purity: index + 2 for index, purity in enumerate(_purities)}
+
+
+class ItemKind(str, Enum):
+    """
+    The kinds of items that can have an RFID
+    """
+    sample = "sample"
+    refined = "refined"
+    blood = "blood"
 
 
 class KrystaliumSampleBase(BaseModel):
@@ -192,6 +210,11 @@ class BloodSample(BloodSampleBase):
         orm_mode = True
 
 
+class Item(BaseModel):
+    kind: ItemKind = Field(description="What kind of item the RFID belongs to")
+    item: Union[KrystaliumSample, RefinedKrystalium, BloodSample] = Field(description="The item itself")
+
+
 class RefinedKrystaliumCreate(RefinedKrystaliumBase):
     pass
 
@@ -232,9 +255,57 @@ class RandomBloodSampleCreate(BaseModel):
     num_samples: int = Field(1, description = "The number of samples to create")
 
 
+BulkItem = TypeVar("BulkItem")
+
+
+class BulkItemError(BaseModel):
+    index: int = Field(description="Position of the item in the request")
+    rfid_id: Optional[str] = Field(None, description="The RFID id of the item, if it had one")
+    detail: str
+
+
+class BulkCreateResult(BaseModel, Generic[BulkItem]):
+    """
+    The result of creating a batch of items. The items without errors are all created (in a single transaction), the
+    others are left out and reported as errors.
+    """
+    created: List[BulkItem] = Field(description="The items that were created, in the order of the request")
+    errors: List[BulkItemError] = Field(description="The items that could not be created and why")
+
+
+class PuritySimulationRequest(BaseModel):
+    num_draws: int = Field(1000000, ge=1, le=20000000, description="How many refined Krystalium to simulate")
+    action_pairs: Optional[List[Tuple[Action, Action]]] = Field(None, description="Opposing actions to try instead of the current ones")
+    target_pairs: Optional[List[Tuple[Target, Target]]] = Field(None, description="Opposing targets to try instead of the current ones")
+    seed: Optional[int] = Field(None, description="Seed for the simulation, to make it reproducible")
+
+
+class PuritySimulationResult(BaseModel):
+    num_draws: int
+    vulgarity: Dict[Vulgarity, float] = Field(description="Simulated fraction of random samples per vulgarity")
+    purity: Dict[Purity, float] = Field(description="Simulated fraction of random refined Krystalium per purity")
+    exact_vulgarity: Dict[Vulgarity, float] = Field(description="Exact fraction of random samples per vulgarity")
+    exact_purity: Dict[Purity, float] = Field(description="Exact fraction of random refined Krystalium per purity")
+
+
+class ResponseCacheStats(BaseModel):
+    hits: int = Field(description="Lookups that were answered from the cache")
+    misses: int = Field(description="Lookups that had to go to the database")
+    invalidations: int = Field(description="Cached responses that were dropped because the item changed")
+    evictions: int = Field(description="Cached responses that were dropped to make room")
+    entries: int = Field(description="Responses in the cache right now")
+    max_entries: int = Field(description="How many responses the cache holds at most")
+
+
 class BadRequestError(BaseModel):
     detail: str
 
 
 class NotFoundError(BaseModel):
     detail: str
+
+
+# Detail of the BadRequestError when an RFID is already used by an item of the given kind
+rfid_in_use_messages = {ItemKind.sample: "A Krystalium sample with the RFID id [{}] has already been registered",
+                        ItemKind.refined: "A refined Krystalium with the RFID id [{}] has already been registered",
+                        ItemKind.blood: "A blood sample with the RFID id [{}] has already been registered"}
@@ -0,0 +1,87 @@
+"""
+Fast path for sending out many items at once. Instead of loading the models and having pydantic validate and
+serialize every one of them, the columns are selected as plain rows, turned into dicts and encoded in one go. What
+comes out of the database was validated on the way in, so it isn't validated again.
+
+The output is the same as that of the schemas (including their computed fields); this is checked when it's imported.
+"""
+import json
+import logging
+from typing import Dict, Iterable, List, Tuple
+
+from .schemas import ItemKind, Purity, Vulgarity, KrystaliumSample, RefinedKrystalium, BloodSample
+
+try:
+    import orjson
+    orjson_enabled = True
+except ImportError:
+    orjson_enabled = False
+
+if orjson_enabled:
+    logging.info("Encoding lists of items with orjson")
+else:
+    # It's in the requirements, so this is most likely a platform it has no wheels for. Everything still works, slower.
+    logging.warning("orjson is not installed, encoding lists of items with json instead")
+
+
+item_schemas = {ItemKind.sample: KrystaliumSample,
+                ItemKind.refined: RefinedKrystalium,
+                ItemKind.blood: BloodSample}
+
+# The columns to select per kind of item, in the order the schema has them
+item_fields: Dict[ItemKind, List[str]] = {kind: list(schema.model_fields) for kind, schema in item_schemas.items()}
+
+# The computed fields of the schemas, as (name, field it's computed from, value of the field -> result)
+_vulgarity_scores = {vulgarity.value: Vulgarity.getScore(vulgarity) for vulgarity in Vulgarity}
+_purity_scores = {purity.value: Purity.getScore(purity) for purity in Purity}
+computed_fields: Dict[ItemKind, List[Tuple[str, str, Dict]]] = {
+    ItemKind.sample: [("vulgarity_score", "vulgarity", _vulgarity_scores)],
+    ItemKind.refined: [("purity_score", "purity", _purity_scores)],
+    ItemKind.blood: [],
+}
+
+for _kind, _schema in item_schemas.items():
+    if {name for name, _, _ in computed_fields[_kind]} != set(_schema.model_computed_fields):
+        raise RuntimeError(f"The computed fields of {_schema.__name__} changed, update them in serialization as well")
+
+
+def dumps(data) -> bytes:
+    if orjson_enabled:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def rowsToDicts(kind: ItemKind, rows: Iterable[Tuple]) -> List[Dict]:
+    """
+    :param rows: Rows with the columns of item_fields[kind]
+    """
+    field_names = item_fields[kind]
+    computed = computed_fields[kind]
+    items = []
+    for row in rows:
+        item = dict(zip(field_names, row))
+        for name, source, results in computed:
+            item[name] = results[item[source]]
+        items.append(item)
+    return items
+
+
+def modelToDict(kind: ItemKind, db_item) -> Dict:
+    """
+    Like rowsToDicts, for a single model that is loaded already
+    """
+    return rowsToDicts(kind, [[getattr(db_item, name) for name in item_fields[kind]]])[0]
+
+
+def dumpItems(kind: ItemKind, rows: Iterable[Tuple]) -> bytes:
+    """
+    Encode the rows as a JSON list
+    """
+    return dumps(rowsToDicts(kind, rows))
+
+
+def dumpItemsNDJSON(kind: ItemKind, rows: Iterable[Tuple]) -> bytes:
+    """
+    Encode the rows as newline delimited JSON, one item per line
+    """
+    return b"".join(dumps(item) + b"\n" for item in rowsToDicts(kind, rows))